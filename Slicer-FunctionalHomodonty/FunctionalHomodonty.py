@@ -1,6 +1,8 @@
 import os
 import unittest
 import logging
+import contextlib
+import threading
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
@@ -51,6 +53,8 @@ class FunctionalHomodontyWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
     self.logic = None
     self._parameterNode = None
     self._updatingGUIFromParameterNode = False
+    self.backgroundRun = None
+    self.runControlStates = []
 
   def setup(self):
     """
@@ -72,6 +76,11 @@ class FunctionalHomodontyWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
     # Create logic class. Logic implements all computations that should be possible to run
     # in batch mode, without a graphical user interface.
     self.logic = FunctionalHomodontyLogic()
+
+    # Progress of background runs is polled from the worker
+    self.backgroundRunTimer = qt.QTimer()
+    self.backgroundRunTimer.setInterval(100)
+    self.backgroundRunTimer.connect('timeout()', self.onBackgroundRunProgress)
         
     # Connections
 
@@ -88,16 +97,17 @@ class FunctionalHomodontyWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
     self.ui.tableSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
     self.ui.SpecieslineEdit.connect('stateChanged(int)', self.updateParameterNodeFromGUI)
     self.ui.SegmentSelectorWidget.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
+    self.ui.ForceInputSlider.connect("valueChanged(double)", self.onForceChanged)
     
 
     # Buttons
     self.ui.applyButton.connect('clicked(bool)', self.onApplyButton)
+    self.ui.CancelButton.connect('clicked(bool)', self.onCancelButton)
     self.ui.ResetpushButton.connect('clicked(bool)', self.onResetButton)
     self.ui.TemplatepushButton.connect('clicked(bool)', self.onTemplate)
     self.ui.FlipButton.connect('clicked(bool)', self.onFlipResults)
-    self.ui.FlipButton.connect('clicked(bool)', self.onApplyButton)
     self.ui.FlipSomeButton.connect('clicked(bool)', self.onFlipSomeResults)
-    self.ui.FlipSomeButton.connect('clicked(bool)', self.onApplyButton)
+    self.ui.EditLinesButton.connect('clicked(bool)', self.onEditLines)
     self.ui.PosVisButton.connect('clicked(bool)', self.onPositionVis)
     self.ui.OutVisButton.connect('clicked(bool)', self.onOutleverVis)
     self.ui.segmentationSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onResetButton)
@@ -111,6 +121,8 @@ class FunctionalHomodontyWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
     """
     Called when the application closes and the module widget is destroyed.
     """
+    if self.backgroundRun:
+      self.backgroundRun.cancel()
     self.removeObservers()
 
   def enter(self):
@@ -131,6 +143,9 @@ class FunctionalHomodontyWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
     """
     Called just before the scene is closed.
     """
+    if self.backgroundRun:
+      self.backgroundRun.cancel()
+      self.backgroundRun.thread.join()
     # Parameter node will be reset, do not use it anymore
     self.setParameterNode(None)
 
@@ -206,7 +221,10 @@ class FunctionalHomodontyWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
     self.ui.tableSelector.blockSignals(wasBlocked)
 
     # Update buttons states and tooltips
-    if self._parameterNode.GetNodeReference("Segmentation") and self.ui.SimpleMarkupsWidget.currentNode() is not None:
+    if self.backgroundRun is not None:
+      self.ui.applyButton.toolTip = "Computing functional homodonty"
+      self.ui.applyButton.enabled = False
+    elif self._parameterNode.GetNodeReference("Segmentation") and self.ui.SimpleMarkupsWidget.currentNode() is not None:
       self.ui.applyButton.toolTip = "Compute functional homodonty"
       self.ui.applyButton.enabled = True
     else:
@@ -260,91 +278,63 @@ class FunctionalHomodontyWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
     """
     Run processing when user clicks "Flip" button.
     """
-    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    pluginHandler = slicer.qSlicerSubjectHierarchyPluginHandler().instance()
-    folderPlugin = pluginHandler.pluginByName("Folder")
-    outvis = folderPlugin.getDisplayVisibility(shNode.GetItemByName("Out Levers"))
-    posvis = folderPlugin.getDisplayVisibility(shNode.GetItemByName("Tooth Positions"))
-    folderPlugin.setDisplayVisibility(shNode.GetItemByName("Out Levers"), 0)
-    folderPlugin.setDisplayVisibility(shNode.GetItemByName("Tooth Positions"), 0)
-    
-    
-    OutItemID = shNode.GetItemByName("Out Levers")
-    Outchildren = vtk.vtkIdList()
-    shNode.GetItemChildren(OutItemID, Outchildren)
-    PosItemID = shNode.GetItemByName("Tooth Positions")
-    Poschildren = vtk.vtkIdList()
-    shNode.GetItemChildren(PosItemID, Poschildren)
-
-    for i in range(Outchildren.GetNumberOfIds()):
-      child = Outchildren.GetId(i)
-      shNode.SetItemParent(child, PosItemID)
-      childNode = shNode.GetItemDataNode(child)
-      childNode.GetDisplayNode().SetSelectedColor((0, 0.72, 0.92))
-      childNode.GetDisplayNode().SetActiveColor((1, 0.65, 0.0))
-
-
-    for i in range(Poschildren.GetNumberOfIds()):
-      child = Poschildren.GetId(i)
-      shNode.SetItemParent(child, OutItemID)
-      childNode = shNode.GetItemDataNode(child)
-      childNode.GetDisplayNode().SetSelectedColor((1.0, 0.5000076295109483, 0.5000076295109483))
-      childNode.GetDisplayNode().SetActiveColor((0.4, 1.0, 0.0))
-      
-    pluginHandler = slicer.qSlicerSubjectHierarchyPluginHandler().instance()
-    folderPlugin = pluginHandler.pluginByName("Folder")
-    folderPlugin.setDisplayVisibility(shNode.GetItemByName("Out Levers"), outvis)
-    folderPlugin.setDisplayVisibility(shNode.GetItemByName("Tooth Positions"), posvis)
+    try:
+      if not self.logic.flipTeeth(self.ui.tableSelector.currentNode(), self.ui.ForceInputSlider.value):
+        self.recomputeFlippedResults()
+    except Exception as e:
+      slicer.util.errorDisplay("Failed to flip results: "+str(e))
+      import traceback
+      traceback.print_exc()
 
   def onFlipSomeResults(self):
     """
     Run processing when user clicks "Flip" button.
     """
-    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    pluginHandler = slicer.qSlicerSubjectHierarchyPluginHandler().instance()
-    folderPlugin = pluginHandler.pluginByName("Folder")
-    outvis = folderPlugin.getDisplayVisibility(shNode.GetItemByName("Out Levers"))
-    posvis = folderPlugin.getDisplayVisibility(shNode.GetItemByName("Tooth Positions"))
-    folderPlugin.setDisplayVisibility(shNode.GetItemByName("Out Levers"), 0)
-    folderPlugin.setDisplayVisibility(shNode.GetItemByName("Tooth Positions"), 0)
-    
-    segmentation = self.ui.SegmentSelectorWidget.currentNode()
-    segments = self.ui.SegmentSelectorWidget.selectedSegmentIDs()
-    OutItemID = shNode.GetItemByName("Out Levers")
-    PosItemID = shNode.GetItemByName("Tooth Positions")
-    Outchildren = []
-    Poschildren = []
-
-    for i in segments:
-      segname = segmentation.GetSegmentation().GetSegment(i).GetName()
-      Outchildren.append(shNode.GetItemChildWithName(OutItemID, segname))
-      Poschildren.append(shNode.GetItemChildWithName(PosItemID, segname))
-
-    for i in Outchildren:
-      child = i
-      shNode.SetItemParent(child, PosItemID)
-      childNode = shNode.GetItemDataNode(child)
-      childNode.GetDisplayNode().SetSelectedColor((0, 0.72, 0.92))
-      childNode.GetDisplayNode().SetActiveColor((1, 0.65, 0.0))
-
-    for i in Poschildren:
-      child = i
-      shNode.SetItemParent(child, OutItemID)
-      childNode = shNode.GetItemDataNode(child)
-      childNode.GetDisplayNode().SetSelectedColor((1.0, 0.5000076295109483, 0.5000076295109483))
-      childNode.GetDisplayNode().SetActiveColor((0.4, 1.0, 0.0))
-      
-    pluginHandler = slicer.qSlicerSubjectHierarchyPluginHandler().instance()
-    folderPlugin = pluginHandler.pluginByName("Folder")
-    folderPlugin.setDisplayVisibility(shNode.GetItemByName("Out Levers"), outvis)
-    folderPlugin.setDisplayVisibility(shNode.GetItemByName("Tooth Positions"), posvis)
+    try:
+      segmentation = self.ui.SegmentSelectorWidget.currentNode()
+      teeth = [(segmentation, segmentId) for segmentId in self.ui.SegmentSelectorWidget.selectedSegmentIDs()]
+      if not self.logic.flipTeeth(self.ui.tableSelector.currentNode(), self.ui.ForceInputSlider.value, teeth):
+        self.recomputeFlippedResults()
+    except Exception as e:
+      slicer.util.errorDisplay("Failed to flip results: "+str(e))
+      import traceback
+      traceback.print_exc()
+
+  def recomputeFlippedResults(self):
+    """
+    Run Apply again for switched teeth whose rows could not be updated from the cache, the switched lines
+    take precedence in the run.
+    """
+    if self.ui.tableSelector.currentNode() and self.ui.applyButton.enabled:
+      logging.info('Switched teeth are not cached, computing results again')
+      self.onApplyButton()
+
+  def onEditLines(self):
+    """
+    Run processing when user clicks "Edit Selected Lines" button.
+    """
+    try:
+      segmentation = self.ui.SegmentSelectorWidget.currentNode()
+      self.logic.editToothLines([(segmentation, segmentId) for segmentId in self.ui.SegmentSelectorWidget.selectedSegmentIDs()])
+    except Exception as e:
+      slicer.util.errorDisplay("Failed to create lines: "+str(e))
+      import traceback
+      traceback.print_exc()
+
+  def onForceChanged(self, force):
+    """
+    Update tooth forces and stresses of the results table as the force slider moves.
+    """
+    tableNode = self.ui.tableSelector.currentNode()
+    if tableNode and self.backgroundRun is None:
+      self.logic.updateResultsForce(tableNode, force)
 
   def onOutleverVis(self):
     """
     Run processing when user clicks "Outlever Vis" button.
     """    
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    folderItemID = shNode.GetItemByName("Out Levers")
+    folderItemID = self.logic.getResultFolders()[2]
     pluginHandler = slicer.qSlicerSubjectHierarchyPluginHandler().instance()
     folderPlugin = pluginHandler.pluginByName("Folder")
 
@@ -359,7 +349,7 @@ class FunctionalHomodontyWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
     Run processing when user clicks "Outlever Vis" button.
     """
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    folderItemID = shNode.GetItemByName("Tooth Positions")
+    folderItemID = self.logic.getResultFolders()[1]
     pluginHandler = slicer.qSlicerSubjectHierarchyPluginHandler().instance()
     folderPlugin = pluginHandler.pluginByName("Folder")
 
@@ -377,6 +367,7 @@ class FunctionalHomodontyWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
     shFolderItemId = shNode.GetItemByName("Functional Homodonty Misc")
     shNode.RemoveItem(shFolderItemId)
     slicer.mrmlScene.RemoveNode(self.ui.tableSelector.currentNode())
+    self.logic.toothResultCache.clear()
     layoutManager = slicer.app.layoutManager()
 
     tableWidget = layoutManager.tableWidget(0)
@@ -386,6 +377,7 @@ class FunctionalHomodontyWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
     self.ui.FlipButton.enabled = False
     self.ui.FlipSomeButton.enabled = False
     self.ui.FlipSomeButton.enabled = False
+    self.ui.EditLinesButton.enabled = False
     self.ui.SegmentSelectorWidget.enabled = False
     #self.ui.ResetpushButton.enabled = False
     
@@ -408,28 +400,108 @@ class FunctionalHomodontyWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
         tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode", expTable)
         self.ui.tableSelector.setCurrentNode(tableNode)
 
-      # Compute output
-      self.logic.run(self.ui.segmentationSelector.currentNode(), self.ui.SimpleMarkupsWidget.currentNode(), 
-      self.ui.ForceInputSlider.value, tableNode, self.ui.SpecieslineEdit.text, self.ui.LowerradioButton.checked, self.ui.UpperradioButton.checked,
-      self.ui.LeftradioButton.checked, self.ui.RightradioButton.checked)
-      
+      jaw = self.logic.createJaw(self.ui.segmentationSelector.currentNode(), self.ui.SimpleMarkupsWidget.currentNode(),
+      self.ui.LowerradioButton.checked, self.ui.UpperradioButton.checked, self.ui.LeftradioButton.checked, self.ui.RightradioButton.checked)
+      self.logic.compactLines = self.ui.CompactcheckBox.checked
+      self.logic.statisticsMethod = "Lean" if self.ui.StatisticsMethodComboBox.currentText == "Lean" else "SegmentStatistics"
+
+      if self.logic.statisticsMethod != "Lean" and not self.ui.PreviewcheckBox.checked:
+        # the Segment Statistics module works through the scene, so it cannot run in the background
+        slicer.app.setOverrideCursor(qt.Qt.WaitCursor)
+        try:
+          self.logic.runMultipleJaws([jaw], self.ui.ForceInputSlider.value, tableNode, self.ui.SpecieslineEdit.text,
+          self.ui.AppendcheckBox.checked)
+        finally:
+          slicer.app.restoreOverrideCursor()
+        self.enableResultControls()
+        return
+
+      # Compute output in the background, the scene and table are updated when the worker is done
+      self.backgroundRun = self.logic.startBackgroundRun([jaw], self.ui.ForceInputSlider.value, tableNode, self.ui.SpecieslineEdit.text,
+      self.ui.AppendcheckBox.checked, self.ui.PreviewcheckBox.checked)
+
+      self.setRunControlsEnabled(False)
+      self.ui.progressBar.value = 0
+      self.ui.progressBar.visible = True
+      self.ui.CancelButton.visible = True
+      self.backgroundRunTimer.start()
 
-      self.ui.OutVisButton.enabled = True
-      self.ui.PosVisButton.enabled = True
-      self.ui.FlipButton.enabled = True
-      self.ui.FlipSomeButton.enabled = True
-      self.ui.SegmentSelectorWidget.enabled = True
-      self.ui.ResetpushButton.enabled = True  
-      
-      
-      if len(self.ui.SegmentSelectorWidget.selectedSegmentIDs()) != 0:
-        self.ui.SegmentSelectorWidget.multiSelection = False
-        self.ui.SegmentSelectorWidget.multiSelection = True
+    except Exception as e:
+      slicer.util.errorDisplay("Failed to compute results: "+str(e))
+      import traceback
+      traceback.print_exc()
+
+  def onBackgroundRunProgress(self):
+    """
+    Show the progress of the background run and finish it on the main thread when the worker is done.
+    """
+    completed, total, message = self.backgroundRun.getProgress()
+    self.ui.progressBar.maximum = max(total, 1)
+    self.ui.progressBar.value = completed
+    self.ui.progressBar.format = message + " (%p%)"
+    if self.backgroundRun.isRunning():
+      return
+
+    self.backgroundRunTimer.stop()
+    backgroundRun = self.backgroundRun
+    self.backgroundRun = None
+    self.ui.progressBar.visible = False
+    self.ui.CancelButton.visible = False
+    self.setRunControlsEnabled(True)
+    try:
+      if not self.logic.finishBackgroundRun(backgroundRun):
+        return
+      if self.ui.ForceInputSlider.value != backgroundRun.arguments[1]:
+        # force was changed while the worker was running
+        self.logic.updateResultsForce(self.ui.tableSelector.currentNode(), self.ui.ForceInputSlider.value)
+      self.enableResultControls()
  
     except Exception as e:
       slicer.util.errorDisplay("Failed to compute results: "+str(e))
       import traceback
       traceback.print_exc()
+
+  def setRunControlsEnabled(self, enabled):
+    """
+    Disable the controls that change the scene, lines or caches used by a background run while it runs,
+    and restore their previous state afterwards.
+    """
+    controls = [self.ui.FlipButton, self.ui.FlipSomeButton, self.ui.EditLinesButton, self.ui.ResetpushButton,
+      self.ui.segmentationSelector, self.ui.SegmentSelectorWidget, self.ui.TemplatepushButton]
+    if not enabled:
+      self.runControlStates = [control.enabled for control in controls]
+      for control in controls:
+        control.enabled = False
+    else:
+      for control, controlEnabled in zip(controls, self.runControlStates):
+        control.enabled = controlEnabled
+      self.runControlStates = []
+    self.updateGUIFromParameterNode()
+
+  def enableResultControls(self):
+    """
+    Enable the controls that work on the results of a run.
+    """
+    self.ui.OutVisButton.enabled = True
+    self.ui.PosVisButton.enabled = True
+    self.ui.FlipButton.enabled = True
+    self.ui.FlipSomeButton.enabled = True
+    self.ui.EditLinesButton.enabled = True
+    self.ui.SegmentSelectorWidget.enabled = True
+    self.ui.ResetpushButton.enabled = True  
+    
+    
+    if len(self.ui.SegmentSelectorWidget.selectedSegmentIDs()) != 0:
+      self.ui.SegmentSelectorWidget.multiSelection = False
+      self.ui.SegmentSelectorWidget.multiSelection = True
+
+  def onCancelButton(self):
+    """
+    Stop the background run. Teeth already measured stay cached, the scene and table are not changed.
+    """
+    if self.backgroundRun:
+      self.backgroundRun.cancel()
+      self.ui.progressBar.format = "Cancelling..."
 #
 # FunctionalHomodontyLogic
 #
@@ -449,6 +521,91 @@ class FunctionalHomodontyLogic(ScriptedLoadableModuleLogic):
     Called when the logic class is instantiated. Can be used for initializing member variables.
     """
     ScriptedLoadableModuleLogic.__init__(self)
+    # world-space surface and cell locator of each tooth, keyed by (segmentation node ID, segment ID)
+    # and then by decimation error
+    self.surfaceCache = {}
+    # tooth surfaces used for base/tip searches are decimated so that they move by at most this distance (mm),
+    # None keeps the full resolution surfaces
+    self.surfaceDecimationError = None
+    # base and tip of a tooth: "BoundingBox" snaps the ends of its oriented bounding box onto the surface,
+    # "PrincipalAxis" takes the surface points furthest along its longest bounding box axis
+    # (see computeBaseAndTipPoints)
+    self.baseTipMethod = "BoundingBox"
+    # area, OBB size and base/tip points of each tooth, keyed by (segmentation node ID, segment ID)
+    self.toothGeometryCache = {}
+    # the same for preview runs (see run), which measure labelmaps downsampled by previewDownsampling
+    # and snap points to decimated surfaces
+    self.previewGeometryCache = {}
+    self.previewDownsampling = 2
+    # landmarks, base/tip points, area, OBB size and table row key of each tooth of the last full run,
+    # keyed by (segmentation node ID, segment ID); flips recompute the rows of the flipped teeth from it
+    self.toothResultCache = {}
+    # draw the lines of teeth without markups lines as a single model per result folder (see updateCompactToothLines),
+    # markups are created only for teeth chosen for editing (see editToothLines)
+    self.compactLines = False
+    # tooth lines are indexed by segment ID in node references of the segmentation node (see setToothLines)
+    self.toothLineReferenceRole = "FunctionalHomodonty.ToothLine."
+    self.toothLineSegmentationReferenceRole = "FunctionalHomodonty.Segmentation"
+    self.toothLineSegmentIdAttribute = "FunctionalHomodonty.SegmentID"
+    # set on the result folder once the lines of older versions in the scene are indexed (see indexLegacyToothLines)
+    self.toothLinesIndexedAttribute = "FunctionalHomodonty.ToothLinesIndexed"
+    self.resultFolders = None  # subject hierarchy item IDs of the result folders (see getResultFolders)
+    # columns of the results table: name, description, unit and whether it holds text
+    self.resultColumns = [
+      ("Species", "Species", None, True),
+      ("Jaw ID", "If upper or lower jaw", None, True),
+      ("Side of Face", "Side of face that the jaw is on", None, True),
+      ("Jaw Length (mm)", "Jaw Length", "mm", False),
+      ("Tooth ID", "Tooth segment name", None, True),
+      ("Position (mm)", "Distance between the base of the tooth and the jaw joint", "mm", False),
+      ("Tooth Height (mm)", "Tooth Height", "mm", False),
+      ("Tooth Width (mm)", "Tooth Width", "mm", False),
+      ("Aspect Ratio", "Tooth Aspect Ratio", "mm", False),
+      ("Surface Area (mm^2)", "Tooth surface area", "mm^2", False),
+      ("Mechanical Advantage", "Tooth mechanical advantage", None, False),
+      ("F-Tooth (N)", "The force acting on a tooth (muscle force * mechanical advantage)", "N", False),
+      ("Stress (N/m^2)", "Tooth stress (tooth force / surface area)", None, False),
+      ]
+    # additional columns of preview results
+    self.previewResultColumns = [
+      ("Position Error (mm)", "Bound of the geometric error of the preview tooth surfaces", "mm", False),
+      ("Surface Area Error (mm^2)", "Estimated error of the preview surface area", "mm^2", False),
+      ]
+    # rows with the same values in these columns belong to the same jaw
+    self.resultKeyColumns = ["Species", "Jaw ID", "Side of Face"]
+    # labelmap statistics plugin measures used by this module
+    self.statisticsMeasurements = ["surface_area_mm2", "centroid_ras", "obb_origin_ras", "obb_diameter_mm",
+      "obb_direction_ras_x", "obb_direction_ras_y", "obb_direction_ras_z"]
+    # segment statistics are also stored on disk, keyed by segment content and enabled measures
+    self.useStatisticsDiskCache = True
+    self.statisticsCacheDirectory = None  # default: FunctionalHomodonty/SegmentStatistics in the Slicer cache folder
+    self.statisticsCacheMaxSizeMB = 100
+    self.statisticsCacheMaxAgeDays = 90
+    # "SegmentStatistics" uses the Segment Statistics module, "Lean" computes only the measures above
+    # in a pool of worker threads (see computeLeanSegmentStatistics)
+    self.statisticsMethod = "SegmentStatistics"
+    self.statisticsWorkers = None  # default: number of CPU cores
+    # surface area of the lean statistics: "FlyingEdges" (same as Segment Statistics) or "BoundaryFaces"
+    # (total area of the voxel faces on the tooth boundary, from the single labelmap pass; faster, but it measures
+    # the voxel staircase and so is larger than the smooth surface)
+    self.leanSurfaceAreaMethod = "FlyingEdges"
+    # rows of each run are also written to this dentition store (see writeDentitionStore), if set
+    self.dentitionStoreDirectory = None
+    self.dentitionStoreMaxChunks = 64  # the store is compacted when it has more chunks
+    # record wall time, calls, peak memory and added scene nodes of each phase of a run (see RunInstrumentation),
+    # shown in the "FunctionalHomodonty Timing" table and written to a JSON log
+    self.instrumentRuns = False
+    self.profileRuns = False  # also capture a cProfile of the run, saved next to the JSON log
+    self.instrumentationLogPath = None  # default: FunctionalHomodontyTiming.json in the Slicer temporary folder
+    self.instrumentationColumns = [
+      ("Phase", "Phase of the run", None, True),
+      ("Tooth", "Tooth segment name, empty for the whole jaw", None, True),
+      ("Calls", "Number of times the phase ran", None, False),
+      ("Time (s)", "Total wall time", "s", False),
+      ("Peak Memory (MB)", "Largest Python and NumPy memory increase within one call", "MB", False),
+      ("Nodes Added", "Number of scene nodes added", None, False),
+      ]
+    self.runInstrumentation = None
 
   def setDefaultParameters(self, parameterNode):
     """
@@ -457,82 +614,1287 @@ class FunctionalHomodontyLogic(ScriptedLoadableModuleLogic):
     if not parameterNode.GetParameter("Force"):
      parameterNode.SetParameter("Force", "1.0")
 
+  def getSegmentClosedSurface(self, segmentationNode, segmentId):
+    """
+    Get the closed surface representation of a segment directly from the segmentation.
+    No copy is made and no model node is added to the scene.
+    :param segmentationNode: segmentation node with the segmented teeth
+    :param segmentId: ID of the tooth segment
+    """
+    closedSurfaceName = slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+    segment = segmentationNode.GetSegmentation().GetSegment(segmentId)
+    return segment.GetRepresentation(closedSurfaceName)
 
-  def run(self, segmentationNode, pointNode, force, tableNode, species, LowerradioButton, UpperradioButton, LeftradioButton, RightradioButton):
+  def getToothSurfaceLocator(self, segmentationData, segmentId, maximumError=None):
     """
-    Run the processing algorithm.
-    Can be used without GUI widget.
-    :param segmentation: segmentation file with all of the segmented teeth
-    :param jawlength: markups line node measuring jaw length
-    :param jawjoint: markups fiducial placed where the jaw joint is
-    :param inlever: markups fiducial placed where the muscle insertion is on the jaw
+    Get the world-space surface of a tooth and a static cell locator built on it.
+    The locator is built only once per segment and reused by every closest-point query.
+    :param segmentationData: segmentation data from getSegmentationData
+    :param segmentId: ID of the tooth segment
+    :param maximumError: decimate the surface, moving it by at most this distance (mm)
+    """
+    surface_World = self.getToothSurface(segmentationData, segmentId, maximumError)
+    cachedSurface = self.surfaceCache[segmentationData["id"], segmentId]["surfaces"][maximumError]
+    if "locator" not in cachedSurface:
+      locator = vtk.vtkStaticCellLocator()
+      locator.SetDataSet(surface_World)
+      locator.BuildLocator()
+      cachedSurface["locator"] = locator
+    return surface_World, cachedSurface["locator"]
+
+  def getToothSurface(self, segmentationData, segmentId, maximumError=None):
+    """
+    Get the world-space surface of a tooth, decimated within maximumError (mm) if given.
+    Surfaces are cached until the closed surface of the segment or its parent transform changes.
+    :param segmentationData: segmentation data from getSegmentationData
+    """
+    segment = segmentationData["segments"][segmentId]
+    cacheKey = (segmentationData["id"], segmentId)
+    if cacheKey not in self.surfaceCache or self.surfaceCache[cacheKey]["surfaceKey"] != segment["surfaceKey"]:
+      self.surfaceCache[cacheKey] = {"surfaceKey": segment["surfaceKey"], "surfaces": {None: {"surface": segment["surface"]}}}
+    segmentSurfaces = self.surfaceCache[cacheKey]["surfaces"]
+    if maximumError not in segmentSurfaces:
+      segmentSurfaces[maximumError] = {"surface": self.decimateSurface(segmentSurfaces[None]["surface"], maximumError)}
+    return segmentSurfaces[maximumError]["surface"]
+
+  def decimateSurface(self, surface, maximumError):
+    """
+    Remove as many triangles as possible from a surface while keeping it within maximumError (mm) of the original.
+    """
+    decimation = vtk.vtkDecimatePro()
+    decimation.SetInputData(surface)
+    decimation.SetTargetReduction(0.99)
+    decimation.PreserveTopologyOn()
+    decimation.ErrorIsAbsoluteOn()
+    decimation.SetAbsoluteError(maximumError)
+    decimation.AccumulateErrorOn()  # bound the distance to the original surface, not to the previous step
+    decimation.Update()
+    logging.debug('Decimated tooth surface from {0} to {1} triangles'.format(
+      surface.GetNumberOfPolys(), decimation.GetOutput().GetNumberOfPolys()))
+    return decimation.GetOutput()
+
+  def findClosestSurfacePoints(self, locator, points):
+    """
+    Find the closest surface point for each of the query points, one locator query per point.
+    VTK locators have no batched query; the locator is built once per surface (see getToothSurfaceLocator),
+    so each query only costs a tree descent, which for the few base and tip candidates of a tooth is faster
+    than any vectorized search over all triangles.
+    :param locator: cell locator returned by getToothSurfaceLocator
+    :param points: sequence of RAS query points (e.g. base and tip candidates)
+    :return: N x 3 array of closest points on the surface
+    """
+    import numpy as np
+
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    closestPoints = np.zeros(points.shape)
+    closestPoint = [0,0,0]
+    cellId = vtk.reference(0)
+    subId = vtk.reference(0)
+    dist2 = vtk.reference(0.0)
+    for i in range(points.shape[0]):
+      locator.FindClosestPoint(points[i], closestPoint, cellId, subId, dist2)
+      closestPoints[i] = closestPoint
+    return closestPoints
+
+
+  def getSegmentLabelmap(self, segmentationNode, segmentId):
+    """
+    Get the binary labelmap representation of a segment (may be a layer shared with other segments).
+    """
+    binaryLabelmapName = slicer.vtkSegmentationConverter.GetSegmentationBinaryLabelmapRepresentationName()
+    segment = segmentationNode.GetSegmentation().GetSegment(segmentId)
+    return segment.GetRepresentation(binaryLabelmapName)
+
+  def getSegmentationData(self, segmentationNode, segmentIds, preview=False, copySurfaces=False, statisticsMethod=None):
+    """
+    Gather what statistics and base/tip searches need from a segmentation into NumPy arrays and VTK data,
+    so that they run without the scene (see startBackgroundRun). Main thread only.
+    Labelmap layers are included only for segments whose labelmap changed since they were last measured,
+    world surfaces only for segments whose surface is not cached (see getToothSurface).
+    Labelmap voxels are NumPy views with no copy, which for large volumes would take long; each layer holds on to
+    its image data, so the views stay valid if the segmentation replaces it, but edits in place do reach them.
+    :param preview: check the preview geometry cache
+    :param copySurfaces: copy the surfaces, so that later edits of the segmentation do not reach them
+    :param statisticsMethod: statistics method the teeth will be measured with (see updateToothStatistics)
+    :return: dictionary with "id" (segmentation node ID), "transformKey" (see getTransformKey), "worldTransformKey"
+      (see getWorldTransformKey), "transformToWorld" (4 x 4 matrix, None if the transform is not linear),
+      "layers" (list of dictionaries with the labelmap "image", its (k, j, i) "voxels", "extent", "spacing" and
+      "imageToWorld" matrix for each labelmap layer) and "segments" (dictionary of segment ID to "name", "labelValue", "labelmapMTime",
+      "layer" index or None, "surfaceKey" and world "surface" or None)
+    """
+    import numpy as np
+    from vtk.util import numpy_support
+
+    geometryCache = self.previewGeometryCache if preview else self.toothGeometryCache
+    statisticsMethod = "Lean" if preview else statisticsMethod or self.statisticsMethod
+    segmentationNodeID = segmentationNode.GetID()
+    transformKey = self.getTransformKey(segmentationNode)
+    transformToWorld = np.eye(4)
+    transformModelToWorld = None
+    parentTransformNode = segmentationNode.GetParentTransformNode()
+    if parentTransformNode:
+      transformModelToWorld = vtk.vtkGeneralTransform()
+      slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(parentTransformNode, None, transformModelToWorld)
+      transformToWorld = None
+      if parentTransformNode.IsTransformToWorldLinear():
+        transformMatrix = vtk.vtkMatrix4x4()
+        parentTransformNode.GetMatrixTransformToWorld(transformMatrix)
+        transformToWorld = slicer.util.arrayFromVTKMatrix(transformMatrix)
+
+    segmentationData = {
+      "id": segmentationNodeID,
+      "transformKey": transformKey,
+      "worldTransformKey": self.getWorldTransformKey(segmentationNode),
+      "transformToWorld": transformToWorld,
+      "layers": [],
+      "segments": {},
+      }
+    layerIndices = {}
+    for segmentId in segmentIds:
+      segment = segmentationNode.GetSegmentation().GetSegment(segmentId)
+      labelmap = self.getSegmentLabelmap(segmentationNode, segmentId)
+      labelmapMTime = labelmap.GetMTime() if labelmap else None
+      entry = geometryCache.get((segmentationNodeID, segmentId))
+      measured = (entry and entry["transformKey"] == transformKey and entry["statisticsMethod"] == statisticsMethod
+        and entry["labelmapMTime"] == labelmapMTime)
+      layerIndex = None
+      if not measured and labelmap and labelmap.GetPointData().GetScalars() is not None:
+        if labelmap not in layerIndices:
+          dims = labelmap.GetDimensions()
+          voxels = numpy_support.vtk_to_numpy(labelmap.GetPointData().GetScalars()).reshape(dims[2], dims[1], dims[0])
+          imageToWorld = vtk.vtkMatrix4x4()
+          labelmap.GetImageToWorldMatrix(imageToWorld)
+          layerIndices[labelmap] = len(segmentationData["layers"])
+          segmentationData["layers"].append({
+            "image": labelmap,
+            "voxels": voxels,
+            "extent": labelmap.GetExtent(),
+            "spacing": labelmap.GetSpacing(),
+            "imageToWorld": slicer.util.arrayFromVTKMatrix(imageToWorld),
+            })
+        layerIndex = layerIndices[labelmap]
+
+      surface = self.getSegmentClosedSurface(segmentationNode, segmentId)
+      surfaceKey = (surface.GetMTime() if surface else None, transformKey)
+      cachedSurfaces = self.surfaceCache.get((segmentationNodeID, segmentId))
+      surface_World = None
+      if surface and not (cachedSurfaces and cachedSurfaces["surfaceKey"] == surfaceKey):
+        if transformModelToWorld:
+          polyTransformToWorld = vtk.vtkTransformPolyDataFilter()
+          polyTransformToWorld.SetTransform(transformModelToWorld)
+          polyTransformToWorld.SetInputData(surface)
+          polyTransformToWorld.Update()
+          surface_World = polyTransformToWorld.GetOutput()
+        elif copySurfaces:
+          surface_World = vtk.vtkPolyData()
+          surface_World.DeepCopy(surface)
+        else:
+          surface_World = surface
+
+      segmentationData["segments"][segmentId] = {
+        "name": segment.GetName(),
+        "labelValue": segment.GetLabelValue(),
+        "labelmapMTime": labelmapMTime,
+        "layer": layerIndex,
+        "surfaceKey": surfaceKey,
+        "surface": surface_World,
+        }
+    return segmentationData
+
+  def getSegmentContentHash(self, segmentationData, segmentId):
+    """
+    Hash the voxels of a segment together with the labelmap geometry.
+    Only voxels carrying the segment's label value are hashed, so editing another
+    segment on a shared labelmap layer does not change the hash.
+    The hashes of all segments of a labelmap layer are computed together in one pass (see hashLabelmapLayer).
+    :param segmentationData: segmentation data from getSegmentationData
+    :return: hash, None if the labelmap of the segment is not in segmentationData
+    """
+    segment = segmentationData["segments"][segmentId]
+    if segment["layer"] is None:
+      return None
+    layer = segmentationData["layers"][segment["layer"]]
+    if "contentHashes" not in layer:
+      layer["contentHashes"] = self.hashLabelmapLayer(layer)
+    return layer["contentHashes"].get(segment["labelValue"], layer["contentHashes"][None])
+
+  def hashLabelmapLayer(self, layer):
+    """
+    Hash the voxels of every label of a labelmap layer in one pass: the indices of the non-zero voxels are
+    sorted by label, and each label hashes its own run of indices together with the labelmap geometry.
+    :param layer: labelmap layer of getSegmentationData
+    :return: dictionary of label value to hash, None for labels without voxels
+    """
+    import hashlib
+    import numpy as np
+
+    geometry = (str(layer["extent"]) + str(layer["imageToWorld"][:3].ravel().tolist())).encode()
+
+    def hashIndices(indices):
+      digest = hashlib.blake2b(digest_size=16)
+      digest.update(geometry)
+      digest.update(indices.tobytes())
+      return digest.hexdigest()
+
+    voxels = layer["voxels"].ravel()
+    indices = np.flatnonzero(voxels)
+    labels = voxels[indices]
+    order = np.argsort(labels, kind="stable")  # indices of each label stay in increasing order
+    indices = indices[order].astype(np.int64)
+    labels = labels[order]
+    starts = np.flatnonzero(np.concatenate([[True], labels[1:] != labels[:-1]]))
+    stops = np.append(starts[1:], len(labels))
+    hashes = {int(labels[start]): hashIndices(indices[start:stop]) for start, stop in zip(starts, stops)}
+    hashes[None] = hashIndices(indices[:0])
+    return hashes
+
+  def getTransformKey(self, segmentationNode):
+    """
+    Identify the current parent transform of a segmentation, so that cached world-space points
+    are dropped when the segmentation is moved.
+    """
+    parentTransformNode = segmentationNode.GetParentTransformNode()
+    if not parentTransformNode:
+      return None
+    return (parentTransformNode.GetID(), parentTransformNode.GetMTime())
+
+  def getStatisticsCacheDirectory(self):
+    """
+    Folder where segment statistics are kept between Slicer sessions.
+    """
+    if self.statisticsCacheDirectory:
+      return self.statisticsCacheDirectory
+    return os.path.join(slicer.app.cachePath, "FunctionalHomodonty", "SegmentStatistics")
+
+  def getStatisticsCacheKey(self, contentHash, worldTransformKey, statisticsMethod=None):
+    """
+    Key of the on-disk statistics of a segment: its content hash, its position in the world,
+    the set of enabled measures and the statistics method (default: statisticsMethod).
+    """
+    import hashlib
+    statisticsMethod = statisticsMethod or self.statisticsMethod
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(contentHash).encode())
+    digest.update(str(worldTransformKey).encode())
+    digest.update(";".join(sorted(self.statisticsMeasurements)).encode())
+    digest.update(statisticsMethod.encode())
+    if statisticsMethod == "Lean":
+      digest.update(self.leanSurfaceAreaMethod.encode())
+    return digest.hexdigest()
+
+  def getWorldTransformKey(self, segmentationNode):
+    """
+    Describe the parent transform of a segmentation in a way that is stable across sessions.
+    Returns False if the transform is not linear, in which case statistics are not stored on disk.
+    """
+    parentTransformNode = segmentationNode.GetParentTransformNode()
+    if not parentTransformNode:
+      return None
+    if not parentTransformNode.IsTransformToWorldLinear():
+      return False
+    transformToWorld = vtk.vtkMatrix4x4()
+    parentTransformNode.GetMatrixTransformToWorld(transformToWorld)
+    return [round(transformToWorld.GetElement(i, j), 9) for i in range(3) for j in range(4)]
+
+  def readCachedStatistics(self, cacheKey):
+    """
+    Read the statistics of one segment from the on-disk cache, or None if it is not there.
+    """
+    import json
+    cacheFile = os.path.join(self.getStatisticsCacheDirectory(), cacheKey + ".json")
+    if not os.path.exists(cacheFile):
+      return None
+    try:
+      with open(cacheFile) as f:
+        measurements = json.load(f)
+      # mark the entry as recently used so that eviction by age keeps it
+      os.utime(cacheFile, None)
+    except (OSError, ValueError):
+      return None
+    return measurements
+
+  def writeCachedStatistics(self, cacheKey, measurements):
+    """
+    Write the statistics of one segment to the on-disk cache.
+    """
+    import json
+    cacheDirectory = self.getStatisticsCacheDirectory()
+    try:
+      os.makedirs(cacheDirectory, exist_ok=True)
+      with open(os.path.join(cacheDirectory, cacheKey + ".json"), "w") as f:
+        json.dump(measurements, f)
+    except OSError as e:
+      logging.warning("Failed to write segment statistics cache: " + str(e))
+
+  def evictStatisticsCache(self):
+    """
+    Remove cached statistics older than statisticsCacheMaxAgeDays, then the least recently used
+    entries until the cache is smaller than statisticsCacheMaxSizeMB.
+    """
+    import time
+    cacheDirectory = self.getStatisticsCacheDirectory()
+    if not os.path.isdir(cacheDirectory):
+      return
+    entries = []
+    for fileName in os.listdir(cacheDirectory):
+      if not fileName.endswith(".json"):
+        continue
+      cacheFile = os.path.join(cacheDirectory, fileName)
+      try:
+        fileStat = os.stat(cacheFile)
+      except OSError:
+        continue
+      entries.append((fileStat.st_mtime, fileStat.st_size, cacheFile))
+    entries.sort()
+
+    oldestAllowed = time.time() - self.statisticsCacheMaxAgeDays * 24 * 3600
+    totalSize = sum(entry[1] for entry in entries)
+    maxSize = self.statisticsCacheMaxSizeMB * 1024 * 1024
+    for modifiedTime, size, cacheFile in entries:
+      if modifiedTime >= oldestAllowed and totalSize <= maxSize:
+        break
+      try:
+        os.remove(cacheFile)
+        totalSize -= size
+      except OSError:
+        pass
+
+  def computeSegmentStatistics(self, segmentationData, segmentIds, contentHashes=None, statisticsMethod=None):
+    """
+    Compute the labelmap statistics this module needs (surface area, centroid and oriented bounding box)
+    for the listed segments only.
+    Segments with a known content hash are first looked up in the on-disk statistics cache.
+    :param segmentationData: segmentation data from getSegmentationData
+    :param contentHashes: dictionary of segment ID to content hash (see getSegmentContentHash)
+    :param statisticsMethod: overrides statisticsMethod. "SegmentStatistics" reads the segmentation node
+      from the scene, so it must run on the main thread.
+    """
+    import numpy as np
+
+    statisticsMethod = statisticsMethod or self.statisticsMethod
+    stats = {"SegmentIDs": list(segmentIds)}
+    cacheKeys = {}
+    worldTransformKey = segmentationData["worldTransformKey"]
+    if self.useStatisticsDiskCache and contentHashes and worldTransformKey is not False:
+      for segmentId in segmentIds:
+        if contentHashes.get(segmentId) is not None:
+          cacheKeys[segmentId] = self.getStatisticsCacheKey(contentHashes[segmentId], worldTransformKey, statisticsMethod)
+
+    missingSegmentIds = []
+    for segmentId in segmentIds:
+      measurements = self.readCachedStatistics(cacheKeys[segmentId]) if segmentId in cacheKeys else None
+      if measurements is None:
+        missingSegmentIds.append(segmentId)
+        continue
+      for measurement in self.statisticsMeasurements:
+        stats[segmentId, "LabelmapSegmentStatisticsPlugin." + measurement] = measurements[measurement]
+    logging.info('Segment statistics read from cache for {0} of {1} teeth'.format(
+      len(segmentIds) - len(missingSegmentIds), len(segmentIds)))
+    if not missingSegmentIds:
+      return stats
+
+    if statisticsMethod == "Lean":
+      computedStats = self.computeLeanSegmentStatistics(segmentationData, missingSegmentIds)
+    else:
+      import SegmentStatistics
+      segStatLogic = SegmentStatistics.SegmentStatisticsLogic()
+      segStatLogic.getParameterNode().SetParameter("Segmentation", segmentationData["id"])
+      segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.enabled", str(True))
+      for measurement in self.statisticsMeasurements:
+        segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin." + measurement + ".enabled", str(True))
+      segStatLogic.reset()
+      segStatLogic.getStatistics().setdefault("SegmentIDs", [])
+      for segmentId in missingSegmentIds:
+        segStatLogic.updateStatisticsForSegment(segmentId)
+      computedStats = segStatLogic.getStatistics()
+
+    for segmentId in missingSegmentIds:
+      measurements = {}
+      for measurement in self.statisticsMeasurements:
+        value = computedStats[segmentId, "LabelmapSegmentStatisticsPlugin." + measurement]
+        stats[segmentId, "LabelmapSegmentStatisticsPlugin." + measurement] = value
+        measurements[measurement] = np.asarray(value).tolist()
+      if segmentId in cacheKeys:
+        self.writeCachedStatistics(cacheKeys[segmentId], measurements)
+    if cacheKeys:
+      self.evictStatisticsCache()
+    return stats
+
+  def computeLeanSegmentStatistics(self, segmentationData, segmentIds, downsampling=1):
+    """
+    Compute only surface area, centroid and oriented bounding box of each segment.
+    Each labelmap layer is scanned once for all of its teeth (see measureLabelmapLayer), then every tooth is
+    finished in a worker thread within its own bounding box.
+    The OBB axes are the principal axes of the tooth voxels, ordered so that z is the longest (the tooth axis).
+    Only NumPy arrays of segmentationData are used, no MRML, so this also runs in the worker of a background run.
+    :param segmentationData: segmentation data from getSegmentationData, with the labelmaps of these segments
+    :param downsampling: measure only every downsampling-th voxel along each axis (for previews)
+    :return: statistics in the same format as SegmentStatisticsLogic.getStatistics()
+    """
+    import concurrent.futures
+    import numpy as np
+
+    transformToWorld = segmentationData["transformToWorld"]
+    if transformToWorld is None:
+      logging.warning("Non-linear transform of the segmentation is ignored by the lean statistics")
+      transformToWorld = np.eye(4)
+
+    # workers only get NumPy views of the labelmaps;
+    # teeth sharing a labelmap layer are grouped so that the layer is scanned once
+    layers = {}
+    tasks = []
+    for segmentId in segmentIds:
+      segment = segmentationData["segments"][segmentId]
+      layerIndex = segment["layer"]
+      if layerIndex not in layers:
+        voxels = segmentationData["layers"][layerIndex]["voxels"]
+        extent = segmentationData["layers"][layerIndex]["extent"]
+        ijkToRAS = np.dot(transformToWorld, segmentationData["layers"][layerIndex]["imageToWorld"])
+        extentStart = (extent[0], extent[2], extent[4])
+        if downsampling > 1:
+          # strided view, the voxel indices are scaled back in the IJK to world matrix
+          voxels = voxels[::downsampling, ::downsampling, ::downsampling]
+          ijkToRAS = np.dot(ijkToRAS, np.array([
+            [downsampling, 0, 0, extentStart[0]],
+            [0, downsampling, 0, extentStart[1]],
+            [0, 0, downsampling, extentStart[2]],
+            [0, 0, 0, 1]]))
+          extentStart = (0, 0, 0)
+        layers[layerIndex] = (voxels, [], extentStart, ijkToRAS)
+      layers[layerIndex][1].append(segment["labelValue"])
+      tasks.append((layers[layerIndex], segment["labelValue"]))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.statisticsWorkers or os.cpu_count()) as executor:
+      layerMeasurements = dict(zip([id(layer) for layer in layers.values()], executor.map(
+        lambda layer: self.measureLabelmapLayer(layer[0], layer[1], layer[2], layer[3]), layers.values())))
+      measurements = list(executor.map(lambda task: self.measureToothLabelmap(task[0][0], task[1], task[0][2], task[0][3],
+        layerMeasurements[id(task[0])][task[1]]), tasks))
+
+    stats = {"SegmentIDs": list(segmentIds)}
+    for segmentId, toothMeasurements in zip(segmentIds, measurements):
+      for measurement in self.statisticsMeasurements:
+        stats[segmentId, "LabelmapSegmentStatisticsPlugin." + measurement] = toothMeasurements[measurement]
+    return stats
+
+  def measureLabelmapLayer(self, voxels, labelValues, extentStart, ijkToRAS, maximumSlabVoxels=2**24):
+    """
+    Measure all listed teeth of a (shared) labelmap layer in one pass over its voxels.
+    The array is read in slabs of slices, without copying it, and per-label sums are accumulated with bincount.
+    :param voxels: labelmap voxels as a (k, j, i) array
+    :param labelValues: voxel values of the teeth to measure
+    :param extentStart: IJK index of the first voxel of the array
+    :param ijkToRAS: 4 x 4 IJK to world matrix
+    :param maximumSlabVoxels: number of voxels processed at once, bounds the temporary memory
+    :return: dictionary of label value to dictionary with "count", "bounds" (first and last k, j, i array index),
+      "centroid" and "covariance" (RAS) and "boundaryFaceArea" (mm^2)
+    """
+    import numpy as np
+
+    labelValues = [int(labelValue) for labelValue in labelValues]
+    numberOfLabels = len(labelValues)
+    dimK, dimJ, dimI = voxels.shape
+    maxLabel = max(labelValues)
+    labelIndexLookup = np.full(maxLabel + 2, -1, dtype=np.int32)  # last entry: voxels outside 0..maxLabel
+    labelIndexLookup[labelValues] = np.arange(numberOfLabels, dtype=np.int32)
+
+    def labelIndices(slab):
+      return labelIndexLookup[np.where((slab >= 0) & (slab <= maxLabel), slab, maxLabel + 1)]
+
+    # coordinates are shifted to the volume center to limit round-off in the second moments
+    center = 0.5 * np.array([dimK - 1, dimJ - 1, dimI - 1])
+    counts = np.zeros(numberOfLabels)
+    sums = np.zeros((3, numberOfLabels))
+    products = np.zeros((3, 3, numberOfLabels))
+    faces = np.zeros((3, numberOfLabels))
+    presence = [np.zeros((numberOfLabels, dim), dtype=bool) for dim in (dimK, dimJ, dimI)]
+
+    def countFaces(labels):
+      return np.bincount(labels[labels >= 0], minlength=numberOfLabels)
+
+    slabSize = max(1, maximumSlabVoxels // (dimJ * dimI))
+    previousSlice = None
+    for slabStart in range(0, dimK, slabSize):
+      labels = labelIndices(voxels[slabStart:slabStart + slabSize])
+      flatIndices = np.flatnonzero(labels >= 0)
+      slabLabels = labels.ravel()[flatIndices]
+      k, j, i = np.unravel_index(flatIndices, labels.shape)
+      coordinates = [k + slabStart - center[0], j - center[1], i - center[2]]
+      counts += np.bincount(slabLabels, minlength=numberOfLabels)
+      for axis in range(3):
+        sums[axis] += np.bincount(slabLabels, weights=coordinates[axis], minlength=numberOfLabels)
+        for otherAxis in range(axis, 3):
+          products[axis, otherAxis] += np.bincount(slabLabels, weights=coordinates[axis] * coordinates[otherAxis], minlength=numberOfLabels)
+      for axis, (indices, dim) in enumerate(zip((k + slabStart, j, i), (dimK, dimJ, dimI))):
+        presence[axis] |= np.bincount(slabLabels * dim + indices, minlength=numberOfLabels * dim).reshape(numberOfLabels, dim) > 0
+
+      # boundary faces: between neighbor voxels of different labels and on the volume border
+      for axis in (1, 2):
+        lower = labels[:, :-1] if axis == 1 else labels[:, :, :-1]
+        upper = labels[:, 1:] if axis == 1 else labels[:, :, 1:]
+        different = lower != upper
+        first = labels[:, :1] if axis == 1 else labels[:, :, :1]
+        last = labels[:, -1:] if axis == 1 else labels[:, :, -1:]
+        faces[axis] += countFaces(lower[different]) + countFaces(upper[different]) + countFaces(first) + countFaces(last)
+      lower = labels[:-1] if previousSlice is None else np.concatenate([previousSlice, labels[:-1]])
+      upper = labels[1:] if previousSlice is None else labels
+      different = lower != upper
+      faces[0] += countFaces(lower[different]) + countFaces(upper[different])
+      if previousSlice is None:
+        faces[0] += countFaces(labels[:1])
+      previousSlice = labels[-1:].copy()
+    if previousSlice is not None:
+      faces[0] += countFaces(previousSlice)
+
+    # moments in the shifted IJK frame to RAS
+    directions = ijkToRAS[:3, :3][:, [2, 1, 0]]  # columns for k, j, i
+    faceAreas = np.array([np.linalg.norm(np.cross(directions[:, 1], directions[:, 2])),
+      np.linalg.norm(np.cross(directions[:, 0], directions[:, 2])),
+      np.linalg.norm(np.cross(directions[:, 0], directions[:, 1]))])
+    origin = np.dot(ijkToRAS, [extentStart[0] + center[2], extentStart[1] + center[1], extentStart[2] + center[0], 1.0])[:3]
+    measurements = {}
+    for labelIndex, labelValue in enumerate(labelValues):
+      count = counts[labelIndex]
+      if count == 0:
+        measurements[labelValue] = {"count": 0}
+        continue
+      mean = sums[:, labelIndex] / count
+      secondMoments = products[:, :, labelIndex]
+      secondMoments = np.triu(secondMoments) + np.triu(secondMoments, 1).T
+      covariance = (secondMoments - count * np.outer(mean, mean)) / max(count - 1, 1)
+      bounds = []
+      for axisPresence in presence:
+        present = np.flatnonzero(axisPresence[labelIndex])
+        bounds.append((present[0], present[-1]))
+      measurements[labelValue] = {
+        "count": int(count),
+        "bounds": bounds,
+        "centroid": origin + np.dot(directions, mean),
+        "covariance": np.dot(directions, np.dot(covariance, directions.T)),
+        "boundaryFaceArea": float(np.dot(faces[:, labelIndex], faceAreas)),
+        }
+    return measurements
+
+  def measureToothLabelmap(self, voxels, labelValue, extentStart, ijkToRAS, layerMeasurement=None):
+    """
+    Measure one tooth in its labelmap. Runs in a worker thread, so it only uses NumPy and VTK filters, no MRML.
+    :param voxels: labelmap voxels as a (k, j, i) array
+    :param labelValue: voxel value of the tooth (the labelmap may be shared with other teeth)
+    :param extentStart: IJK index of the first voxel of the array
+    :param ijkToRAS: 4 x 4 IJK to world matrix
+    :param layerMeasurement: measurements of this tooth from measureLabelmapLayer; if given, only the tooth's
+      bounding box is read instead of the whole labelmap
+    :return: dictionary of measurement name to value, as in statisticsMeasurements
+    """
+    import numpy as np
+
+    if layerMeasurement is not None:
+      if layerMeasurement["count"] == 0:
+        kIndices = []
+      else:
+        kIndices, jIndices, iIndices = layerMeasurement["bounds"]
+    else:
+      mask = voxels == labelValue
+      kIndices = np.flatnonzero(mask.any(axis=(1, 2)))
+    if len(kIndices) == 0:
+      return {"surface_area_mm2": 0.0, "centroid_ras": [0.0, 0.0, 0.0], "obb_origin_ras": [0.0, 0.0, 0.0],
+        "obb_diameter_mm": [0.0, 0.0, 0.0], "obb_direction_ras_x": [1.0, 0.0, 0.0],
+        "obb_direction_ras_y": [0.0, 1.0, 0.0], "obb_direction_ras_z": [0.0, 0.0, 1.0]}
+    if layerMeasurement is not None:
+      mask = voxels[kIndices[0]:kIndices[-1]+1, jIndices[0]:jIndices[-1]+1, iIndices[0]:iIndices[-1]+1] == labelValue
+    else:
+      jIndices = np.flatnonzero(mask.any(axis=(0, 2)))
+      iIndices = np.flatnonzero(mask.any(axis=(0, 1)))
+      # crop to the tooth
+      mask = mask[kIndices[0]:kIndices[-1]+1, jIndices[0]:jIndices[-1]+1, iIndices[0]:iIndices[-1]+1]
+    k, j, i = np.nonzero(mask)
+    ijk = np.column_stack([
+      i + iIndices[0] + extentStart[0],
+      j + jIndices[0] + extentStart[1],
+      k + kIndices[0] + extentStart[2],
+      np.ones(len(i))])
+    pointsRAS = np.dot(ijk, ijkToRAS.T)[:, :3]
+    if layerMeasurement is not None:
+      centroid = layerMeasurement["centroid"]
+      covariance = layerMeasurement["covariance"]
+    else:
+      centroid = pointsRAS.mean(axis=0)
+      covariance = np.cov((pointsRAS - centroid).T)
+
+    # oriented bounding box along the principal axes, including the voxels' own size
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    projected = np.dot(pointsRAS - centroid, eigenvectors)
+    voxelHalfSize = 0.5 * np.abs(np.dot(eigenvectors.T, ijkToRAS[:3, :3])).sum(axis=1)
+    low = projected.min(axis=0) - voxelHalfSize
+    high = projected.max(axis=0) + voxelHalfSize
+
+    if layerMeasurement is not None and self.leanSurfaceAreaMethod == "BoundaryFaces":
+      surfaceArea = layerMeasurement["boundaryFaceArea"]
+    else:
+      surfaceArea = self.computeDiscreteSurfaceArea(mask, ijkToRAS)
+
+    return {
+      "surface_area_mm2": surfaceArea,
+      "centroid_ras": np.asarray(centroid).tolist(),
+      "obb_origin_ras": (centroid + np.dot(eigenvectors, low)).tolist(),
+      "obb_diameter_mm": (high - low).tolist(),
+      "obb_direction_ras_x": eigenvectors[:, 0].tolist(),
+      "obb_direction_ras_y": eigenvectors[:, 1].tolist(),
+      "obb_direction_ras_z": eigenvectors[:, 2].tolist(),
+      }
+
+  def computeDiscreteSurfaceArea(self, mask, ijkToRAS):
+    """
+    Surface area of the discrete isosurface of a binary (k, j, i) mask, as the Segment Statistics labelmap plugin measures it.
+    """
+    import numpy as np
+    from vtk.util import numpy_support
+
+    padded = np.pad(mask, 1).astype(np.uint8)
+    image = vtk.vtkImageData()
+    image.SetDimensions(padded.shape[2], padded.shape[1], padded.shape[0])
+    image.SetSpacing(np.linalg.norm(ijkToRAS[:3, :3], axis=0))
+    image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(padded.ravel(), deep=0, array_type=vtk.VTK_UNSIGNED_CHAR))
+    surfaceFilter = vtk.vtkDiscreteFlyingEdges3D()
+    surfaceFilter.SetInputData(image)
+    surfaceFilter.SetValue(0, 1)
+    surfaceFilter.ComputeNormalsOff()
+    surfaceFilter.Update()
+    massProperties = vtk.vtkMassProperties()
+    massProperties.SetInputData(surfaceFilter.GetOutput())
+    massProperties.Update()
+    return massProperties.GetSurfaceArea()
+
+  def computeBaseAndTipPoints(self, segmentationData, segmentId, geometry, jawID, maximumError=None, jawLandmarks=None):
+    """
+    Find the base and tip of one tooth: the ends of its oriented bounding box, snapped onto the tooth surface,
+    or with baseTipMethod "PrincipalAxis" the extreme surface points along its principal axis
+    (see computePrincipalAxisBaseAndTipPoints).
+    :param segmentationData: segmentation data from getSegmentationData
+    :param geometry: geometry cache entry of the tooth (see updateToothStatistics)
+    :param jawID: "Lower Jaw" or "Upper Jaw", decides which end of the OBB is the base
+    :param maximumError: snap onto the tooth surface decimated within this distance (mm)
+    :param jawLandmarks: jaw joint, tip of jaw and muscle insertion (RAS), used by the principal axis method
+    :return: base and tip points (RAS)
+    """
+    if self.baseTipMethod == "PrincipalAxis":
+      return self.computePrincipalAxisBaseAndTipPoints(segmentationData, segmentId, geometry, jawID, maximumError, jawLandmarks)
+
+    # get tooth position at the base of the tooth
+    obb_origin_ras = geometry["obbOrigin"]
+    obb_diameter_mm = geometry["obbDiameter"]
+    obb_direction_ras_x, obb_direction_ras_y, obb_direction_ras_z = geometry["obbDirections"]
+    if jawID == "Lower Jaw":
+      baseCandidateRAS = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*-2.2 * obb_direction_ras_z)
+      if (obb_direction_ras_z[0] > 0 and obb_direction_ras_z[1] > 0 and obb_direction_ras_z[2] < 0):
+        baseCandidateRAS = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*2.2 * obb_direction_ras_z)
+      if (obb_direction_ras_z[1] < 0):
+        baseCandidateRAS = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*2.2 * obb_direction_ras_z)
+      if (obb_direction_ras_z[0] < 0 and obb_direction_ras_z[1] < 0):
+        baseCandidateRAS = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*-2.2 * obb_direction_ras_z)
+      if all(obb_direction_ras_z < 0):
+        baseCandidateRAS = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*2.2 * obb_direction_ras_z)
+    if jawID == "Upper Jaw":
+      baseCandidateRAS = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*2.2 * obb_direction_ras_z)
+      if (obb_direction_ras_z[0] > 0 and obb_direction_ras_z[1] > 0 and obb_direction_ras_z[2] < 0):
+        baseCandidateRAS = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*-2.2 * obb_direction_ras_z)
+      if (obb_direction_ras_z[1] < 0):
+        baseCandidateRAS = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*-2.2 * obb_direction_ras_z)
+      if (obb_direction_ras_z[0] < 0 and obb_direction_ras_z[1] < 0):
+        baseCandidateRAS = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*2.2 * obb_direction_ras_z)
+      if all(obb_direction_ras_z < 0):
+        baseCandidateRAS = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*-2.2 * obb_direction_ras_z)
+
+    # try to find the tip of the tooth
+    if jawID == "Lower Jaw":
+      tipCandidateRAS = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*2.2 * obb_direction_ras_z)
+      if (obb_direction_ras_z[0] > 0 and obb_direction_ras_z[1] > 0 and obb_direction_ras_z[2] < 0):
+        tipCandidateRAS = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*-2.2 * obb_direction_ras_z)
+      if (obb_direction_ras_z[1] < 0):
+        tipCandidateRAS = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*-2.2 * obb_direction_ras_z)
+      if (obb_direction_ras_z[0] < 0 and obb_direction_ras_z[1] < 0):
+        tipCandidateRAS = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*2.2 * obb_direction_ras_z)
+      if all(obb_direction_ras_z < 0):
+        tipCandidateRAS = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*-2.2 * obb_direction_ras_z)
+    if jawID == "Upper Jaw":
+      tipCandidateRAS = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*-2.2 * obb_direction_ras_z)
+      if (obb_direction_ras_z[0] > 0 and obb_direction_ras_z[1] > 0 and obb_direction_ras_z[2] < 0):
+        tipCandidateRAS = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*2.2 * obb_direction_ras_z)
+      if (obb_direction_ras_z[1] < 0):
+        tipCandidateRAS = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*2.2 * obb_direction_ras_z)
+      if (obb_direction_ras_z[0] < 0 and obb_direction_ras_z[1] < 0):
+        tipCandidateRAS = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*-2.2 * obb_direction_ras_z)
+      if all(obb_direction_ras_z < 0):
+        tipCandidateRAS = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*2.2 * obb_direction_ras_z)
+
+    # snap both candidate points onto the tooth surface with one locator
+    surface_World, locator = self.getToothSurfaceLocator(segmentationData, segmentId, maximumError)
+    basePointRAS, tipPointRAS = self.findClosestSurfacePoints(locator, [baseCandidateRAS, tipCandidateRAS])
+    return basePointRAS, tipPointRAS
+
+  def computePrincipalAxisBaseAndTipPoints(self, segmentationData, segmentId, geometry, jawID, maximumError=None, jawLandmarks=None):
+    """
+    Find the base and tip of one tooth as the surface points with the smallest and largest projection onto
+    the principal axis of the tooth (the OBB axis with the largest diameter), in one vectorized pass over
+    the surface points. Both are surface points, so no closest-point search is needed, and the result does not
+    depend on the sign conventions of the OBB directions.
+    Teeth stand on the jaw, so the axis is pointed away from the jaw line (jaw joint to tip of jaw), along the
+    perpendicular from the line to the tooth centroid: the near end is the base and the far end the tip, however
+    the specimen lies in the scanner. Without landmarks, or for a tooth centered on the jaw line, the axis is
+    pointed superior in the lower jaw and inferior in the upper jaw.
+    :param geometry: geometry cache entry of the tooth (see updateToothStatistics)
+    :param jawID: "Lower Jaw" or "Upper Jaw"
+    :param maximumError: use the tooth surface decimated within this distance (mm)
+    :param jawLandmarks: jaw joint, tip of jaw and muscle insertion (RAS); only the jaw line is used
+    :return: base and tip points (RAS)
+    """
+    import numpy as np
+    from vtk.util import numpy_support
+
+    axis = geometry["obbDirections"][np.argmax(geometry["obbDiameter"])]
+    awayFromJawLine = None
+    if jawLandmarks is not None:
+      jointRAS, jawtipRAS = np.asarray(jawLandmarks[0], dtype=float), np.asarray(jawLandmarks[1], dtype=float)
+      jawDirection = jawtipRAS - jointRAS
+      perpendicular = geometry["centroid"] - jointRAS
+      if np.dot(jawDirection, jawDirection) > 0:
+        perpendicular = perpendicular - np.dot(perpendicular, jawDirection) / np.dot(jawDirection, jawDirection) * jawDirection
+      if np.linalg.norm(perpendicular) > 1e-6 * max(np.linalg.norm(jawDirection), 1.0):
+        awayFromJawLine = perpendicular
+    if awayFromJawLine is None:
+      awayFromJawLine = np.array([0.0, 0.0, 1.0 if jawID == "Lower Jaw" else -1.0])
+    if np.dot(axis, awayFromJawLine) < 0:
+      axis = -axis
+    surface_World = self.getToothSurface(segmentationData, segmentId, maximumError)
+    points = numpy_support.vtk_to_numpy(surface_World.GetPoints().GetData())
+    projection = points @ axis
+    basePointRAS = points[np.argmin(projection)].astype(float)
+    tipPointRAS = points[np.argmax(projection)].astype(float)
+    return basePointRAS, tipPointRAS
+
+  def updateToothStatistics(self, segmentationData, segmentIds, preview=False, statisticsMethod=None):
+    """
+    Make sure the geometry cache holds surface area and oriented bounding box of each tooth,
+    recomputing only teeth whose voxels changed since they were last computed.
+    A segment is considered unchanged if it was measured with the same statistics method (their areas and OBB axis
+    orders differ) and its labelmap modified time is the same, or else its content hash is the same.
+    All changed segments of the segmentation go through a single statistics pass.
+    :param segmentationData: segmentation data from getSegmentationData
+    :param preview: use the preview cache, filled from downsampled labelmaps. The area error is estimated from
+      the difference to the next coarser level, the position error bounded by the downsampled voxel diagonal
+      plus the surface decimation tolerance.
+    :param statisticsMethod: overrides statisticsMethod (see computeSegmentStatistics). Preview is always lean.
+    :return: list of geometry cache entries, in the order of segmentIds
+    """
+    import numpy as np
+
+    geometryCache = self.previewGeometryCache if preview else self.toothGeometryCache
+    statisticsMethod = "Lean" if preview else statisticsMethod or self.statisticsMethod
+    segmentationNodeID = segmentationData["id"]
+    transformKey = segmentationData["transformKey"]
+
+    staleSegmentIds = []
+    contentHashes = {}
+    for segmentId in segmentIds:
+      labelmapMTime = segmentationData["segments"][segmentId]["labelmapMTime"]
+      entry = geometryCache.get((segmentationNodeID, segmentId))
+      if entry and entry["transformKey"] == transformKey and entry["statisticsMethod"] == statisticsMethod:
+        if entry["labelmapMTime"] == labelmapMTime:
+          continue
+        contentHashes[segmentId] = self.getSegmentContentHash(segmentationData, segmentId)
+        if contentHashes[segmentId] is not None and entry["contentHash"] == contentHashes[segmentId]:
+          entry["labelmapMTime"] = labelmapMTime
+          continue
+      staleSegmentIds.append(segmentId)
+
+    logging.info('Recomputing geometry of {0} of {1} teeth'.format(len(staleSegmentIds), len(segmentIds)))
+    if staleSegmentIds:
+      for segmentId in staleSegmentIds:
+        if segmentId not in contentHashes:
+          contentHashes[segmentId] = self.getSegmentContentHash(segmentationData, segmentId)
+      if preview:
+        stats = self.computeLeanSegmentStatistics(segmentationData, staleSegmentIds, self.previewDownsampling)
+        coarseStats = self.computeLeanSegmentStatistics(segmentationData, staleSegmentIds, 2 * self.previewDownsampling)
+      else:
+        stats = self.computeSegmentStatistics(segmentationData, staleSegmentIds, contentHashes, statisticsMethod)
+      for segmentId in staleSegmentIds:
+        segment = segmentationData["segments"][segmentId]
+        geometryCache[(segmentationNodeID, segmentId)] = {
+          # measure surface area
+          "area": stats[segmentId,"LabelmapSegmentStatisticsPlugin.surface_area_mm2"]/2,
+          "centroid": np.array(stats[segmentId,"LabelmapSegmentStatisticsPlugin.centroid_ras"]),
+          "obbOrigin": np.array(stats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_origin_ras"]),
+          "obbDiameter": np.array(stats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_diameter_mm"]),
+          "obbDirections": np.array([
+            stats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_direction_ras_x"],
+            stats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_direction_ras_y"],
+            stats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_direction_ras_z"]]),
+          # base and tip points, keyed by jaw ID, surface decimation error and base/tip method
+          "points": {},
+          "labelmapMTime": segment["labelmapMTime"],
+          "contentHash": contentHashes[segmentId],
+          "transformKey": transformKey,
+          "statisticsMethod": statisticsMethod,
+          }
+        if preview:
+          # first-order convergence: the error at one level is about the change to the next coarser level
+          coarseArea = coarseStats[segmentId,"LabelmapSegmentStatisticsPlugin.surface_area_mm2"]/2
+          voxelSize = self.previewDownsampling * np.array(segmentationData["layers"][segment["layer"]]["spacing"])
+          entry = geometryCache[(segmentationNodeID, segmentId)]
+          entry["areaError"] = abs(entry["area"] - coarseArea)
+          entry["surfaceError"] = voxelSize.max()
+          entry["positionError"] = np.linalg.norm(voxelSize) + entry["surfaceError"]
+
+    return [geometryCache[(segmentationNodeID, segmentId)] for segmentId in segmentIds]
+
+  def updateToothGeometry(self, segmentationData, segmentIds, jawID, preview=False, statisticsMethod=None, jawLandmarks=None):
+    """
+    Get surface area, OBB size and base/tip points of each tooth, from the geometry cache where possible.
+    :param segmentationData: segmentation data from getSegmentationData
+    :param jawID: "Lower Jaw" or "Upper Jaw", decides which end of the OBB is the base
+    :param jawLandmarks: jaw joint, tip of jaw and muscle insertion (RAS), which orient the principal axis
+      (see computePrincipalAxisBaseAndTipPoints)
+    :param preview: use downsampled labelmaps and decimated surfaces (see updateToothStatistics)
+    :param statisticsMethod: overrides statisticsMethod (see updateToothStatistics)
+    :return: list of geometry dictionaries with "area", "obbDiameter", "basePoint", "tipPoint", "positionError"
+      (surface decimation error for full resolution) and "areaError" (0 for full resolution), in the order of segmentIds
+    """
+    import numpy as np
+
+    toothGeometry = []
+    for segmentId, entry in zip(segmentIds, self.updateToothStatistics(segmentationData, segmentIds, preview, statisticsMethod)):
+      maximumError = max(entry.get("surfaceError", 0.0), self.surfaceDecimationError or 0.0) or None
+      pointsKey = (jawID, maximumError, self.baseTipMethod)
+      if self.baseTipMethod == "PrincipalAxis" and jawLandmarks is not None:
+        # the principal axis is oriented by the jaw line
+        pointsKey += tuple(np.concatenate(jawLandmarks[:2]))
+      if pointsKey not in entry["points"]:
+        with self.measurePhase("base/tip points", segmentationData["segments"][segmentId]["name"]):
+          entry["points"][pointsKey] = self.computeBaseAndTipPoints(segmentationData, segmentId, entry, jawID, maximumError, jawLandmarks)
+      basePointRAS, tipPointRAS = entry["points"][pointsKey]
+      toothGeometry.append({
+        "area": entry["area"],
+        "obbDiameter": entry["obbDiameter"],
+        "basePoint": basePointRAS,
+        "tipPoint": tipPointRAS,
+        "positionError": entry.get("positionError", maximumError or 0.0),
+        "areaError": entry.get("areaError", 0.0),
+        })
+    return toothGeometry
+
+  def orientBaseAndTipPoints(self, basePoints, tipPoints, jointRAS, jawtipRAS, inleverRAS, jawID):
+    """
+    Swap base and tip of the teeth whose tip is closer to the jaw line than their base.
+    In the lower jaw distances are measured from the line through the jaw joint, in the upper jaw
+    from the line through the muscle insertion.
+    :param basePoints: N x 3 array of tooth base points
+    :param tipPoints: N x 3 array of tooth tip points
+    :return: oriented copies of basePoints and tipPoints
+    """
+    import numpy as np
+
+    basePoints = np.array(basePoints, dtype=float).reshape(-1, 3)
+    tipPoints = np.array(tipPoints, dtype=float).reshape(-1, 3)
+    jointRAS = np.array(jointRAS, dtype=float)
+    inleverRAS = np.array(inleverRAS, dtype=float)
+    jawvec = jointRAS - np.array(jawtipRAS, dtype=float)
+
+    if jawID == "Lower Jaw":
+      t = np.dot(basePoints - jointRAS, jawvec)[:, np.newaxis] / jawvec**2
+      jawvecpoints = jointRAS + t*jawvec
+      swap = np.linalg.norm(basePoints - jawvecpoints, axis=1) > np.linalg.norm(tipPoints - jawvecpoints, axis=1)
+      basePoints[swap], tipPoints[swap] = tipPoints[swap], basePoints[swap]
+
+    if jawID == "Upper Jaw":
+      t = np.dot(basePoints - inleverRAS, jawvec)[:, np.newaxis] / jawvec**2
+      jawvecpoints = inleverRAS + t*jawvec
+      swap = np.linalg.norm(basePoints - jawvecpoints, axis=1) < np.linalg.norm(tipPoints - jawvecpoints, axis=1)
+      basePoints[swap], tipPoints[swap] = tipPoints[swap], basePoints[swap]
+
+    return basePoints, tipPoints
+
+  def computeToothMechanics(self, basePoints, tipPoints, positionStartPoints, obbDiameters, areas, jointRAS, jawtipRAS, inleverRAS, force):
+    """
+    Compute position, out-lever, height, width, aspect ratio, mechanical advantage, tooth force and stress
+    of all teeth in one vectorized pass.
+    :param basePoints: N x 3 array of tooth base points (end of the tooth position lines)
+    :param tipPoints: N x 3 array of tooth tip points (end of the out-lever lines)
+    :param positionStartPoints: N x 3 array of start points of the tooth position lines
+    :param obbDiameters: N x 3 array of oriented bounding box sizes (mm)
+    :param areas: surface area of each tooth (mm^2)
+    :param jointRAS: jaw joint, or N x 3 array of the jaw joint of each tooth (same for jawtipRAS and inleverRAS)
     :param force: amount of force exerted by the muscles acting on the jaw
-    :param tableNode: table to show results
+    :return: dictionary of per-tooth arrays (and the jaw and in-lever lengths, scalar for a single jaw)
     """
+    import numpy as np
 
+    basePoints = np.asarray(basePoints, dtype=float).reshape(-1, 3)
+    tipPoints = np.asarray(tipPoints, dtype=float).reshape(-1, 3)
+    obbDiameters = np.asarray(obbDiameters, dtype=float).reshape(-1, 3)
+    areas = np.asarray(areas, dtype=float)
+    jointRAS = np.array(jointRAS, dtype=float)
+
+    jawLength = np.linalg.norm(jointRAS - np.array(jawtipRAS, dtype=float), axis=-1)
+    inLever = np.linalg.norm(jointRAS - np.array(inleverRAS, dtype=float), axis=-1)
+    position = np.linalg.norm(basePoints - np.asarray(positionStartPoints, dtype=float), axis=1)
+    outLever = np.linalg.norm(tipPoints - jointRAS, axis=1)
+    height = np.linalg.norm(tipPoints - basePoints, axis=1)
+    width = np.maximum(obbDiameters[:, 0], obbDiameters[:, 1])
+    mechanicalAdvantage = inLever / outLever
+    toothForce, stress = self.computeToothForces(mechanicalAdvantage, areas, force)
+
+    return {
+      "jawLength": jawLength,
+      "inLever": inLever,
+      "area": areas,
+      "position": position,
+      "relativePosition": position / jawLength,
+      "outLever": outLever,
+      "height": height,
+      "width": width,
+      "aspectRatio": height / width,
+      "mechanicalAdvantage": mechanicalAdvantage,
+      "toothForce": toothForce,
+      "stress": stress,
+      }
+
+  def computeToothForces(self, mechanicalAdvantage, areas, force):
+    """
+    Compute tooth force (muscle force * mechanical advantage) and stress (tooth force / surface area) of all teeth.
+    Both are linear in the muscle force, so a vector of forces is swept in one vectorized operation.
+    :param mechanicalAdvantage: mechanical advantage of each tooth
+    :param areas: surface area of each tooth (mm^2)
+    :param force: muscle force, or vector of muscle forces
+    :return: tooth forces and stresses, arrays of N teeth, or N teeth x number of forces for a vector of forces
+    """
     import numpy as np
 
-    logging.info('Processing started')
+    mechanicalAdvantage = np.asarray(mechanicalAdvantage, dtype=float)
+    areas = np.asarray(areas, dtype=float)
+    toothForce = np.multiply.outer(mechanicalAdvantage, force)
+    stress = toothForce / (areas * 1e-6).reshape(areas.shape + (1,) * np.ndim(force))
+    return toothForce, stress
 
-    if not segmentationNode:
-      raise ValueError("Segmentation node is invalid")
-    
-    # Get visible segment ID list.
-    # Get segment ID list
-    visibleSegmentIds = vtk.vtkStringArray()
-    segmentationNode.GetDisplayNode().GetVisibleSegmentIDs(visibleSegmentIds)
-    if visibleSegmentIds.GetNumberOfValues() == 0:
-      raise ValueError("SliceAreaPlot will not return any results: there are no visible segments")
-    
-              
-    # Make a table and set the first column as the slice number. 
+  def sweepResultsForces(self, tableNode, forces):
+    """
+    Stress of every tooth of a results table for each of several muscle forces, e.g. for a sensitivity analysis
+    across bite force estimates. Uses the mechanical advantage and surface area columns, no geometry is recomputed.
+    :param forces: vector of muscle forces
+    :return: tooth forces and stresses, arrays of table rows x forces
+    """
+    results = self.readResultsTable(tableNode, [column for column in self.resultColumns
+      if column[0] in ("Mechanical Advantage", "Surface Area (mm^2)")])
+    return self.computeToothForces(results["Mechanical Advantage"], results["Surface Area (mm^2)"], forces)
+
+  def updateResultsForce(self, tableNode, force):
+    """
+    Update the tooth force and stress columns of a results table in place for a new muscle force,
+    from the mechanical advantage and surface area already in the table.
+    """
+    import numpy as np
+
+    table = tableNode.GetTable()
+    if table.GetNumberOfRows() == 0 or table.GetColumnByName("Mechanical Advantage") is None:
+      return
+    toothForce, stress = self.sweepResultsForces(tableNode, force)
+    self.updateResultsTableRows(tableNode, np.arange(table.GetNumberOfRows()), {
+      "F-Tooth (N)": toothForce,
+      "Stress (N/m^2)": stress,
+      })
+
+  def readResultsTable(self, tableNode, columns=None):
+    """
+    Read the result columns of a table as lists (text columns) and NumPy arrays (numeric columns).
+    Columns missing from the table are filled with "NA" or NaN.
+    :param columns: columns to read, as in resultColumns (default: resultColumns)
+    """
+    import numpy as np
+    from vtk.util import numpy_support
+
+    table = tableNode.GetTable()
+    numberOfRows = table.GetNumberOfRows()
+    results = {}
+    for name, description, unit, isText in columns or self.resultColumns:
+      column = table.GetColumnByName(name)
+      if column is None:
+        results[name] = ["NA"] * numberOfRows if isText else np.full(numberOfRows, np.nan)
+      elif isText:
+        results[name] = [column.GetValue(i) for i in range(numberOfRows)]
+      elif column.IsNumeric():
+        results[name] = numpy_support.vtk_to_numpy(column).astype(float)
+      else:
+        results[name] = np.array([column.GetValue(i) for i in range(numberOfRows)], dtype=float)
+    return results
+
+  def writeResultsTable(self, tableNode, results, appendResults=False, columns=None):
+    """
+    Write result columns to a table. Numeric columns are passed to VTK from NumPy without copying.
+    :param results: dictionary of column name to per-tooth values (see resultColumns)
+    :param appendResults: keep the rows already in the table, except the rows of the jaws (species, jaw and side)
+      that are written now, which are replaced
+    :param columns: columns to write, as in resultColumns (default: resultColumns)
+    """
+    import numpy as np
+    from vtk.util import numpy_support
+
+    columns = columns or self.resultColumns
+    if appendResults and tableNode.GetTable().GetNumberOfRows() > 0:
+      previousResults = self.readResultsTable(tableNode, columns)
+      newJawKeys = set(zip(*[results[name] for name in self.resultKeyColumns]))
+      keepRows = np.array([key not in newJawKeys for key in zip(*[previousResults[name] for name in self.resultKeyColumns])], dtype=bool)
+      for name, description, unit, isText in columns:
+        if isText:
+          results[name] = [value for value, keep in zip(previousResults[name], keepRows) if keep] + list(results[name])
+        else:
+          results[name] = np.concatenate([previousResults[name][keepRows], np.asarray(results[name], dtype=float)])
+
+    wasModified = tableNode.StartModify()  # Add all columns in a single batch
     tableNode.RemoveAllColumns()
+    for name, description, unit, isText in columns:
+      if isText:
+        values = results[name]
+        column = vtk.vtkStringArray()
+        column.SetNumberOfValues(len(values))
+        for i, value in enumerate(values):
+          column.SetValue(i, str(value))
+      else:
+        column = numpy_support.numpy_to_vtk(np.ascontiguousarray(results[name], dtype=np.float32), deep=0, array_type=vtk.VTK_FLOAT)
+      column.SetName(name)
+      tableNode.AddColumn(column)
+      tableNode.SetColumnDescription(name, description)
+      if unit:
+        tableNode.SetColumnUnitLabel(name, unit)  # TODO: use length unit
+    tableNode.EndModify(wasModified)
+
+  def findResultsTableRows(self, tableNode, toothKeys):
+    """
+    Find the rows of teeth in a results table.
+    :param toothKeys: list of (species, jaw ID, side of face, tooth ID) tuples
+    :return: array of row indices, -1 for teeth not in the table
+    """
+    import numpy as np
+
+    keyColumns = [column for column in self.resultColumns if column[0] in self.resultKeyColumns + ["Tooth ID"]]
+    keyColumns.sort(key=lambda column: (self.resultKeyColumns + ["Tooth ID"]).index(column[0]))
+    tableResults = self.readResultsTable(tableNode, keyColumns)
+    rowsByKey = {key: row for row, key in enumerate(zip(*[tableResults[column[0]] for column in keyColumns]))}
+    return np.array([rowsByKey.get(tuple(key), -1) for key in toothKeys], dtype=int)
+
+  def updateResultsTableRows(self, tableNode, rows, results):
+    """
+    Overwrite values of some rows of numeric result columns in place, without rebuilding the table.
+    :param rows: array of row indices
+    :param results: dictionary of column name to the new values of these rows
+    """
+    import numpy as np
+    from vtk.util import numpy_support
+
     table = tableNode.GetTable()
-    
-    SpeciesArray = vtk.vtkStringArray()
-    SpeciesArray.SetName("Species")
-    
-    JawIDArray = vtk.vtkStringArray()
-    JawIDArray.SetName("Jaw ID")
-    
-    SideArray = vtk.vtkStringArray()
-    SideArray.SetName("Side of Face")
-    
-    SegmentNameArray = vtk.vtkStringArray()
-    SegmentNameArray.SetName("Tooth ID")
-    
-    JawLengthArray = vtk.vtkFloatArray()
-    JawLengthArray.SetName("Jaw Length (mm)")  
-   
-    RelPosArray = vtk.vtkFloatArray()
-    RelPosArray.SetName("Rel Position")   
-   
-    PositionArray = vtk.vtkFloatArray()
-    PositionArray.SetName("Position (mm)")
-    
-    ToothHeightArray = vtk.vtkFloatArray()
-    ToothHeightArray.SetName("Tooth Height (mm)")
-    
-    ToothWidthArray = vtk.vtkFloatArray()
-    ToothWidthArray.SetName("Tooth Width (mm)")
-    
-    AspectRatioArray = vtk.vtkFloatArray()
-    AspectRatioArray.SetName("Aspect Ratio")    
+    for name, values in results.items():
+      column = table.GetColumnByName(name)
+      if column is None or not column.IsNumeric():
+        continue
+      numpy_support.vtk_to_numpy(column)[rows] = np.asarray(values, dtype=float)
+      column.Modified()
+    table.Modified()
+    tableNode.Modified()
+
+  def flipTeeth(self, tableNode, force, teeth=None):
+    """
+    Switch base and tip of teeth: their tooth position lines become out-lever lines and the other way around.
+    Only position, out-lever, height, mechanical advantage, tooth force and stress of these teeth are recomputed,
+    from the cached landmarks, area and OBB size of the last run, and their table rows are updated in place.
+    Line endpoints take precedence over cached base/tip points, as in run, so edited lines are kept.
+    Teeth drawn in the compact line models (see compactLines) have their cached points swapped and the models redrawn.
+    :param tableNode: results table of the last run, if any
+    :param force: amount of force exerted by the muscles acting on the jaw
+    :param teeth: list of (segmentation node, segment ID) of the teeth to flip, default: all teeth with lines
+    :return: False if some switched teeth are not in the cache or the table (e.g. after a scene reload or Reset,
+      or for lines drawn by the user), so their rows still hold the values of before the switch and
+      need a new run; True otherwise
+    """
+    import numpy as np
 
-    SurfaceAreaArray = vtk.vtkFloatArray()
-    SurfaceAreaArray.SetName("Surface Area (mm^2)")
-    
-    MechAdvArray = vtk.vtkFloatArray()
-    MechAdvArray.SetName("Mechanical Advantage")  
-    
-    FToothArray = vtk.vtkFloatArray()
-    FToothArray.SetName("F-Tooth (N)")    
+    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    newFolder, posFolder, outFolder = self.getResultFolders()
+    pluginHandler = slicer.qSlicerSubjectHierarchyPluginHandler().instance()
+    folderPlugin = pluginHandler.pluginByName("Folder")
+    outvis = folderPlugin.getDisplayVisibility(outFolder)
+    posvis = folderPlugin.getDisplayVisibility(posFolder)
+    folderPlugin.setDisplayVisibility(outFolder, 0)
+    folderPlugin.setDisplayVisibility(posFolder, 0)
+
+    rowsUpdated = True
+    self.indexLegacyToothLines()
+    if teeth is None:
+      # teeth of all indexed lines, lines that are not indexed (see indexLegacyToothLines) are only switched
+      teeth = {}
+      for folder, child, lineNode in self.getResultFolderLines():
+        segmentationNode = lineNode.GetNodeReference(self.toothLineSegmentationReferenceRole)
+        if segmentationNode:
+          teeth[segmentationNode.GetID(), lineNode.GetAttribute(self.toothLineSegmentIdAttribute)] = segmentationNode
+        else:
+          shNode.SetItemParent(child, outFolder if folder == posFolder else posFolder)
+          self.setToothLineColors(lineNode, folder == outFolder)
+          rowsUpdated = False
+      for (segmentationNodeID, segmentId), entry in self.toothResultCache.items():
+        if entry["compact"]:
+          teeth[segmentationNodeID, segmentId] = slicer.mrmlScene.GetNodeByID(segmentationNodeID)
+      teeth = [(segmentationNode, segmentId) for (segmentationNodeID, segmentId), segmentationNode in teeth.items()]
+
+    entries = []
+    linePointRAS = [0,]*3
+    compactFlipped = False
+    for segmentationNode, segmentId in teeth:
+      ToothOutlineNode, ToothPoslineNode = self.getToothLines(segmentationNode, segmentId)
+      entry = self.toothResultCache.get((segmentationNode.GetID(), segmentId))
+      if not ToothPoslineNode and not ToothOutlineNode and entry and entry["compact"]:
+        # swap base and tip of a compact tooth, the new position line starts at the jaw joint like the out-lever line
+        entry["basePoint"], entry["tipPoint"] = entry["tipPoint"], entry["basePoint"]
+        entry["positionStartPoint"] = entry["jointRAS"]
+        entries.append(entry)
+        compactFlipped = True
+        continue
+      if ToothPoslineNode:
+        shNode.SetItemParent(shNode.GetItemByDataNode(ToothPoslineNode), posFolder)
+        self.setToothLineColors(ToothPoslineNode, True)
+      if ToothOutlineNode:
+        shNode.SetItemParent(shNode.GetItemByDataNode(ToothOutlineNode), outFolder)
+        self.setToothLineColors(ToothOutlineNode, False)
+      if not ToothPoslineNode and not ToothOutlineNode:
+        continue
+      self.setToothLines(segmentationNode, segmentId, ToothPoslineNode, ToothOutlineNode)
+
+      # swap the cached base and tip points, reading them from the switched lines
+      if entry is None or not ToothPoslineNode or not ToothOutlineNode:
+        rowsUpdated = False
+        continue
+      ToothPoslineNode.GetNthControlPointPosition(0, linePointRAS)
+      entry["positionStartPoint"] = np.array(linePointRAS)
+      ToothPoslineNode.GetNthControlPointPosition(1, linePointRAS)
+      entry["basePoint"] = np.array(linePointRAS)
+      ToothOutlineNode.SetNthControlPointPosition(0, entry["jointRAS"])
+      ToothOutlineNode.GetNthControlPointPosition(1, linePointRAS)
+      entry["tipPoint"] = np.array(linePointRAS)
+      entries.append(entry)
+
+    folderPlugin.setDisplayVisibility(outFolder, outvis)
+    folderPlugin.setDisplayVisibility(posFolder, posvis)
+    if compactFlipped:
+      self.updateCompactToothLines()
+    if not entries or not tableNode:
+      return rowsUpdated
+
+    mechanics = self.computeToothMechanics(
+      np.array([entry["basePoint"] for entry in entries]), np.array([entry["tipPoint"] for entry in entries]),
+      np.array([entry["positionStartPoint"] for entry in entries]), np.array([entry["obbDiameter"] for entry in entries]),
+      np.array([entry["area"] for entry in entries]), np.array([entry["jointRAS"] for entry in entries]),
+      np.array([entry["jawtipRAS"] for entry in entries]), np.array([entry["inleverRAS"] for entry in entries]), force)
+    rows = self.findResultsTableRows(tableNode, [entry["toothKey"] for entry in entries])
+    found = rows >= 0
+    self.updateResultsTableRows(tableNode, rows[found], {
+      "Position (mm)": mechanics["position"][found],
+      "Tooth Height (mm)": mechanics["height"][found],
+      "Aspect Ratio": mechanics["aspectRatio"][found],
+      "Mechanical Advantage": mechanics["mechanicalAdvantage"][found],
+      "F-Tooth (N)": mechanics["toothForce"][found],
+      "Stress (N/m^2)": mechanics["stress"][found],
+      })
+    return rowsUpdated and found.all()
+
+  def getToothLines(self, segmentationNode, segmentId):
+    """
+    Get the tooth position and out-lever lines of a tooth from the index kept in node references
+    of the segmentation node (see setToothLines), which is saved with the scene.
+    Lines of scenes computed by older versions are only found once indexed (see indexLegacyToothLines).
+    :return: position and out-lever line nodes, None where there is no line
+    """
+    role = self.toothLineReferenceRole + segmentId
+    return segmentationNode.GetNodeReference(role + ".Position"), segmentationNode.GetNodeReference(role + ".OutLever")
 
-    StressArray = vtk.vtkFloatArray()
-    StressArray.SetName("Stress (N/m^2)")
-    
-    # create misc folder
+  def indexLegacyToothLines(self):
+    """
+    Index the lines of scenes computed by older versions, which are only named after their tooth (see setToothLines).
+    Runs once per scene: the result folder is then marked, and is saved marked with the scene.
+    Lines whose name matches no segment or segments of several segmentations, and lines of teeth that already
+    have lines, are left as they are.
+    """
+    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    newFolder, posFolder, outFolder = self.getResultFolders()
+    if shNode.GetItemAttribute(newFolder, self.toothLinesIndexedAttribute):
+      return
+
+    segmentsByName = {}
+    for segmentationNode in slicer.util.getNodesByClass("vtkMRMLSegmentationNode"):
+      segmentation = segmentationNode.GetSegmentation()
+      for segmentIndex in range(segmentation.GetNumberOfSegments()):
+        segmentsByName.setdefault(segmentation.GetNthSegment(segmentIndex).GetName(), []).append(
+          (segmentationNode, segmentation.GetNthSegmentID(segmentIndex)))
+    legacyLines = {}  # (segmentation node, segment ID) -> [position line, out-lever line]
+    for folder, child, lineNode in self.getResultFolderLines():
+      if lineNode.GetNodeReference(self.toothLineSegmentationReferenceRole):
+        continue
+      segments = segmentsByName.get(lineNode.GetName(), [])
+      if len(segments) != 1:
+        logging.warning('Line {0} matches {1} segments, it is not indexed'.format(lineNode.GetName(), len(segments)))
+        continue
+      lines = legacyLines.setdefault(segments[0], [None, None])
+      lineIndex = 0 if folder == posFolder else 1
+      if lines[lineIndex] is None:
+        lines[lineIndex] = lineNode
+    for (segmentationNode, segmentId), (ToothPoslineNode, ToothOutlineNode) in legacyLines.items():
+      if self.getToothLines(segmentationNode, segmentId) == (None, None):
+        self.setToothLines(segmentationNode, segmentId, ToothPoslineNode, ToothOutlineNode)
+    shNode.SetItemAttribute(newFolder, self.toothLinesIndexedAttribute, "1")
+
+  def getResultFolderLines(self):
+    """
+    :return: list of (folder, subject hierarchy item, line node) of the lines in the tooth position and out-lever folders
+    """
+    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    newFolder, posFolder, outFolder = self.getResultFolders()
+    folderLines = []
+    for folder in (posFolder, outFolder):
+      children = vtk.vtkIdList()
+      shNode.GetItemChildren(folder, children)
+      for childIndex in range(children.GetNumberOfIds()):
+        lineNode = shNode.GetItemDataNode(children.GetId(childIndex))
+        if lineNode and lineNode.IsA("vtkMRMLMarkupsLineNode"):
+          folderLines.append((folder, children.GetId(childIndex), lineNode))
+    return folderLines
+
+  def setToothLines(self, segmentationNode, segmentId, ToothPoslineNode, ToothOutlineNode):
+    """
+    Index the tooth position and out-lever lines of a tooth. The segmentation node references the lines
+    (one reference role per segment and line) and each line references its segmentation and stores the segment ID.
+    """
+    role = self.toothLineReferenceRole + segmentId
+    for lineRole, lineNode in ((".Position", ToothPoslineNode), (".OutLever", ToothOutlineNode)):
+      segmentationNode.SetNodeReferenceID(role + lineRole, lineNode.GetID() if lineNode else None)
+      if lineNode:
+        lineNode.SetNodeReferenceID(self.toothLineSegmentationReferenceRole, segmentationNode.GetID())
+        lineNode.SetAttribute(self.toothLineSegmentIdAttribute, segmentId)
+
+  def setToothLineColors(self, lineNode, position):
+    """
+    Set the colors of a tooth position line (position=True) or out-lever line.
+    """
+    if position:
+      lineNode.GetDisplayNode().SetSelectedColor((0, 0.72, 0.92))
+      lineNode.GetDisplayNode().SetActiveColor((1, 0.65, 0.0))
+    else:
+      lineNode.GetDisplayNode().SetSelectedColor((1.0, 0.5000076295109483, 0.5000076295109483))
+      lineNode.GetDisplayNode().SetActiveColor((0.4, 1.0, 0.0))
+
+  def getResultFolders(self):
+    """
+    Get (and create if needed) the subject hierarchy folders holding the result lines.
+    The folders are searched by name only if the folders found last time are gone.
+    :return: IDs of the "Functional Homodonty Misc", "Tooth Positions" and "Out Levers" folders
+    """
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    folderNames = ["Functional Homodonty Misc", "Tooth Positions", "Out Levers"]
+    if self.resultFolders and [shNode.GetItemName(folder) for folder in self.resultFolders] == folderNames:
+      return self.resultFolders
     newFolder = shNode.GetItemByName("Functional Homodonty Misc")
     outFolder = shNode.GetItemByName("Out Levers")
     posFolder = shNode.GetItemByName("Tooth Positions")
@@ -548,49 +1910,379 @@ class FunctionalHomodontyLogic(ScriptedLoadableModuleLogic):
     shNode.SetItemExpanded(newFolder,0)   
     shNode.SetItemExpanded(outFolder,0) 
     shNode.SetItemExpanded(posFolder,0) 
-    # create models of the teeth
-    exportFolderItemId = shNode.CreateFolderItem(shNode.GetSceneItemID(), "Tooth Segments")
-    slicer.modules.segmentations.logic().ExportAllSegmentsToModels(segmentationNode, exportFolderItemId) 
-    #boxFolderItemId = shNode.CreateFolderItem(shNode.GetSceneItemID(), "Tooth Boxes")
-    #shNode.SetItemParent(boxFolderItemId, newFolder)
-    #shNode.SetItemExpanded(boxFolderItemId,0)
-
-    # calculate the centroid and surface area of each segment
-    import SegmentStatistics
-    segStatLogic = SegmentStatistics.SegmentStatisticsLogic()
-    segStatLogic.getParameterNode().SetParameter("Segmentation", segmentationNode.GetID())
-    segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.enabled", str(True))
-    segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.surface_area_mm2.enabled", str(True))
-    segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.centroid_ras.enabled", str(True))
-    segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.obb_origin_ras.enabled",str(True))
-    segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.obb_diameter_mm.enabled",str(True))
-    segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.obb_direction_ras_x.enabled",str(True))
-    segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.obb_direction_ras_y.enabled",str(True))
-    segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.obb_direction_ras_z.enabled",str(True))
-    segStatLogic.computeStatistics()
-    stats = segStatLogic.getStatistics()
+    self.resultFolders = (newFolder, posFolder, outFolder)
+    return self.resultFolders
 
-    jointRAS = [0,]*3
-    pointNode.GetNthControlPointPosition(0,jointRAS)
-	# draw line representing jaw length
-    jawtipRAS = [0,]*3
-    pointNode.GetNthControlPointPosition(1,jawtipRAS)
-    lengthLine = slicer.util.getFirstNodeByClassByName("vtkMRMLMarkupsLineNode", "JawLength")
-    if lengthLine == None:
-      lengthLine = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsLineNode", "JawLength")
-      lengthLine.GetDisplayNode().SetPropertiesLabelVisibility(False)
-      lengthLine.AddControlPoint(jointRAS)
-      lengthLine.AddControlPoint(jawtipRAS)
-      shNode.SetItemParent(shNode.GetItemByDataNode(lengthLine), newFolder)
-    else: 
-      lengthLine.SetNthControlPointPosition(0,jointRAS) 
-      lengthLine.SetNthControlPointPosition(1,jawtipRAS) 
-    lengthLine.SetDisplayVisibility(0)
+  def run(self, segmentationNode, pointNode, force, tableNode, species, LowerradioButton, UpperradioButton, LeftradioButton, RightradioButton, appendResults=False, preview=False):
+    """
+    Run the processing algorithm.
+    Can be used without GUI widget.
+    :param segmentation: segmentation file with all of the segmented teeth
+    :param jawlength: markups line node measuring jaw length
+    :param jawjoint: markups fiducial placed where the jaw joint is
+    :param inlever: markups fiducial placed where the muscle insertion is on the jaw
+    :param force: amount of force exerted by the muscles acting on the jaw
+    :param tableNode: table to show results
+    :param appendResults: add the rows of this jaw to the rows already in the table instead of clearing it
+    :param preview: quick approximate results from downsampled labelmaps and decimated surfaces, with error columns.
+      No lines are drawn, a final run at full resolution gives the numbers to publish.
+    """
+    jaw = self.createJaw(segmentationNode, pointNode, LowerradioButton, UpperradioButton, LeftradioButton, RightradioButton)
+    self.runMultipleJaws([jaw], force, tableNode, species, appendResults, preview)
 
-	
-	# draw line representing in-lever
+  def createJaw(self, segmentationNode, pointNode, LowerradioButton, UpperradioButton, LeftradioButton, RightradioButton):
+    """
+    Describe one jaw for runMultipleJaws from the jaw and side choices of the GUI.
+    """
+    jawID = "NA"
+    if LowerradioButton == True:
+      jawID = "Lower Jaw"
+    if UpperradioButton == True:
+      jawID = "Upper Jaw"
+    side = "NA"
+    if LeftradioButton == True:
+      side = "Left"
+    if RightradioButton == True:
+      side = "Right"
+    return {"segmentation": segmentationNode, "landmarks": pointNode, "jaw": jawID, "side": side}
+
+  def prepareJaws(self, jaws):
+    """
+    Check the jaws of a run and fill in their segment IDs (visible segments) where not given.
+    :return: dictionary of segmentation node ID to (segmentation node, IDs of all segments used by the jaws)
+    """
+    for jaw in jaws:
+      segmentationNode = jaw["segmentation"]
+      if not segmentationNode:
+        raise ValueError("Segmentation node is invalid")
+      if "segmentIds" not in jaw:
+        # Get visible segment ID list.
+        visibleSegmentIds = vtk.vtkStringArray()
+        segmentationNode.GetDisplayNode().GetVisibleSegmentIDs(visibleSegmentIds)
+        jaw["segmentIds"] = [visibleSegmentIds.GetValue(i) for i in range(visibleSegmentIds.GetNumberOfValues())]
+      if len(jaw["segmentIds"]) == 0:
+        raise ValueError("SliceAreaPlot will not return any results: there are no visible segments")
+
+    # one statistics pass per segmentation, shared by all jaws segmented in it
+    segmentIdsBySegmentation = {}
+    for jaw in jaws:
+      segmentationNode = jaw["segmentation"]
+      segmentIds = segmentIdsBySegmentation.setdefault(segmentationNode.GetID(), (segmentationNode, []))[1]
+      segmentIds.extend(segmentId for segmentId in jaw["segmentIds"] if segmentId not in segmentIds)
+    return segmentIdsBySegmentation
+
+  def startBackgroundRun(self, jaws, force, tableNode, species, appendResults=False, preview=False):
+    """
+    Start a run whose computations, tooth statistics, base/tip surface searches and mechanics, are done in a
+    worker thread. Closed surfaces, transforms, landmarks and tooth lines are first copied here on the main thread
+    (see getSegmentationData and getJawData), so the worker never reads the scene. Labelmaps are not copied, that
+    would freeze the application for large volumes: the segmentations are observed instead, and if one of them is
+    edited before the run is finished the run is stopped and its results are discarded (see finishBackgroundRun).
+    Poll the returned BackgroundRun for progress (one step per segmentation, tooth and jaw), cancel it if needed,
+    and call finishBackgroundRun on the main thread once it is done to draw the lines and fill the table in one step.
+    The Segment Statistics module works through the scene, so the worker always measures the teeth with the
+    lean statistics (see computeLeanSegmentStatistics), whatever statisticsMethod is.
+    An instrumented run (see instrumentRun) covers the steps on both threads, up to finishBackgroundRun.
+    Parameters are the same as for runMultipleJaws.
+    """
+    instrumentation = self.startRunInstrumentation()
+    try:
+      with self.useRunInstrumentation(instrumentation):
+        segmentIdsBySegmentation = self.prepareJaws(jaws)
+        segmentationData = {}
+        segmentationNames = {}
+        for segmentationNodeID, (segmentationNode, segmentIds) in segmentIdsBySegmentation.items():
+          with self.measurePhase("closed surfaces"):
+            segmentationNode.CreateClosedSurfaceRepresentation()
+          with self.measurePhase("segmentation data"):
+            segmentationData[segmentationNodeID] = self.getSegmentationData(segmentationNode, segmentIds, preview,
+              copySurfaces=True, statisticsMethod="Lean")
+          segmentationNames[segmentationNodeID] = segmentationNode.GetName()
+        jawData = [self.getJawData(jaw, species) for jaw in jaws]
+    except Exception:
+      self.stopRunInstrumentation(instrumentation, write=False)
+      raise
+
+    def computeJaws(backgroundRun):
+      # the steps of the worker, instrumented and profiled in its thread
+      with self.useRunInstrumentation(instrumentation):
+        backgroundRun.setTotal(len(segmentationData) + sum(len(data["segmentIds"]) for data in jawData) + len(jawData))
+        for segmentationNodeID, (segmentationNode, segmentIds) in segmentIdsBySegmentation.items():
+          if not backgroundRun.reportProgress("Measuring " + segmentationNames[segmentationNodeID]):
+            return None
+          with self.measurePhase("statistics"):
+            self.updateToothStatistics(segmentationData[segmentationNodeID], segmentIds, preview, "Lean")
+        for data in jawData:
+          for segmentId, toothName in zip(data["segmentIds"], data["toothNames"]):
+            if not backgroundRun.reportProgress("Finding base and tip of " + toothName):
+              return None
+            self.updateToothGeometry(segmentationData[data["segmentationNodeID"]], [segmentId], data["jaw"], preview, "Lean",
+              (data["jointRAS"], data["jawtipRAS"], data["inleverRAS"]))
+        jawResults = []
+        for data in jawData:
+          if not backgroundRun.reportProgress("Computing " + data["jaw"]):
+            return None
+          jawResults.append(self.computeJawResults(segmentationData[data["segmentationNodeID"]], data, force, preview, "Lean"))
+        backgroundRun.reportProgress("Done")
+        return jawResults
+
+    backgroundRun = BackgroundRun(computeJaws, (jawData, force, tableNode, appendResults, preview))
+    backgroundRun.instrumentation = instrumentation
+
+    # segment edits go through the segmentation, scripts may also modify the labelmaps directly
+    # (the source representation was called master representation before Slicer 5.3)
+    sourceRepresentationModified = getattr(slicer.vtkSegmentation, "SourceRepresentationModified", None)
+    if sourceRepresentationModified is None:
+      sourceRepresentationModified = slicer.vtkSegmentation.MasterRepresentationModified
+    for segmentationNodeID, (segmentationNode, segmentIds) in segmentIdsBySegmentation.items():
+      onEdited = lambda caller, event, name=segmentationNode.GetName(): backgroundRun.invalidate(
+        "Segmentation {0} was edited during the run".format(name))
+      for event in (sourceRepresentationModified, slicer.vtkSegmentation.SegmentModified, slicer.vtkSegmentation.SegmentRemoved):
+        backgroundRun.observations.append((segmentationNode, segmentationNode.AddObserver(event, onEdited)))
+      for layer in segmentationData[segmentationNodeID]["layers"]:
+        backgroundRun.observations.append((layer["image"], layer["image"].AddObserver(vtk.vtkCommand.ModifiedEvent, onEdited)))
+
+    backgroundRun.start()
+    return backgroundRun
+
+  def finishBackgroundRun(self, backgroundRun):
+    """
+    Draw the lines and fill the results table of a finished background run, from the results of the worker.
+    Main thread only. Errors of the worker are raised here, as is a ValueError if a segmentation was edited
+    during the run; the teeth the worker measured are then dropped from the geometry caches.
+    :return: False if the run was cancelled (nothing is changed), True otherwise
+    """
+    backgroundRun.thread.join()
+    backgroundRun.removeObservations()
+    jawData, force, tableNode, appendResults, preview = backgroundRun.arguments
+    completed = False
+    try:
+      if backgroundRun.invalidReason is not None:
+        for data in jawData:
+          for segmentId in data["segmentIds"]:
+            self.toothGeometryCache.pop((data["segmentationNodeID"], segmentId), None)
+            self.previewGeometryCache.pop((data["segmentationNodeID"], segmentId), None)
+        raise ValueError(backgroundRun.invalidReason + ", apply again to compute results")
+      if backgroundRun.error is not None:
+        raise backgroundRun.error
+      if backgroundRun.cancelled():
+        logging.info('Processing cancelled')
+        return False
+      with self.useRunInstrumentation(backgroundRun.instrumentation):
+        self.writeRunResults(jawData, backgroundRun.result, tableNode, appendResults, preview)
+      completed = True
+    finally:
+      self.stopRunInstrumentation(backgroundRun.instrumentation, completed)
+    logging.info('Processing completed')
+    return True
+
+  def runMultipleJaws(self, jaws, force, tableNode, species, appendResults=False, preview=False):
+    """
+    Compute several jaws of a specimen (upper/lower, left/right) in one run and fill one combined table.
+    Each segmentation goes through a single statistics pass, however many jaws use it.
+    :param jaws: list of dictionaries with "segmentation" (segmentation node), "landmarks" (markups node with jaw joint,
+      tip of jaw and muscle insertion site), "jaw" ("Lower Jaw" or "Upper Jaw") and "side" ("Left" or "Right").
+      Optional "segmentIds" restricts a jaw to some segments (default: visible segments) and optional "species"
+      overrides the species name.
+    :param force: amount of force exerted by the muscles acting on the jaw
+    :param tableNode: table to show results
+    :param species: species name written in the table
+    :param appendResults: add the rows of these jaws to the rows already in the table instead of clearing it
+    :param preview: quick approximate results (see run)
+    """
+    logging.info('Processing started' + (' (preview)' if preview else ''))
+
+    with self.instrumentRun():
+      # one statistics pass per segmentation, shared by all jaws segmented in it
+      segmentIdsBySegmentation = self.prepareJaws(jaws)
+      segmentationData = {}
+      for segmentationNodeID, (segmentationNode, segmentIds) in segmentIdsBySegmentation.items():
+        # make sure the tooth surfaces exist, they are read straight from the segmentation
+        with self.measurePhase("closed surfaces"):
+          segmentationNode.CreateClosedSurfaceRepresentation()
+        with self.measurePhase("segmentation data"):
+          segmentationData[segmentationNodeID] = self.getSegmentationData(segmentationNode, segmentIds, preview)
+        with self.measurePhase("statistics"):
+          self.updateToothStatistics(segmentationData[segmentationNodeID], segmentIds, preview)
+
+      jawData = [self.getJawData(jaw, species) for jaw in jaws]
+      jawResults = [self.computeJawResults(segmentationData[data["segmentationNodeID"]], data, force, preview)
+        for data in jawData]
+      self.writeRunResults(jawData, jawResults, tableNode, appendResults, preview)
+    logging.info('Processing completed')
+
+  def getJawData(self, jaw, species):
+    """
+    Read the landmarks of a jaw and the tooth lines of earlier runs into arrays for computeJawResults. Main thread only.
+    :param jaw: jaw as in runMultipleJaws, with its segment IDs (see prepareJaws)
+    :param species: species name of the run, unless the jaw has its own
+    :return: dictionary with "segmentation" (node), "segmentationNodeID", "segmentIds", "toothNames", "species", "jaw",
+      "side", landmarks "jointRAS", "jawtipRAS" and "inleverRAS", N x 3 "positionStartPoints", "basePoints" and
+      "tipPoints" of existing lines (NaN where a tooth has none) and "positionLines" and "outLeverLines" (line nodes,
+      None where a tooth has none)
+    """
+    import numpy as np
+
+    segmentationNode = jaw["segmentation"]
+    segmentIds = jaw["segmentIds"]
+    pointNode = jaw["landmarks"]
+    species = jaw.get("species", species)
+    self.indexLegacyToothLines()
+    if species == "Enter species name" or species == "":
+      species = "NA"
+
+    jointRAS = [0,]*3
+    pointNode.GetNthControlPointPosition(0,jointRAS)
+    jawtipRAS = [0,]*3
+    pointNode.GetNthControlPointPosition(1,jawtipRAS)
     inleverRAS = [0,]*3
     pointNode.GetNthControlPointPosition(2,inleverRAS)
+
+    # lines of teeth computed before may have been edited or switched by the user, they take precedence
+    numberOfTeeth = len(segmentIds)
+    positionStartPoints = np.full((numberOfTeeth, 3), np.nan)
+    basePoints = np.full((numberOfTeeth, 3), np.nan)
+    tipPoints = np.full((numberOfTeeth, 3), np.nan)
+    posLineNodes = []
+    outLineNodes = []
+    linePointRAS = [0,]*3
+    for i, segmentId in enumerate(segmentIds):
+     ToothPoslineNode, ToothOutlineNode = self.getToothLines(segmentationNode, segmentId)
+     compactEntry = self.toothResultCache.get((segmentationNode.GetID(), segmentId))
+     if not ToothPoslineNode and not ToothOutlineNode and compactEntry and compactEntry["compact"]:
+       # compact lines of the last run (see updateCompactToothLines), which may have been switched
+       positionStartPoints[i] = compactEntry["positionStartPoint"]
+       basePoints[i] = compactEntry["basePoint"]
+       tipPoints[i] = compactEntry["tipPoint"]
+     if ToothPoslineNode:
+       ToothPoslineNode.GetNthControlPointPosition(0, linePointRAS)
+       positionStartPoints[i] = linePointRAS
+       ToothPoslineNode.GetNthControlPointPosition(1, linePointRAS)
+       basePoints[i] = linePointRAS
+     if ToothOutlineNode:
+       ToothOutlineNode.GetNthControlPointPosition(1, linePointRAS)
+       tipPoints[i] = linePointRAS
+     posLineNodes.append(ToothPoslineNode)
+     outLineNodes.append(ToothOutlineNode)
+
+    return {
+      "segmentation": segmentationNode,
+      "segmentationNodeID": segmentationNode.GetID(),
+      "segmentIds": list(segmentIds),
+      "toothNames": [segmentationNode.GetSegmentation().GetSegment(segmentId).GetName() for segmentId in segmentIds],
+      "species": species,
+      "jaw": jaw["jaw"],
+      "side": jaw["side"],
+      "jointRAS": np.array(jointRAS, dtype=float),
+      "jawtipRAS": np.array(jawtipRAS, dtype=float),
+      "inleverRAS": np.array(inleverRAS, dtype=float),
+      "positionStartPoints": positionStartPoints,
+      "basePoints": basePoints,
+      "tipPoints": tipPoints,
+      "positionLines": posLineNodes,
+      "outLeverLines": outLineNodes,
+      }
+
+  def computeJawResults(self, segmentationData, jawData, force, preview=False, statisticsMethod=None):
+    """
+    Compute tooth positions, out-levers and stresses of one jaw. Only segmentationData and jawData are read,
+    not the scene, so this also runs in the worker of a background run.
+    :param segmentationData: segmentation data of the jaw (see getSegmentationData)
+    :param jawData: landmarks and existing lines of the jaw (see getJawData)
+    :param force: amount of force exerted by the muscles acting on the jaw
+    :param preview: quick approximate results (see run)
+    :param statisticsMethod: overrides statisticsMethod (see updateToothStatistics)
+    :return: dictionary of result column name to per-tooth values (see resultColumns, and previewResultColumns
+      in preview), and dictionary with the N x 3 "positionStartPoints", "basePoints" and "tipPoints" of the teeth
+      and their "toothGeometry" (see updateToothGeometry), for drawJaw
+    """
+    import numpy as np
+
+    segmentIds = jawData["segmentIds"]
+    jawID = jawData["jaw"]
+
+    # calculate surface area and base/tip points of each tooth that changed since the last run
+    with self.measurePhase("tooth geometry"):
+      toothGeometry = self.updateToothGeometry(segmentationData, segmentIds, jawID, preview, statisticsMethod,
+        (jawData["jointRAS"], jawData["jawtipRAS"], jawData["inleverRAS"]))
+
+    # base and tip points of all teeth, flipped where the tip ended up closer to the jaw line
+    jointRAS, jawtipRAS, inleverRAS = jawData["jointRAS"], jawData["jawtipRAS"], jawData["inleverRAS"]
+    basePoints = np.array([geometry["basePoint"] for geometry in toothGeometry])
+    tipPoints = np.array([geometry["tipPoint"] for geometry in toothGeometry])
+    basePoints, tipPoints = self.orientBaseAndTipPoints(basePoints, tipPoints, jointRAS, jawtipRAS, inleverRAS, jawID)
+    positionStartPoints = np.tile(jointRAS, (len(segmentIds), 1))
+
+    # lines of teeth computed before take precedence
+    for points, linePoints in ((positionStartPoints, jawData["positionStartPoints"]),
+      (basePoints, jawData["basePoints"]), (tipPoints, jawData["tipPoints"])):
+      drawn = ~np.isnan(linePoints[:, 0])
+      points[drawn] = linePoints[drawn]
+
+    # compute lever arms, tooth shape, mechanical advantage and stress of all teeth at once
+    with self.measurePhase("mechanics"):
+      mechanics = self.computeToothMechanics(basePoints, tipPoints, positionStartPoints,
+        np.array([geometry["obbDiameter"] for geometry in toothGeometry]),
+        np.array([geometry["area"] for geometry in toothGeometry]),
+        jointRAS, jawtipRAS, inleverRAS, force)
+
+    numberOfTeeth = len(segmentIds)
+    results = {
+      "Species": [jawData["species"]] * numberOfTeeth,
+      "Jaw ID": [jawID] * numberOfTeeth,
+      "Side of Face": [jawData["side"]] * numberOfTeeth,
+      "Jaw Length (mm)": np.full(numberOfTeeth, mechanics["jawLength"]),
+      "Tooth ID": list(jawData["toothNames"]),
+      "Position (mm)": mechanics["position"],
+      "Tooth Height (mm)": mechanics["height"],
+      "Tooth Width (mm)": mechanics["width"],
+      "Aspect Ratio": mechanics["aspectRatio"],
+      "Surface Area (mm^2)": mechanics["area"],
+      "Mechanical Advantage": mechanics["mechanicalAdvantage"],
+      "F-Tooth (N)": mechanics["toothForce"],
+      "Stress (N/m^2)": mechanics["stress"],
+      }
+    if preview:
+      results["Position Error (mm)"] = np.array([geometry["positionError"] for geometry in toothGeometry])
+      results["Surface Area Error (mm^2)"] = np.array([geometry["areaError"] for geometry in toothGeometry])
+    return results, {
+      "positionStartPoints": positionStartPoints,
+      "basePoints": basePoints,
+      "tipPoints": tipPoints,
+      "toothGeometry": toothGeometry,
+      }
+
+  def drawJaw(self, jawData, points, preview=False):
+    """
+    Draw the jaw length, in-lever and tooth lines of one jaw and keep its teeth in the result cache for flips.
+    Main thread only.
+    :param jawData: landmarks and existing lines of the jaw (see getJawData)
+    :param points: tooth points computed by computeJawResults
+    :param preview: tooth lines are not drawn, as existing lines take precedence over computed points in later runs
+    """
+    import numpy as np
+
+    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    newFolder, posFolder, outFolder = self.getResultFolders()
+    segmentationNode = jawData["segmentation"]
+    segmentIds = jawData["segmentIds"]
+    jointRAS, jawtipRAS, inleverRAS = jawData["jointRAS"], jawData["jawtipRAS"], jawData["inleverRAS"]
+
+	# draw line representing jaw length
+    lengthLine = slicer.util.getFirstNodeByClassByName("vtkMRMLMarkupsLineNode", "JawLength")
+    if lengthLine == None:
+      lengthLine = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsLineNode", "JawLength")
+      lengthLine.GetDisplayNode().SetPropertiesLabelVisibility(False)
+      lengthLine.AddControlPoint(jointRAS)
+      lengthLine.AddControlPoint(jawtipRAS)
+      shNode.SetItemParent(shNode.GetItemByDataNode(lengthLine), newFolder)
+    else: 
+      lengthLine.SetNthControlPointPosition(0,jointRAS) 
+      lengthLine.SetNthControlPointPosition(1,jawtipRAS) 
+    lengthLine.SetDisplayVisibility(0)
+
+	
+	# draw line representing in-lever
     leverLine = slicer.util.getFirstNodeByClassByName("vtkMRMLMarkupsLineNode", "InLever")
     if leverLine == None:
       leverLine = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsLineNode", "InLever")
@@ -602,281 +2294,205 @@ class FunctionalHomodontyLogic(ScriptedLoadableModuleLogic):
       leverLine.SetNthControlPointPosition(0,jointRAS)
       leverLine.SetNthControlPointPosition(1,inleverRAS) 
     leverLine.SetDisplayVisibility(0)
-    
-    # perform computations for each tooth 
-    for segmentId in stats["SegmentIDs"]:
-     
-     if species != "Enter species name" and species != "":
-       SpeciesArray.InsertNextValue(species)  
-     if species == "Enter species name" or species == "": 
-       species = "NA" 
-       SpeciesArray.InsertNextValue(species)  
-     jawID = "NA"
-     if LowerradioButton == True:
-       jawID = "Lower Jaw"
-     if UpperradioButton == True:
-       jawID = "Upper Jaw"
-     if jawID != "":
-       JawIDArray.InsertNextValue(jawID)
-     side = "NA"
-     if LeftradioButton == True:
-       side = "Left"
-     if RightradioButton == True:
-       side = "Right"
-     if side != "":
-       SideArray.InsertNextValue(side)
-     
-     segment = segmentationNode.GetSegmentation().GetSegment(segmentId)
-     SegmentNameArray.InsertNextValue(segment.GetName())
-     
-     
-     JawLength = lengthLine.GetMeasurement('length').GetValue()
-     JawLengthArray.InsertNextValue(JawLength)
-     
-     # measure surface area
-     Area = stats[segmentId,"LabelmapSegmentStatisticsPlugin.surface_area_mm2"]/2
-     SurfaceAreaArray.InsertNextValue(Area)
-     
-     # get tooth position at the base of the tooth
-     obb_origin_ras = np.array(stats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_origin_ras"])
-     obb_diameter_mm = np.array(stats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_diameter_mm"])
-     obb_direction_ras_x = np.array(stats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_direction_ras_x"])
-     obb_direction_ras_y = np.array(stats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_direction_ras_y"])
-     obb_direction_ras_z = np.array(stats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_direction_ras_z"])
-     if LowerradioButton == True:
-       obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*-2.2 * obb_direction_ras_z)
-       if (obb_direction_ras_z[0] > 0 and obb_direction_ras_z[1] > 0 and obb_direction_ras_z[2] < 0):
-         obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*2.2 * obb_direction_ras_z)
-       if (obb_direction_ras_z[1] < 0):
-         obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*2.2 * obb_direction_ras_z)
-       if (obb_direction_ras_z[0] < 0 and obb_direction_ras_z[1] < 0):
-         obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*-2.2 * obb_direction_ras_z)
-       if all(obb_direction_ras_z < 0):
-         obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*2.2 * obb_direction_ras_z)
-     if UpperradioButton == True:
-       obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*2.2 * obb_direction_ras_z)
-       if (obb_direction_ras_z[0] > 0 and obb_direction_ras_z[1] > 0 and obb_direction_ras_z[2] < 0):
-         obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*-2.2 * obb_direction_ras_z)
-       if (obb_direction_ras_z[1] < 0):
-         obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*-2.2 * obb_direction_ras_z)
-       if (obb_direction_ras_z[0] < 0 and obb_direction_ras_z[1] < 0):
-         obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*2.2 * obb_direction_ras_z)
-       if all(obb_direction_ras_z < 0):
-         obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*-2.2 * obb_direction_ras_z)
-     modelNode = slicer.util.getFirstNodeByClassByName("vtkMRMLModelNode", segment.GetName())
-
-     if modelNode.GetParentTransformNode():
-       transformModelToWorld = vtk.vtkGeneralTransform()
-       slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(modelNode.GetParentTransformNode(), None, transformModelToWorld)
-       polyTransformToWorld = vtk.vtkTransformPolyDataFilter()
-       polyTransformToWorld.SetTransform(transformModelToWorld)
-       polyTransformToWorld.SetInputData(modelNode.GetPolyData())
-       polyTransformToWorld.Update()
-       surface_World = polyTransformToWorld.GetOutput()
-     else:
-       surface_World = modelNode.GetPolyData()
-     distanceFilter = vtk.vtkImplicitPolyDataDistance()
-     distanceFilter.SetInput(surface_World)
-     closestPointOnSurface_World = [0,0,0]
-     distanceFilter.EvaluateFunctionAndGetClosestPoint(obb_center_ras, closestPointOnSurface_World)
-     #slicer.mrmlScene.RemoveNode(modelNode)
-     #toothposRAS = stats[segmentId,"LabelmapSegmentStatisticsPlugin.centroid_ras"] # draw to the center of tooth
-     toothposRAS = closestPointOnSurface_World # draw to the tip of the tooth
-
-     
-     # try to find the tip of the tooth
-     #obb_origin_ras = np.array(stats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_origin_ras"])
-     #obb_diameter_mm = np.array(stats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_diameter_mm"])
-     #obb_direction_ras_x = np.array(stats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_direction_ras_x"])
-     #obb_direction_ras_y = np.array(stats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_direction_ras_y"])
-     #obb_direction_ras_z = np.array(stats[segmentId,"LabelmapSegmentStatisticsPlugin.obb_direction_ras_z"])
-     if LowerradioButton == True:
-       obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*2.2 * obb_direction_ras_z)
-       if (obb_direction_ras_z[0] > 0 and obb_direction_ras_z[1] > 0 and obb_direction_ras_z[2] < 0):
-         obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*-2.2 * obb_direction_ras_z)
-       if (obb_direction_ras_z[1] < 0):
-         obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*-2.2 * obb_direction_ras_z)
-       if (obb_direction_ras_z[0] < 0 and obb_direction_ras_z[1] < 0):
-         obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*2.2 * obb_direction_ras_z)
-       if all(obb_direction_ras_z < 0):
-         obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*-2.2 * obb_direction_ras_z)
-     if UpperradioButton == True:
-       obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*-2.2 * obb_direction_ras_z)
-       if (obb_direction_ras_z[0] > 0 and obb_direction_ras_z[1] > 0 and obb_direction_ras_z[2] < 0):
-         obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*2.2 * obb_direction_ras_z)
-       if (obb_direction_ras_z[1] < 0):
-         obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*2.2 * obb_direction_ras_z)
-       if (obb_direction_ras_z[0] < 0 and obb_direction_ras_z[1] < 0):
-         obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*-2.2 * obb_direction_ras_z)
-       if all(obb_direction_ras_z < 0):
-         obb_center_ras = obb_origin_ras+0.5*(obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[2]*2.2 * obb_direction_ras_z)
-     modelNode = slicer.util.getFirstNodeByClassByName("vtkMRMLModelNode", segment.GetName())
-
-     if modelNode.GetParentTransformNode():
-       transformModelToWorld = vtk.vtkGeneralTransform()
-       slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(modelNode.GetParentTransformNode(), None, transformModelToWorld)
-       polyTransformToWorld = vtk.vtkTransformPolyDataFilter()
-       polyTransformToWorld.SetTransform(transformModelToWorld)
-       polyTransformToWorld.SetInputData(modelNode.GetPolyData())
-       polyTransformToWorld.Update()
-       surface_World = polyTransformToWorld.GetOutput()
-     else:
-       surface_World = modelNode.GetPolyData()
-     distanceFilter = vtk.vtkImplicitPolyDataDistance()
-     distanceFilter.SetInput(surface_World)
-     closestPointOnSurface_World = [0,0,0]
-     distanceFilter.EvaluateFunctionAndGetClosestPoint(obb_center_ras, closestPointOnSurface_World)
-     slicer.mrmlScene.RemoveNode(modelNode)
-     #toothoutRAS = stats[segmentId,"LabelmapSegmentStatisticsPlugin.centroid_ras"] # draw to the center of tooth
-     toothoutRAS = closestPointOnSurface_World # draw to the tip of the tooth
-     
-     jawvec = jointRAS[0]-jawtipRAS[0],jointRAS[1]-jawtipRAS[1],jointRAS[2]-jawtipRAS[2]
-     jawvec = np.array(jawvec)
-     posvec = toothposRAS[0]-jointRAS[0],toothposRAS[1]-jointRAS[1],toothposRAS[2]-jointRAS[2]
-     posvec = np.array(posvec)
-     t = np.dot(jawvec,posvec)/jawvec**2
-     jawvecpoint = jointRAS + t*jawvec
-     ToothPos = np.linalg.norm(np.array(toothposRAS)-np.array(jawvecpoint))
-     OutLever = np.linalg.norm(np.array(toothoutRAS)-np.array(jawvecpoint))
-     if (ToothPos > OutLever and jawID == "Lower Jaw"):
-       tmp1 = toothoutRAS
-       tmp2 = toothposRAS
-       toothoutRAS = tmp2
-       toothposRAS = tmp1
-     posvec = toothposRAS[0]-inleverRAS[0],toothposRAS[1]-inleverRAS[1],toothposRAS[2]-inleverRAS[2]
-     posvec = np.array(posvec)
-     t = np.dot(jawvec,posvec)/jawvec**2
-     jawvecpoint = inleverRAS + t*jawvec
-     ToothPos = np.linalg.norm(np.array(toothposRAS)-np.array(jawvecpoint))
-     OutLever = np.linalg.norm(np.array(toothoutRAS)-np.array(jawvecpoint))
-     if (ToothPos < OutLever and jawID == "Upper Jaw"):
-       tmp1 = toothoutRAS
-       tmp2 = toothposRAS
-       toothoutRAS = tmp2
-       toothposRAS = tmp1       
-     
-     # draw line between jaw joint and the base of the tooth
-     ToothPoslineNode = shNode.GetItemDataNode(shNode.GetItemChildWithName(posFolder, segment.GetName()))
-     if ToothPoslineNode == None:
-       ToothPoslineNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsLineNode", segment.GetName())
-       ToothPoslineNode.GetDisplayNode().SetPropertiesLabelVisibility(False)
-       ToothPoslineNode.GetDisplayNode().SetSelectedColor((0, 0.72, 0.92))
-       ToothPoslineNode.GetDisplayNode().SetActiveColor((1, 0.65, 0.0))
-       ToothPoslineNode.AddControlPoint(jointRAS)
-       ToothPoslineNode.AddControlPoint(toothposRAS)
-       shNode.SetItemParent(shNode.GetItemByDataNode(ToothPoslineNode), posFolder)
-     ToothPos = ToothPoslineNode.GetMeasurement('length').GetValue()
-     PositionArray.InsertNextValue(ToothPos)
-     # auto hide the positions folder
-     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-     pluginHandler = slicer.qSlicerSubjectHierarchyPluginHandler().instance()
-     folderPlugin = pluginHandler.pluginByName("Folder")
-     if folderPlugin.getDisplayVisibility(posFolder) == 0:
-       folderPlugin.setDisplayVisibility(posFolder, 1)
-       folderPlugin.setDisplayVisibility(posFolder, 0)
-     
-     # draw line between jaw joint and tooth
-     ToothOutlineNode = shNode.GetItemDataNode(shNode.GetItemChildWithName(outFolder, segment.GetName()))
-     if ToothOutlineNode == None:
-       ToothOutlineNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsLineNode", segment.GetName())
-       ToothOutlineNode.GetDisplayNode().SetPropertiesLabelVisibility(False)
-       ToothOutlineNode.AddControlPoint(jointRAS)
-       ToothOutlineNode.AddControlPoint(toothoutRAS)
-       shNode.SetItemParent(shNode.GetItemByDataNode(ToothOutlineNode), outFolder)
-     else: 
-       ToothOutlineNode.SetNthControlPointPosition(0,jointRAS)     
-     OutLever = ToothOutlineNode.GetMeasurement('length').GetValue()
-     # auto show the outlever folder
-     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-     pluginHandler = slicer.qSlicerSubjectHierarchyPluginHandler().instance()
-     folderPlugin = pluginHandler.pluginByName("Folder")
-     if folderPlugin.getDisplayVisibility(outFolder) == 0:
-       folderPlugin.setDisplayVisibility(outFolder, 1)
-       folderPlugin.setDisplayVisibility(outFolder, 0)
-              
-     
-     RelPosArray.InsertNextValue(ToothPos/JawLength)
-     
-     # calculate tooth aspect ratio
-     heightNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsLineNode", segment.GetName())
-     heightNode.GetDisplayNode().SetPropertiesLabelVisibility(False)
-     heightNode.AddControlPoint(ToothPoslineNode.GetNthControlPointPosition(1))
-     heightNode.AddControlPoint(ToothOutlineNode.GetNthControlPointPosition(1))
-     ToothHeight = heightNode.GetMeasurement('length').GetValue()
-     slicer.mrmlScene.RemoveNode(heightNode)
-     #ToothHeight = obb_diameter_mm[2]
-     ToothHeightArray.InsertNextValue(ToothHeight)
-     if obb_diameter_mm[0] > obb_diameter_mm[1]:
-       ToothWidthArray.InsertNextValue(obb_diameter_mm[0])
-       AspectRatioArray.InsertNextValue(ToothHeight/obb_diameter_mm[0])
-     if obb_diameter_mm[0] < obb_diameter_mm[1]:
-       ToothWidthArray.InsertNextValue(obb_diameter_mm[1])
-       AspectRatioArray.InsertNextValue(ToothHeight/obb_diameter_mm[1])
-
-     
-     # calculate mechanical advantage and F-Tooth
-     InLever = leverLine.GetMeasurement('length').GetValue()
-     MA = InLever/OutLever
-     MechAdvArray.InsertNextValue(MA)
-     FToothArray.InsertNextValue(force * MA)
-     
-     # calculate tooth stress
-     StressArray.InsertNextValue((force * MA)/ (Area * 1e-6))
 
-    
-    if species != "Enter species name" and species != "":
-      tableNode.AddColumn(SpeciesArray)
-      tableNode.SetColumnDescription(SpeciesArray.GetName(), "Species")
-
-    tableNode.AddColumn(JawIDArray)
-    tableNode.SetColumnDescription(JawIDArray.GetName(), "If upper or lower jaw")
-   
-    tableNode.AddColumn(SideArray)
-    tableNode.SetColumnDescription(SideArray.GetName(), "Side of face that the jaw is on")  
-        
-    tableNode.AddColumn(JawLengthArray)
-    tableNode.SetColumnDescription(JawLengthArray.GetName(), "Jaw Length")
-    tableNode.SetColumnUnitLabel(JawLengthArray.GetName(), "mm")  # TODO: use length unit
-    
-    tableNode.AddColumn(SegmentNameArray)
-    tableNode.SetColumnDescription(SegmentNameArray.GetName(), "Tooth segment name")
-    
-    tableNode.AddColumn(PositionArray)
-    tableNode.SetColumnDescription(PositionArray.GetName(), "Distance between the base of the tooth and the jaw joint")
-    tableNode.SetColumnUnitLabel(PositionArray.GetName(), "mm")  # TODO: use length unit
-    
-    #tableNode.AddColumn(RelPosArray)
-    #tableNode.SetColumnDescription(RelPosArray.GetName(), "Relative position of the tooth")
-    #tableNode.SetColumnUnitLabel(RelPosArray.GetName(), "%")  # TODO: use length unit
-
-    tableNode.AddColumn(ToothHeightArray)
-    tableNode.SetColumnDescription(ToothHeightArray.GetName(), "Tooth Height")
-    tableNode.SetColumnUnitLabel(ToothHeightArray.GetName(), "mm")  # TODO: use length unit
-
-    tableNode.AddColumn(ToothWidthArray)
-    tableNode.SetColumnDescription(ToothWidthArray.GetName(), "Tooth Width")
-    tableNode.SetColumnUnitLabel(ToothWidthArray.GetName(), "mm")  # TODO: use length unit
-
-    tableNode.AddColumn(AspectRatioArray)
-    tableNode.SetColumnDescription(AspectRatioArray.GetName(), "Tooth Aspect Ratio")
-    tableNode.SetColumnUnitLabel(AspectRatioArray.GetName(), "mm")  # TODO: use length unit
-
-    tableNode.AddColumn(SurfaceAreaArray)
-    tableNode.SetColumnDescription(SurfaceAreaArray.GetName(), "Tooth surface area")
-    tableNode.SetColumnUnitLabel(SurfaceAreaArray.GetName(), "mm^2")  # TODO: use length unit
-    
-    tableNode.AddColumn(MechAdvArray)
-    tableNode.SetColumnDescription(MechAdvArray.GetName(), "Tooth mechanical advantage")
+    if preview:
+      return
 
-    tableNode.AddColumn(FToothArray)
-    tableNode.SetColumnDescription(FToothArray.GetName(), "The force acting on a tooth (muscle force * mechanical advantage)")
-    tableNode.SetColumnUnitLabel(FToothArray.GetName(), "N")  # TODO: use length unit
+    posLineNodes = jawData["positionLines"]
+    outLineNodes = jawData["outLeverLines"]
+    positionStartPoints, basePoints, tipPoints = points["positionStartPoints"], points["basePoints"], points["tipPoints"]
+    toothGeometry = points["toothGeometry"]
+    for i, segmentId in enumerate(segmentIds):
+      self.toothResultCache[segmentationNode.GetID(), segmentId] = {
+        "toothKey": (jawData["species"], jawData["jaw"], jawData["side"], jawData["toothNames"][i]),
+        "jointRAS": jointRAS,
+        "jawtipRAS": jawtipRAS,
+        "inleverRAS": inleverRAS,
+        "positionStartPoint": positionStartPoints[i],
+        "basePoint": basePoints[i],
+        "tipPoint": tipPoints[i],
+        "obbDiameter": toothGeometry[i]["obbDiameter"],
+        "area": toothGeometry[i]["area"],
+        # drawn in the compact line models instead of markups
+        "compact": self.compactLines and posLineNodes[i] is None and outLineNodes[i] is None,
+        }
+
+    # draw the tooth position and out-lever lines, all scene changes are made in a single batch
+    slicer.mrmlScene.StartState(slicer.mrmlScene.BatchProcessState)
+    try:
+      for i, segmentId in enumerate(segmentIds):
+        if self.toothResultCache[segmentationNode.GetID(), segmentId]["compact"]:
+          continue
+        segmentName = jawData["toothNames"][i]
+        with self.measurePhase("tooth lines", segmentName):
+
+          # draw line between jaw joint and the base of the tooth
+          ToothPoslineNode = posLineNodes[i]
+          if ToothPoslineNode == None:
+            ToothPoslineNode = self.createToothLine(segmentName, jointRAS, basePoints[i], posFolder, True)
+
+          # draw line between jaw joint and tooth
+          ToothOutlineNode = outLineNodes[i]
+          if ToothOutlineNode == None:
+            ToothOutlineNode = self.createToothLine(segmentName, jointRAS, tipPoints[i], outFolder, False)
+          else:
+            ToothOutlineNode.SetNthControlPointPosition(0,jointRAS)
+
+          if posLineNodes[i] == None or outLineNodes[i] == None:
+            self.setToothLines(segmentationNode, segmentId, ToothPoslineNode, ToothOutlineNode)
+    finally:
+      with self.measurePhase("end batch"):
+        slicer.mrmlScene.EndState(slicer.mrmlScene.BatchProcessState)
+
+    with self.measurePhase("compact lines"):
+      self.updateCompactToothLines()
+
+    # new lines follow the visibility of their folder (positions are hidden by default)
+    with self.measurePhase("folder visibility"):
+      self.updateResultFolderVisibility()
+
+  def writeRunResults(self, jawData, jawResults, tableNode, appendResults=False, preview=False):
+    """
+    Draw the lines of the jaws of a run and write their rows to the results table and the dentition store.
+    Main thread only.
+    :param jawData: jaws of the run (see getJawData)
+    :param jawResults: results and points of each jaw (see computeJawResults)
+    """
+    import numpy as np
 
-    tableNode.AddColumn(StressArray)
-    tableNode.SetColumnDescription(StressArray.GetName(), "Tooth stress (tooth force / surface area)")
+    for data, (results, points) in zip(jawData, jawResults):
+      self.drawJaw(data, points, preview)
+
+    # fill the results table
+    columns = self.resultColumns + self.previewResultColumns if preview else self.resultColumns
+    results = {}
+    for name, description, unit, isText in columns:
+      if isText:
+        results[name] = [value for jawResult, points in jawResults for value in jawResult[name]]
+      else:
+        results[name] = np.concatenate([jawResult[name] for jawResult, points in jawResults])
+    if self.dentitionStoreDirectory and not preview:
+      with self.measurePhase("dentition store"):
+        self.writeDentitionStore(self.dentitionStoreDirectory, results)
+    with self.measurePhase("table"):
+      self.writeResultsTable(tableNode, results, appendResults, columns)
+      tableNode.SetAttribute("FunctionalHomodonty.Preview", str(preview))
+
+    with self.measurePhase("layout"):
+      self.showResultsTable(tableNode)
+    with self.measurePhase("render"):
+      slicer.util.forceRenderAllViews()
+
+  def createToothLine(self, segmentName, startPointRAS, endPointRAS, folder, position):
+    """
+    Create a tooth position line (position=True) or out-lever line in a result folder.
+    """
+    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    lineNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsLineNode", segmentName)
+    lineNode.GetDisplayNode().SetPropertiesLabelVisibility(False)
+    if position:
+      self.setToothLineColors(lineNode, True)
+    lineNode.AddControlPoint(startPointRAS)
+    lineNode.AddControlPoint(endPointRAS)
+    shNode.SetItemParent(shNode.GetItemByDataNode(lineNode), folder)
+    return lineNode
+
+  def updateResultFolderVisibility(self):
+    """
+    Make new lines and models follow the visibility of their result folder.
+    """
+    newFolder, posFolder, outFolder = self.getResultFolders()
+    pluginHandler = slicer.qSlicerSubjectHierarchyPluginHandler().instance()
+    folderPlugin = pluginHandler.pluginByName("Folder")
+    for folder in (posFolder, outFolder):
+      if folderPlugin.getDisplayVisibility(folder) == 0:
+        folderPlugin.setDisplayVisibility(folder, 1)
+        folderPlugin.setDisplayVisibility(folder, 0)
 
-    shNode.RemoveItem(exportFolderItemId)
+  def updateCompactToothLines(self):
+    """
+    Draw the lines of all compact teeth (see compactLines) as one model per result folder:
+    a "Tooth Positions Model" and an "Out Levers Model", one line cell per tooth, with the tooth index,
+    segment ID, tooth ID and line length as cell data. The models are removed when no tooth is compact.
+    """
+    import numpy as np
+    from vtk.util import numpy_support
 
+    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    newFolder, posFolder, outFolder = self.getResultFolders()
+    compactTeeth = [(cacheKey, entry) for cacheKey, entry in self.toothResultCache.items() if entry["compact"]]
+    numberOfTeeth = len(compactTeeth)
+
+    for folder, modelName, startKey, endKey, color in (
+      (posFolder, "Tooth Positions Model", "positionStartPoint", "basePoint", (0, 0.72, 0.92)),
+      (outFolder, "Out Levers Model", "jointRAS", "tipPoint", (1.0, 0.5000076295109483, 0.5000076295109483))):
+      modelNode = shNode.GetItemDataNode(shNode.GetItemChildWithName(folder, modelName))
+      if numberOfTeeth == 0:
+        if modelNode:
+          slicer.mrmlScene.RemoveNode(modelNode)
+        continue
+
+      # points of line i are 2i (start) and 2i+1 (end)
+      points = np.empty((2 * numberOfTeeth, 3))
+      points[0::2] = [entry[startKey] for cacheKey, entry in compactTeeth]
+      points[1::2] = [entry[endKey] for cacheKey, entry in compactTeeth]
+      vtkPoints = vtk.vtkPoints()
+      vtkPoints.SetData(numpy_support.numpy_to_vtk(points, deep=1))
+      connectivity = np.column_stack([np.full(numberOfTeeth, 2), np.arange(0, 2 * numberOfTeeth, 2),
+        np.arange(1, 2 * numberOfTeeth, 2)]).ravel().astype(numpy_support.ID_TYPE_CODE)
+      lines = vtk.vtkCellArray()
+      lines.SetCells(numberOfTeeth, numpy_support.numpy_to_vtkIdTypeArray(connectivity, deep=1))
+      polyData = vtk.vtkPolyData()
+      polyData.SetPoints(vtkPoints)
+      polyData.SetLines(lines)
+
+      toothIndex = numpy_support.numpy_to_vtk(np.arange(numberOfTeeth), deep=1, array_type=vtk.VTK_INT)
+      toothIndex.SetName("Tooth Index")
+      polyData.GetCellData().AddArray(toothIndex)
+      length = numpy_support.numpy_to_vtk(np.linalg.norm(points[1::2] - points[0::2], axis=1), deep=1)
+      length.SetName("Length (mm)")
+      polyData.GetCellData().SetScalars(length)
+      for arrayName, values in (("Segment ID", [cacheKey[1] for cacheKey, entry in compactTeeth]),
+        ("Tooth ID", [entry["toothKey"][3] for cacheKey, entry in compactTeeth])):
+        array = vtk.vtkStringArray()
+        array.SetName(arrayName)
+        array.SetNumberOfValues(numberOfTeeth)
+        for i, value in enumerate(values):
+          array.SetValue(i, value)
+        polyData.GetCellData().AddArray(array)
+
+      if not modelNode:
+        modelNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", modelName)
+        modelNode.CreateDefaultDisplayNodes()
+        modelNode.GetDisplayNode().SetColor(color)
+        modelNode.GetDisplayNode().SetLineWidth(3)
+        modelNode.GetDisplayNode().SetScalarVisibility(False)
+        shNode.SetItemParent(shNode.GetItemByDataNode(modelNode), folder)
+      modelNode.SetAndObservePolyData(polyData)
+
+  def editToothLines(self, teeth):
+    """
+    Create markups lines for compact teeth (see compactLines), so that they can be edited.
+    Their lines are removed from the compact models; later runs use the markups as for any other tooth.
+    :param teeth: list of (segmentation node, segment ID)
+    """
+    newFolder, posFolder, outFolder = self.getResultFolders()
+    for segmentationNode, segmentId in teeth:
+      entry = self.toothResultCache.get((segmentationNode.GetID(), segmentId))
+      if entry is None or not entry["compact"]:
+        continue
+      segmentName = segmentationNode.GetSegmentation().GetSegment(segmentId).GetName()
+      ToothPoslineNode = self.createToothLine(segmentName, entry["positionStartPoint"], entry["basePoint"], posFolder, True)
+      ToothOutlineNode = self.createToothLine(segmentName, entry["jointRAS"], entry["tipPoint"], outFolder, False)
+      self.setToothLines(segmentationNode, segmentId, ToothPoslineNode, ToothOutlineNode)
+      entry["compact"] = False
+    self.updateCompactToothLines()
+    self.updateResultFolderVisibility()
+
+  def showResultsTable(self, tableNode):
+    """
+    Switch to a 3D view + table layout showing the results table.
+    """
     customLayout = """
       <layout type=\"vertical\" split=\"true\" >
        <item splitSize=\"600\">
@@ -906,10 +2522,1005 @@ class FunctionalHomodontyLogic(ScriptedLoadableModuleLogic):
 #    slicer.app.applicationLogic().GetSelectionNode().SetReferenceActiveTableID(tableNode.GetID())
 #    slicer.app.applicationLogic().PropagateTableSelection()
 
-    logging.info('Processing completed')
-    
+  def measurePhase(self, name, tooth=None):
+    """
+    Context manager recording a phase of the current run, if the run is instrumented (see instrumentRuns).
+    :param tooth: name of the tooth the phase is about, if any
+    """
+    if self.runInstrumentation is None:
+      return contextlib.nullcontext()
+    return self.runInstrumentation.phase(name, tooth)
 
- 
+  @contextlib.contextmanager
+  @contextlib.contextmanager
+  def instrumentRun(self):
+    """
+    Context manager instrumenting a whole run if instrumentRuns or profileRuns is set.
+    The phases are written to the "FunctionalHomodonty Timing" table and, with the scene node counts
+    before and after the run, to the JSON log at instrumentationLogPath.
+    """
+    instrumentation = self.startRunInstrumentation()
+    completed = False
+    try:
+      with self.useRunInstrumentation(instrumentation):
+        yield
+      completed = True
+    finally:
+      self.stopRunInstrumentation(instrumentation, completed)
+
+  def startRunInstrumentation(self):
+    """
+    Start instrumenting a run if instrumentRuns or profileRuns is set, for runs whose steps are not in one block
+    (see startBackgroundRun). Each step is then run inside useRunInstrumentation, on whatever thread it runs.
+    :return: instrumentation of the run, None if the run is not instrumented
+    """
+    if not (self.instrumentRuns or self.profileRuns):
+      return None
+    instrumentation = RunInstrumentation(slicer.mrmlScene, self.profileRuns)
+    instrumentation.nodeCountsBefore = self.getSceneNodeCounts()
+    instrumentation.start()
+    return instrumentation
+
+  @contextlib.contextmanager
+  def useRunInstrumentation(self, instrumentation):
+    """
+    Context manager recording the phases of a step of an instrumented run (see measurePhase)
+    and profiling the step in its thread.
+    :param instrumentation: instrumentation from startRunInstrumentation, None if the run is not instrumented
+    """
+    if instrumentation is None:
+      yield
+      return
+    self.runInstrumentation = instrumentation
+    try:
+      with instrumentation.profile():
+        yield
+    finally:
+      self.runInstrumentation = None
+
+  def stopRunInstrumentation(self, instrumentation, write=True):
+    """
+    Stop instrumenting a run and, unless it failed or was cancelled, write its phases (see writeInstrumentation).
+    """
+    if instrumentation is None:
+      return
+    instrumentation.stop()
+    if write:
+      self.writeInstrumentation(instrumentation, instrumentation.nodeCountsBefore, self.getSceneNodeCounts())
+
+  def getSceneNodeCounts(self):
+    """
+    Number of scene nodes of each class.
+    """
+    counts = {}
+    for nodeIndex in range(slicer.mrmlScene.GetNumberOfNodes()):
+      className = slicer.mrmlScene.GetNthNode(nodeIndex).GetClassName()
+      counts[className] = counts.get(className, 0) + 1
+    return counts
+
+  def writeInstrumentation(self, instrumentation, nodeCountsBefore, nodeCountsAfter):
+    """
+    Show the phases of an instrumented run in the "FunctionalHomodonty Timing" table and write them to the JSON log.
+    A cProfile capture, merged over all threads of the run, is saved next to the log (.prof) and its top functions are logged.
+    """
+    import io
+    import json
+    import pstats
+    import time
+    import numpy as np
+
+    logPath = self.instrumentationLogPath or os.path.join(slicer.app.temporaryPath, "FunctionalHomodontyTiming.json")
+    records = instrumentation.getRecords()
+    log = {
+      "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+      "phases": records,
+      "sceneNodesBefore": nodeCountsBefore,
+      "sceneNodesAfter": nodeCountsAfter,
+      }
+    if instrumentation.profilers:
+      log["profile"] = os.path.splitext(logPath)[0] + ".prof"
+      stream = io.StringIO()
+      stats = pstats.Stats(*instrumentation.profilers, stream=stream)
+      stats.dump_stats(log["profile"])
+      stats.sort_stats("cumulative").print_stats(20)
+      logging.info(stream.getvalue())
+    with open(logPath, "w") as f:
+      json.dump(log, f, indent=2)
+    logging.info('Run instrumentation written to ' + logPath)
+
+    timingTableNode = slicer.util.getFirstNodeByClassByName("vtkMRMLTableNode", "FunctionalHomodonty Timing")
+    if timingTableNode is None:
+      timingTableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode", "FunctionalHomodonty Timing")
+    self.writeResultsTable(timingTableNode, {
+      "Phase": [record["phase"] for record in records],
+      "Tooth": [record["tooth"] or "" for record in records],
+      "Calls": np.array([record["calls"] for record in records], dtype=float),
+      "Time (s)": np.array([record["time"] for record in records]),
+      "Peak Memory (MB)": np.array([record["peakMemoryMB"] for record in records]),
+      "Nodes Added": np.array([record["nodesAdded"] for record in records], dtype=float),
+      }, columns=self.instrumentationColumns)
+
+  def readDentitionStoreIndex(self, storeDirectory):
+    """
+    Read the index of a dentition store, or None if the store does not exist yet.
+    The index lists the columns (name, "numeric" or "text" type and text categories) and the chunks of rows.
+    Each chunk is a directory with one .npy file per column it has, and lists the contiguous row range
+    [start, stop) of each of its (species, jaw ID, side of face) groups that is still part of the store.
+    """
+    import json
+    indexPath = os.path.join(storeDirectory, "index.json")
+    if not os.path.exists(indexPath):
+      return None
+    with open(indexPath) as f:
+      index = json.load(f)
+    if index.get("version") != 2:
+      raise ValueError("Unsupported dentition store version in " + indexPath + ", import the dentitions into a new store")
+    return index
+
+  def writeDentitionStoreIndex(self, storeDirectory, index):
+    """
+    Replace the index of a dentition store in one step, so that readers see either the old or the new store.
+    """
+    import json
+    indexPath = os.path.join(storeDirectory, "index.json")
+    with open(indexPath + ".tmp", "w") as f:
+      json.dump(index, f)
+    os.replace(indexPath + ".tmp", indexPath)
+
+  def readDentitionStore(self, storeDirectory, species=None, jawID=None, columns=None):
+    """
+    Read rows of a dentition store. Columns are memory-mapped, so only the rows of the requested
+    species and jaw are read from disk. Rows come chunk by chunk, sorted by species, jaw ID and side within a chunk.
+    :param species: read only this species (default: all)
+    :param jawID: read only this jaw ID (default: all)
+    :param columns: names of the columns to read (default: all)
+    :return: dictionary of column name to values: NumPy arrays for numeric columns, lists for text columns
+    """
+    import numpy as np
+
+    index = self.readDentitionStoreIndex(storeDirectory)
+    if index is None:
+      return {}
+    chunkRanges = []
+    for chunk in index["chunks"]:
+      ranges = [(start, stop) for groupSpecies, groupJawID, groupSide, start, stop in chunk["groups"]
+        if (species is None or groupSpecies == species) and (jawID is None or groupJawID == jawID)]
+      if ranges:
+        chunkRanges.append((chunk, ranges))
+    results = {}
+    for columnIndex, column in enumerate(index["columns"]):
+      if columns is not None and column["name"] not in columns:
+        continue
+      isText = column["type"] == "text"
+      parts = [np.empty(0, dtype=np.int32 if isText else float)]
+      for chunk, ranges in chunkRanges:
+        if columnIndex in chunk["columns"]:
+          data = np.load(os.path.join(storeDirectory, chunk["directory"], "column{0:03d}.npy".format(columnIndex)), mmap_mode="r")
+          parts.extend(data[start:stop] for start, stop in ranges)
+        else:
+          # column added after this chunk was written
+          numberOfRows = sum(stop - start for start, stop in ranges)
+          parts.append(np.full(numberOfRows, -1, dtype=np.int32) if isText else np.full(numberOfRows, np.nan))
+      data = np.concatenate(parts)
+      if isText:
+        # code -1 is a missing value
+        results[column["name"]] = list(np.array(column["categories"] + ["NA"], dtype=object)[data])
+      else:
+        results[column["name"]] = data
+    return results
+
+  def writeDentitionStore(self, storeDirectory, results, replaceJaws=True):
+    """
+    Add rows to a columnar dentition store (created if needed). The rows are written as a new chunk:
+    numeric columns as NumPy arrays and text columns as codes of categories kept in the index, one .npy file
+    per column, with rows sorted by species, jaw ID and side so that each group can be read on its own
+    (see readDentitionStore). Stored data is never rewritten, so a write costs as much as its own rows;
+    replaced rows are only dropped from the index. The store is compacted (see compactDentitionStore) once
+    dropped rows outnumber the stored ones or there are more than dentitionStoreMaxChunks chunks.
+    The index is switched to the new chunk at the end.
+    :param results: dictionary of column name to per-tooth values: NumPy arrays for numeric columns,
+      lists of text otherwise (as in writeResultsTable). Names are matched to stored columns ignoring case.
+    :param replaceJaws: remove stored rows of the jaws (species, jaw and side) that are written now
+    """
+    import shutil
+
+    index = self.readDentitionStoreIndex(storeDirectory) or {"version": 2, "nextChunk": 0, "columns": [], "chunks": []}
+    removedChunks = []
+    if replaceJaws and results:
+      numberOfNewRows = len(next(iter(results.values())))
+      keys = [results.get(name, ["NA"] * numberOfNewRows) for name in self.resultKeyColumns]
+      newJawKeys = set((str(species), str(jawID), str(side)) for species, jawID, side in zip(*keys))
+      for chunk in index["chunks"]:
+        chunk["groups"] = [group for group in chunk["groups"] if tuple(group[:3]) not in newJawKeys]
+      removedChunks = [chunk for chunk in index["chunks"] if not chunk["groups"]]
+      index["chunks"] = [chunk for chunk in index["chunks"] if chunk["groups"]]
+
+    os.makedirs(storeDirectory, exist_ok=True)
+    self.writeDentitionChunk(storeDirectory, index, results)
+    self.writeDentitionStoreIndex(storeDirectory, index)
+    # readers may still have removed chunks mapped, they are then removed by a later write
+    for chunk in removedChunks:
+      shutil.rmtree(os.path.join(storeDirectory, chunk["directory"]), ignore_errors=True)
+
+    storedRows = sum(chunk["rows"] for chunk in index["chunks"])
+    liveRows = sum(stop - start for chunk in index["chunks"] for groupSpecies, groupJawID, groupSide, start, stop in chunk["groups"])
+    if storedRows - liveRows > liveRows or len(index["chunks"]) > self.dentitionStoreMaxChunks:
+      self.compactDentitionStore(storeDirectory)
+
+  def writeDentitionChunk(self, storeDirectory, index, results):
+    """
+    Write rows as a new chunk of a dentition store and add it to the index (which is not saved here).
+    """
+    import numpy as np
+
+    def isNumeric(values):
+      return isinstance(values, np.ndarray) and values.dtype.kind in "biuf"
+
+    numberOfRows = len(next(iter(results.values()))) if results else 0
+    if numberOfRows == 0:
+      return
+    species = np.array([str(value) for value in results.get("Species", ["NA"] * numberOfRows)])
+    jawIDs = np.array([str(value) for value in results.get("Jaw ID", ["NA"] * numberOfRows)])
+    sides = np.array([str(value) for value in results.get("Side of Face", ["NA"] * numberOfRows)])
+    order = np.lexsort((sides, jawIDs, species))
+    species, jawIDs, sides = species[order], jawIDs[order], sides[order]
+    groupStarts = np.flatnonzero(np.r_[True, (species[1:] != species[:-1]) | (jawIDs[1:] != jawIDs[:-1]) | (sides[1:] != sides[:-1])])
+    groupStops = np.r_[groupStarts[1:], numberOfRows]
+
+    chunk = {
+      "directory": "chunk-{0:06d}".format(index["nextChunk"]),
+      "rows": numberOfRows,
+      "columns": [],
+      "groups": [[species[start], jawIDs[start], sides[start], int(start), int(stop)] for start, stop in zip(groupStarts, groupStops)],
+      }
+    chunkDirectory = os.path.join(storeDirectory, chunk["directory"])
+    os.makedirs(chunkDirectory, exist_ok=True)
+    columnIndices = {column["name"].lower(): columnIndex for columnIndex, column in enumerate(index["columns"])}
+    for name, values in results.items():
+      columnIndex = columnIndices.get(name.lower())
+      if columnIndex is None:
+        columnIndex = columnIndices[name.lower()] = len(index["columns"])
+        index["columns"].append({"name": name, "type": "numeric" if isNumeric(values) else "text"})
+        if not isNumeric(values):
+          index["columns"][columnIndex]["categories"] = []
+      column = index["columns"][columnIndex]
+      if column["type"] == "numeric" and isNumeric(values):
+        data = np.asarray(values, dtype=float)
+      elif column["type"] == "numeric":
+        data = np.full(numberOfRows, np.nan)
+        for i, value in enumerate(values):
+          try:
+            data[i] = float(value)
+          except ValueError:
+            pass
+      else:
+        values = ["NA" if isinstance(value, float) and np.isnan(value) else str(value) for value in values]
+        categoryCodes = {category: code for code, category in enumerate(column["categories"])}
+        for value in dict.fromkeys(values):
+          if value not in categoryCodes:
+            categoryCodes[value] = len(column["categories"])
+            column["categories"].append(value)
+        data = np.array([categoryCodes[value] for value in values], dtype=np.int32)
+      np.save(os.path.join(chunkDirectory, "column{0:03d}.npy".format(columnIndex)), data[order])
+      chunk["columns"].append(columnIndex)
+    index["chunks"].append(chunk)
+    index["nextChunk"] += 1
+
+  def compactDentitionStore(self, storeDirectory):
+    """
+    Rewrite the rows of a dentition store as a single chunk, dropping replaced rows.
+    """
+    import shutil
+
+    index = self.readDentitionStoreIndex(storeDirectory)
+    if index is None:
+      return
+    results = self.readDentitionStore(storeDirectory)
+    oldChunks = index["chunks"]
+    index["chunks"] = []
+    self.writeDentitionChunk(storeDirectory, index, results)
+    self.writeDentitionStoreIndex(storeDirectory, index)
+    for chunk in oldChunks:
+      shutil.rmtree(os.path.join(storeDirectory, chunk["directory"]), ignore_errors=True)
+
+  def importDentitionCSV(self, storeDirectory, csvPath):
+    """
+    Add the rows of a dentition CSV file (such as master_dentition.csv) to a dentition store.
+    Headers are matched to the result columns ignoring case and surrounding spaces (e.g. "Jaw length (mm)" is stored
+    as "Jaw Length (mm)"), so that imported rows and rows of later runs share their columns.
+    Columns whose values are all numbers (or NA) are stored as numeric columns, except text result columns
+    such as Tooth ID.
+    """
+    import csv
+    import numpy as np
+
+    with open(csvPath, newline="") as f:
+      header = next(csv.reader(f))
+    resultColumnNames = {name.lower(): name for name, description, unit, isText in self.resultColumns}
+    names = [resultColumnNames.get(name.strip().lower(), name.strip()) for name in header]
+    for i, name in enumerate(names):
+      if name.lower() in [otherName.lower() for otherName in names[:i]]:
+        raise ValueError("Column \"" + header[i] + "\" of " + csvPath + " is a duplicate of another column")
+
+    textColumns = [name for name, description, unit, isText in self.resultColumns if isText]
+    results = {}
+    for name, values in zip(names, self.readDentitionColumns(csvPath).values()):
+      if name in textColumns:
+        results[name] = values
+        continue
+      numbers = np.full(len(values), np.nan)
+      for i, value in enumerate(values):
+        if value in ("", "NA"):
+          continue
+        try:
+          numbers[i] = float(value)
+        except ValueError:
+          numbers = values
+          break
+      results[name] = numbers
+    self.writeDentitionStore(storeDirectory, results)
+
+  def readDentitionColumns(self, source):
+    """
+    Read all columns of a results table node, a dentition store or a dentition CSV file (such as master_dentition.csv).
+    :param source: vtkMRMLTableNode, dentition store directory or path of a CSV file
+    :return: dictionary of column name to list of values (as text), or NumPy array for numeric columns of a store
+    """
+    if isinstance(source, str) and os.path.isdir(source):
+      return self.readDentitionStore(source)
+    if isinstance(source, str):
+      import csv
+      with open(source, newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = [row for row in reader if row]
+      return {name: [row[i] if i < len(row) else "" for row in rows] for i, name in enumerate(header)}
+
+    table = source.GetTable()
+    columns = {}
+    for columnIndex in range(table.GetNumberOfColumns()):
+      column = table.GetColumn(columnIndex)
+      columns[column.GetName()] = [str(column.GetVariantValue(i).ToString()) for i in range(table.GetNumberOfRows())]
+    return columns
+
+  def findDentitionColumn(self, columns, pattern, column=None):
+    """
+    Find the name of the column that contains the given pattern (case insensitive), like get_column() in
+    bootstrap_median_residuals.R.
+    :param column: column name or 0-based column index to use instead of searching
+    """
+    names = list(columns.keys())
+    if column is not None:
+      return names[column] if isinstance(column, int) else column
+    matches = [name for name in names if pattern in name.lower()]
+    if len(matches) != 1:
+      raise ValueError("Cannot identify the " + pattern + " column, found: " + str(matches))
+    return matches[0]
+
+  def readDentitions(self, source, stressColumn=None, positionColumn=None, jawLengthColumn=None):
+    """
+    Split a results table or dentition CSV file into dentitions (combinations of species and jaw)
+    and compute median-normalized stress, position as % of jaw length and median residuals of each tooth.
+    :param source: vtkMRMLTableNode, dentition store directory or path of a CSV file
+    :param stressColumn: name or 0-based index of the stress column (default: the column containing "stress")
+    :param positionColumn: name or 0-based index of the position column (default: the column containing "position")
+    :param jawLengthColumn: name or 0-based index of the jaw length column (default: the column containing "length")
+    :return: list of dentition dictionaries with "species", "jawID" and per-tooth arrays "stress",
+      "stressNorm", "positionNorm" and "residuals"
+    """
+    import numpy as np
+
+    columns = self.readDentitionColumns(source)
+    stressName = self.findDentitionColumn(columns, "stress", stressColumn)
+    positionName = self.findDentitionColumn(columns, "position", positionColumn)
+    jawLengthName = self.findDentitionColumn(columns, "length", jawLengthColumn)
+
+    def toFloat(values):
+      if isinstance(values, np.ndarray) and values.dtype.kind == "f":
+        return values
+      numbers = np.full(len(values), np.nan)
+      for i, value in enumerate(values):
+        try:
+          numbers[i] = float(value)
+        except ValueError:
+          pass
+      return numbers
+
+    species = np.array(columns["Species"])
+    jawIDs = np.array(columns["Jaw ID"])
+    stress = toFloat(columns[stressName])
+    position = toFloat(columns[positionName])
+    jawLength = toFloat(columns[jawLengthName])
+    # remove NA rows
+    valid = ~(np.isnan(stress) | np.isnan(position) | np.isnan(jawLength))
+
+    dentitions = []
+    dentitionKeys = list(dict.fromkeys(zip(columns["Species"], columns["Jaw ID"])))
+    for dentitionSpecies, dentitionJawID in dentitionKeys:
+      rows = np.flatnonzero((species == dentitionSpecies) & (jawIDs == dentitionJawID) & valid)
+      if len(rows) == 0:
+        continue
+      # generate median-normalized stress values
+      stressNorm = stress[rows] / np.median(stress[rows])
+      dentitions.append({
+        "species": dentitionSpecies,
+        "jawID": dentitionJawID,
+        "rows": rows,
+        "stress": stress[rows],
+        "stressNorm": stressNorm,
+        # generate position as a proportion of jaw length
+        "positionNorm": position[rows] / jawLength[rows] * 100,
+        # calculate median residuals
+        "residuals": stressNorm - np.median(stressNorm),
+        })
+    return dentitions
+
+  def getBootstrapSampling(self, numberOfTeeth, bootstraps, dentitionSubsample):
+    """
+    Number of teeth drawn per replicate and number of replicates of a dentition, so that each dentition
+    contributes about the same number of residuals whatever its number of teeth.
+    """
+    import numpy as np
+    # figure out how many teeth to use each time (rounded half to even, as in R)
+    sampleSize = int(np.round(dentitionSubsample * numberOfTeeth))
+    if sampleSize == 0:
+      return 0, 0
+    return sampleSize, int(np.round(bootstraps / sampleSize))
+
+  def bootstrapDentitionResiduals(self, stressNorm, bootstraps, dentitionSubsample, rng):
+    """
+    Bootstrapped median residuals of one dentition. All replicates are drawn at once as a 2-D index matrix
+    (one row per replicate, sampled without replacement) and reduced with a vectorized median.
+    :param stressNorm: median-normalized stress of each tooth
+    :param rng: numpy.random.Generator
+    :return: 1-D array of residuals of all replicates
+    """
+    sampleSize, replicates = self.getBootstrapSampling(len(stressNorm), bootstraps, dentitionSubsample)
+    return bootstrapResiduals(stressNorm, sampleSize, replicates, rng)
+
+  def twoClusterCutoff(self, values, weights=None):
+    """
+    Cutoff between two clusters of 1-D values: the mean of the two k-means centers.
+    The optimal split of the sorted values is found exactly from prefix sums instead of random-start k-means.
+    :param weights: optional weight (count) of each value
+    """
+    import numpy as np
+
+    values = np.asarray(values, dtype=float).ravel()
+    weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=float).ravel()
+    order = np.argsort(values, kind="stable")
+    values = values[order]
+    weights = weights[order]
+    if len(values) == 0:
+      return np.nan
+    if values[0] == values[-1]:
+      return values[0]
+
+    # center the values to limit round-off in the sums of squares
+    shift = np.average(values, weights=weights)
+    centered = values - shift
+    leftWeight = np.cumsum(weights)[:-1]
+    leftSum = np.cumsum(weights * centered)[:-1]
+    leftSquares = np.cumsum(weights * centered**2)[:-1]
+    rightWeight = weights.sum() - leftWeight
+    rightSum = np.sum(weights * centered) - leftSum
+    rightSquares = np.sum(weights * centered**2) - leftSquares
+    with np.errstate(divide="ignore", invalid="ignore"):
+      withinSquares = (leftSquares - leftSum**2 / leftWeight) + (rightSquares - rightSum**2 / rightWeight)
+    # only split between distinct values and between non-empty clusters
+    withinSquares[(values[:-1] == values[1:]) | (leftWeight <= 0) | (rightWeight <= 0)] = np.inf
+    split = np.argmin(withinSquares)
+    centers = (leftSum[split] / leftWeight[split], rightSum[split] / rightWeight[split])
+    return shift + 0.5 * (centers[0] + centers[1])
+
+  def weightedQuantile(self, values, weights, q):
+    """
+    Quantile of values repeated weights times, interpolated between order statistics as numpy.quantile does.
+    """
+    import numpy as np
+
+    values = np.asarray(values, dtype=float).ravel()
+    weights = np.asarray(weights, dtype=float).ravel()
+    order = np.argsort(values, kind="stable")
+    values = values[order]
+    cumulative = np.cumsum(weights[order])
+    if len(values) == 0 or cumulative[-1] <= 0:
+      return np.nan
+    position = q * (cumulative[-1] - 1)
+    lower = np.floor(position)
+    ranks = np.minimum([lower, lower + 1], cumulative[-1] - 1)
+    lowerValue, upperValue = values[np.minimum(np.searchsorted(cumulative, ranks, side="right"), len(values) - 1)]
+    return lowerValue + (upperValue - lowerValue) * (position - lower)
+
+  def residualCutoffs(self, residuals, weights=None):
+    """
+    Homodonty cutoffs from bootstrapped residuals: standard deviation, k-means and 95% quantile
+    of the absolute residuals.
+    :param weights: optional weight (replicate count) of each residual, as returned by the exact bootstrap
+    """
+    import numpy as np
+
+    residuals = np.asarray(residuals, dtype=float)
+    absResiduals = np.abs(residuals)
+    if weights is None:
+      return {
+        "sd": np.std(residuals, ddof=1),
+        "kmeans": self.twoClusterCutoff(absResiduals),
+        "q95": np.quantile(absResiduals, 0.95),
+        }
+    weights = np.asarray(weights, dtype=float)
+    totalWeight = weights.sum()
+    mean = np.sum(weights * residuals) / totalWeight
+    return {
+      "sd": np.sqrt(np.sum(weights * (residuals - mean)**2) / (totalWeight - 1)),
+      "kmeans": self.twoClusterCutoff(absResiduals, weights),
+      "q95": self.weightedQuantile(absResiduals, weights, 0.95),
+      }
+
+  def residualSketchCutoffs(self, sketch):
+    """
+    Homodonty cutoffs from a ResidualSketch instead of the residuals themselves.
+    The standard deviation is exact; the k-means split is made between histogram bins (each bin weighted by its count
+    at the mean of its values) and the 95% quantile is interpolated within its bin, both within sketch.binWidth.
+    """
+    binMeans, binCounts = sketch.binnedValues()
+    return {
+      "sd": sketch.std(),
+      "kmeans": self.twoClusterCutoff(binMeans, binCounts),
+      "q95": sketch.quantile(0.95),
+      "cutoffError": sketch.binWidth,
+      }
+
+  def bootstrapMedianResiduals(self, source, bootstraps=10e3, dentitionSubsample=0.5,
+    stressColumn=None, positionColumn=None, jawLengthColumn=None, seed=None, workers=1, streaming=False, sketchBins=2**14,
+    exact=False, exactLimit=200000):
+    """
+    Empirical cutoffs for functional homodonty, as bootstrap_median_residuals() in bootstrap_median_residuals.R.
+    Each dentition is subsampled (without replacement) bootstraps / sample size times and the residuals of the
+    median-normalized stress from the subsample median are pooled over all dentitions.
+    Every dentition draws from its own random stream, spawned from the master seed in dentition order,
+    so the result is bit-identical whatever the number of workers.
+    :param source: results vtkMRMLTableNode, dentition store directory, dentition CSV file path or list of dentitions from readDentitions
+    :param bootstraps: number of bootstrapped teeth per dentition
+    :param dentitionSubsample: proportion of teeth of a dentition sampled in each replicate
+    :param seed: master seed (default: fresh entropy, returned as "seed" so that the run can be repeated)
+    :param workers: number of worker threads the dentitions are spread over (None: number of CPU cores)
+    :param streaming: fold the residuals into a constant-memory ResidualSketch instead of keeping them all.
+      "bootstrappedResiduals" is then None and the sketch is returned as "sketch"; see residualSketchCutoffs.
+    :param sketchBins: number of histogram bins of the sketch in streaming mode. Sketches with the same number of
+      bins can be merged, also across runs (see ResidualSketch.merge).
+    :param exact: instead of sampling, compute the exact residual distribution over all subsamples in closed form
+      (see exactMedianResiduals), for dentitions whose distribution has at most exactLimit distinct
+      (tooth, median) combinations: n^2 for an odd sample size, n^3 for an even one.
+      The dentition keeps the weight of its replicates, and the weights are returned as "residualWeights"
+      (None when sampling only).
+    :return: dictionary with "bootstrappedResiduals", cutoffs "sd", "kmeans" and "q95", "originalTeeth" (the dentitions)
+      and "seed"
+    """
+    import numpy as np
+
+    dentitions = source if isinstance(source, list) else self.readDentitions(source, stressColumn, positionColumn, jawLengthColumn)
+    seedSequence = np.random.SeedSequence(seed)
+    tasks = []
+    for dentition, dentitionSeed in zip(dentitions, seedSequence.spawn(len(dentitions))):
+      numberOfTeeth = len(dentition["stressNorm"])
+      sampleSize, replicates = self.getBootstrapSampling(numberOfTeeth, bootstraps, dentitionSubsample)
+      exactSupport = numberOfTeeth**2 if sampleSize % 2 else numberOfTeeth**3
+      tasks.append((dentition["stressNorm"], sampleSize, replicates, dentitionSeed, exact and replicates > 0 and exactSupport <= exactLimit))
+
+    if streaming:
+      # |residual| never exceeds the range of normalized stress within a dentition; all group sketches start with
+      # the same range, so none of them is widened and the result does not depend on the grouping
+      maxAbsResidual = max([np.ptp(task[0]) for task in tasks if len(task[0])] + [0.0])
+      # groups of dentitions do not depend on the number of workers, so neither does the merge order
+      groupSize = 64
+      groups = [(tasks[i:i + groupSize], maxAbsResidual, sketchBins) for i in range(0, len(tasks), groupSize)]
+      sketch = ResidualSketch(maxAbsResidual, sketchBins)
+      for groupSketch in self.mapBootstrapTasks(bootstrapSketchTask, groups, workers):
+        sketch.merge(groupSketch)
+      results = {"bootstrappedResiduals": None, "sketch": sketch, "originalTeeth": dentitions, "seed": seedSequence.entropy}
+      results.update(self.residualSketchCutoffs(sketch))
+      return results
+
+    dentitionResiduals = list(self.mapBootstrapTasks(bootstrapResidualsTask, tasks, workers))
+    residuals = np.concatenate([np.empty(0)] + [residuals for residuals, weights in dentitionResiduals])
+    weights = None
+    if any(weights is not None for residuals, weights in dentitionResiduals):
+      weights = np.concatenate([np.empty(0)] + [np.ones(len(residuals)) if weights is None else weights
+        for residuals, weights in dentitionResiduals])
+
+    results = {"bootstrappedResiduals": residuals, "residualWeights": weights, "originalTeeth": dentitions,
+      "seed": seedSequence.entropy}
+    results.update(self.residualCutoffs(residuals, weights))
+    return results
+
+  def mapBootstrapTasks(self, function, tasks, workers):
+    """
+    Run function on each of the tasks, in a worker pool if more than one worker is requested.
+    Results are yielded in task order.
+    """
+    if workers is None or workers > 1:
+      with self.createBootstrapExecutor(workers) as executor:
+        for result in executor.map(function, tasks):
+          yield result
+    else:
+      for task in tasks:
+        yield function(task)
+
+  def createBootstrapExecutor(self, workers):
+    """
+    Pool of worker threads for the bootstrap, as for the lean statistics. Forking the Slicer process is unsafe
+    (its Qt and VTK threads are not copied) and spawned processes would have to start Slicer to import this module,
+    while the bootstrap spends most of its time in NumPy sorts and medians that release the GIL.
+    :param workers: number of workers (default: number of CPU cores)
+    """
+    import concurrent.futures
+    return concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+
+#
+# Bootstrap helpers, run by the worker threads of mapBootstrapTasks
+#
+
+def bootstrapResiduals(stressNorm, sampleSize, replicates, rng):
+  """
+  Median residuals of replicates subsamples of sampleSize teeth drawn without replacement.
+  The replicates are drawn as one 2-D index matrix and reduced with a row-wise median.
+  """
+  import numpy as np
+
+  stressNorm = np.asarray(stressNorm, dtype=float)
+  if replicates == 0:
+    return np.empty(0)
+  indices = rng.permuted(np.tile(np.arange(len(stressNorm)), (replicates, 1)), axis=1)[:, :sampleSize]
+  sampled = stressNorm[indices]
+  return (sampled - np.median(sampled, axis=1, keepdims=True)).ravel()
+
+def bootstrapSketchTask(task):
+  """
+  Bootstrap a group of dentitions in a worker and fold their residuals into one ResidualSketch.
+  Replicates are generated in blocks so that memory stays bounded however many are requested.
+  :param task: tuple of a list of bootstrapResidualsTask tasks, the sketch range and its number of bins
+  """
+  import numpy as np
+  dentitionTasks, maxAbsResidual, bins = task
+  sketch = ResidualSketch(maxAbsResidual, bins)
+  for stressNorm, sampleSize, replicates, seedSequence, exact in dentitionTasks:
+    if exact:
+      sketch.add(*exactMedianResiduals(stressNorm, sampleSize, replicates))
+      continue
+    rng = np.random.default_rng(seedSequence)
+    blockSize = max(1, 2**20 // max(sampleSize, 1))
+    for start in range(0, replicates, blockSize):
+      sketch.add(bootstrapResiduals(stressNorm, sampleSize, min(blockSize, replicates - start), rng))
+  return sketch
+
+def exactMedianResiduals(stressNorm, sampleSize, replicates):
+  """
+  Exact residual distribution of a dentition: the median residuals of all subsamples of sampleSize teeth,
+  computed in closed form from order statistics instead of enumerating the subsamples.
+  With the teeth sorted, the number of subsamples in which tooth i is drawn and the median is tooth m
+  (odd sample size), or the mean of teeth a < b (even sample size), is a product of binomial coefficients
+  counting the teeth drawn below and above the median, so only the n^2 (tooth, median) pairs or
+  n^3 (tooth, a, b) triples are visited.
+  Every subsample gets weight replicates / number of subsamples, as if each was drawn equally often.
+  :return: distinct residuals and their weights
+  """
+  import math
+  import numpy as np
+
+  x = np.sort(np.asarray(stressNorm, dtype=float))
+  n = len(x)
+  k = sampleSize
+  logFactorial = np.array([math.lgamma(i + 1) for i in range(n + 1)])
+
+  def logComb(a, b):
+    # log of the binomial coefficient, -inf where it is 0
+    a, b = np.broadcast_arrays(np.asarray(a), np.asarray(b))
+    valid = (b >= 0) & (b <= a)
+    a, b = np.where(valid, a, 0), np.where(valid, b, 0)
+    return np.where(valid, logFactorial[a] - logFactorial[b] - logFactorial[a - b], -np.inf)
+
+  logSubsamples = logComb(n, k)
+  if k % 2:
+    h = k // 2
+    i, m = np.meshgrid(np.arange(n), np.arange(n), indexing="ij")
+    # tooth i drawn with median m: h-1 more teeth below m and h above, or h below and h-1 more above
+    logCounts = np.where(i < m, logComb(m - 1, h - 1) + logComb(n - 1 - m, h),
+      np.where(i > m, logComb(m, h) + logComb(n - 2 - m, h - 1), logComb(m, h) + logComb(n - 1 - m, h)))
+    residuals = x[i] - x[m]
+  else:
+    h = k // 2
+    i, a, b = np.meshgrid(np.arange(n), np.arange(n), np.arange(n), indexing="ij")
+    # median teeth a < b: h-1 teeth drawn below a, h-1 above b and none in between
+    logCounts = np.where(i < a, logComb(a - 1, h - 2) + logComb(n - 1 - b, h - 1),
+      np.where(i > b, logComb(a, h - 1) + logComb(n - 2 - b, h - 2),
+      np.where((i == a) | (i == b), logComb(a, h - 1) + logComb(n - 1 - b, h - 1), -np.inf)))
+    logCounts = np.where(a < b, logCounts, -np.inf)
+    residuals = x[i] - (x[a] + x[b]) / 2
+  drawn = np.isfinite(logCounts)
+  weights = np.exp(logCounts[drawn] - logSubsamples) * replicates
+  residuals, inverse = np.unique(residuals[drawn], return_inverse=True)
+  return residuals, np.bincount(inverse.ravel(), weights=weights, minlength=len(residuals))
+
+def bootstrapResidualsTask(task):
+  """
+  Bootstrap one dentition in a worker, with the random stream given by its seed sequence,
+  or compute its exact residual distribution when exact is set.
+  :param task: tuple of median-normalized stress, sample size, number of replicates, numpy.random.SeedSequence
+    and exact
+  :return: residuals and their weights (None for sampled residuals)
+  """
+  import numpy as np
+  stressNorm, sampleSize, replicates, seedSequence, exact = task
+  if exact:
+    return exactMedianResiduals(stressNorm, sampleSize, replicates)
+  return bootstrapResiduals(stressNorm, sampleSize, replicates, np.random.default_rng(seedSequence)), None
+
+class ResidualSketch:
+  """
+  Constant-memory summary of bootstrapped residuals that can be merged across workers, runs and machines.
+  Mean and variance are accumulated exactly (Chan et al. pairwise update); absolute residuals are counted
+  in a histogram that also keeps the sum of the values in each bin.
+  The histogram range is a power of two, widened by powers of two when larger residuals come in: the bins of a
+  narrower range then nest exactly in the bins of the wider one, so sketches with the same number of bins merge
+  whatever their ranges (at the resolution of the widest).
+  """
+
+  def __init__(self, maxAbsResidual=1.0, bins=2**14):
+    """
+    :param maxAbsResidual: largest absolute residual expected, rounded up to a power of two
+    """
+    import numpy as np
+    self.maxAbsResidual = 2.0 ** np.ceil(np.log2(maxAbsResidual)) if maxAbsResidual > 0 else 1.0
+    self.bins = int(bins)
+    self.binWidth = self.maxAbsResidual / self.bins
+    self.count = 0
+    self.mean = 0.0
+    self.m2 = 0.0
+    self.binCounts = np.zeros(self.bins)
+    self.binSums = np.zeros(self.bins)
+
+  def widen(self, maxAbsResidual):
+    """
+    Widen the histogram range by a power of two so that it covers maxAbsResidual, merging the bins that fall
+    into each wider bin.
+    """
+    import numpy as np
+    if maxAbsResidual <= self.maxAbsResidual:
+      return
+    factor = int(2.0 ** np.ceil(np.log2(maxAbsResidual / self.maxAbsResidual)))
+    index = np.arange(self.bins) // factor
+    self.binCounts = np.bincount(index, weights=self.binCounts, minlength=self.bins)
+    self.binSums = np.bincount(index, weights=self.binSums, minlength=self.bins)
+    self.maxAbsResidual *= factor
+    self.binWidth = self.maxAbsResidual / self.bins
+
+  def combineMoments(self, count, mean, m2):
+    total = self.count + count
+    delta = mean - self.mean
+    self.mean += delta * count / total
+    self.m2 += m2 + delta**2 * self.count * count / total
+    self.count = total
+
+  def add(self, residuals, weights=None):
+    import numpy as np
+    residuals = np.asarray(residuals, dtype=float).ravel()
+    weights = np.ones(len(residuals)) if weights is None else np.asarray(weights, dtype=float).ravel()
+    if len(residuals) == 0:
+      return
+    batchCount = weights.sum()
+    batchMean = np.sum(weights * residuals) / batchCount
+    self.combineMoments(batchCount, batchMean, np.sum(weights * (residuals - batchMean)**2))
+    absResiduals = np.abs(residuals)
+    self.widen(absResiduals.max())
+    index = np.minimum((absResiduals / self.binWidth).astype(np.int64), self.bins - 1)
+    self.binCounts += np.bincount(index, weights=weights, minlength=self.bins)
+    self.binSums += np.bincount(index, weights=weights * absResiduals, minlength=self.bins)
+
+  def merge(self, other):
+    """
+    Add the residuals of another sketch with the same number of bins, widening the range of either to the wider one.
+    The other sketch is not changed.
+    """
+    import copy
+    if other.bins != self.bins:
+      raise ValueError("Cannot merge residual sketches with different numbers of bins")
+    if other.count == 0:
+      return
+    if other.maxAbsResidual < self.maxAbsResidual:
+      other = copy.deepcopy(other)
+      other.widen(self.maxAbsResidual)
+    self.widen(other.maxAbsResidual)
+    self.combineMoments(other.count, other.mean, other.m2)
+    self.binCounts += other.binCounts
+    self.binSums += other.binSums
+
+  def std(self):
+    import numpy as np
+    return np.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else np.nan
+
+  def quantile(self, q):
+    """
+    Quantile of the absolute residuals (linear interpolation between order statistics, as numpy.quantile),
+    assuming the values are spread evenly within their bin.
+    """
+    import numpy as np
+    if self.count == 0:
+      return np.nan
+    position = q * (self.count - 1)
+    cumulative = np.cumsum(self.binCounts)
+    binIndex = int(np.searchsorted(cumulative, position, side="right"))
+    below = cumulative[binIndex] - self.binCounts[binIndex]
+    return self.binWidth * (binIndex + (position - below + 0.5) / self.binCounts[binIndex])
+
+  def binnedValues(self):
+    """
+    Mean absolute residual and count of every non-empty bin.
+    """
+    occupied = self.binCounts > 0
+    return self.binSums[occupied] / self.binCounts[occupied], self.binCounts[occupied]
+
+class BackgroundRun:
+  """
+  Work running in a worker thread, with progress reporting and cancellation.
+  The worker function receives this object and calls reportProgress before each step; it must return
+  when reportProgress returns False (cancel requested).
+  """
+
+  def __init__(self, work, arguments=()):
+    self.work = work
+    self.arguments = arguments  # kept for finishing the run on the main thread
+    self.result = None  # return value of the work function
+    self.error = None
+    self.invalidReason = None  # why the inputs of the run are no longer valid, see invalidate
+    self.observations = []  # (object, observer tag) of the inputs watched during the run
+    self.instrumentation = None  # RunInstrumentation of the run, if it is instrumented
+    self.lock = threading.Lock()
+    self.cancelRequested = threading.Event()
+    self.completed = -1
+    self.total = 0
+    self.message = ""
+    self.thread = threading.Thread(target=self.execute, daemon=True)
+
+  def start(self):
+    self.thread.start()
+
+  def execute(self):
+    try:
+      self.result = self.work(self)
+    except Exception as e:
+      import traceback
+      traceback.print_exc()
+      self.error = e
+
+  def setTotal(self, total):
+    with self.lock:
+      self.total = total
+
+  def reportProgress(self, message):
+    """
+    Start the next step. Called from the worker thread.
+    :return: False if the run should stop
+    """
+    with self.lock:
+      self.completed = min(self.completed + 1, self.total)
+      self.message = message
+    return not self.cancelRequested.is_set()
+
+  def getProgress(self):
+    """
+    :return: number of completed steps, total number of steps and current step message
+    """
+    with self.lock:
+      return max(self.completed, 0), self.total, self.message
+
+  def cancel(self):
+    self.cancelRequested.set()
+
+  def cancelled(self):
+    return self.cancelRequested.is_set()
+
+  def invalidate(self, reason):
+    """
+    Stop the run because its inputs changed under it; its results must not be used.
+    """
+    if self.invalidReason is None:
+      self.invalidReason = reason
+    self.cancel()
+
+  def removeObservations(self):
+    for observedObject, tag in self.observations:
+      observedObject.RemoveObserver(tag)
+    self.observations = []
+
+  def isRunning(self):
+    return self.thread.is_alive()
+
+class RunInstrumentation:
+  """
+  Wall time, number of calls, peak memory and added scene nodes of the phases of a run, in total and per tooth.
+  Memory is traced with tracemalloc, so it covers Python objects and NumPy arrays but not VTK data, in all threads.
+  Phases may run in a worker thread, one at a time; scene nodes are only counted in the thread that created this.
+  The whole run, from start to stop, is the "run" phase.
+  """
+
+  def __init__(self, scene=None, profile=False):
+    self.scene = scene
+    self.sceneThread = threading.get_ident()
+    self.records = {}  # (phase, tooth) -> record, in the order the phases first started
+    self.stack = []
+    self.startedTracing = False
+    self.runPhase = contextlib.ExitStack()
+    self.profilers = [] if profile else None  # one cProfile per profiled step, see profile
+
+  def start(self):
+    import tracemalloc
+    if not tracemalloc.is_tracing():
+      tracemalloc.start()
+      self.startedTracing = True
+    self.runPhase.enter_context(self.phase("run"))
+
+  def stop(self):
+    import tracemalloc
+    self.runPhase.close()
+    if self.startedTracing:
+      tracemalloc.stop()
+      self.startedTracing = False
+
+  @contextlib.contextmanager
+  def profile(self):
+    """
+    Profile a step of the run, if profiling. cProfile only sees the thread that enabled it,
+    so each step gets its own profiler in the thread it runs in.
+    """
+    if self.profilers is None:
+      yield
+      return
+    import cProfile
+    profiler = cProfile.Profile()
+    self.profilers.append(profiler)
+    profiler.enable()
+    try:
+      yield
+    finally:
+      profiler.disable()
+
+  @contextlib.contextmanager
+  def phase(self, name, tooth=None):
+    import time
+    import tracemalloc
+
+    # keep the peak seen so far by the enclosing phase before the peak is reset for this one
+    if self.stack:
+      self.stack[-1]["peak"] = max(self.stack[-1]["peak"], tracemalloc.get_traced_memory()[1])
+    tracemalloc.reset_peak()
+    frame = {"memory": tracemalloc.get_traced_memory()[0]}
+    frame["peak"] = frame["memory"]
+    self.stack.append(frame)
+    record = self.records.setdefault((name, tooth), {"calls": 0, "time": 0.0, "peakMemory": 0, "nodesAdded": 0})
+    countNodes = self.scene is not None and threading.get_ident() == self.sceneThread
+    numberOfNodes = self.scene.GetNumberOfNodes() if countNodes else 0
+    startTime = time.perf_counter()
+    try:
+      yield
+    finally:
+      elapsed = time.perf_counter() - startTime
+      self.stack.pop()
+      peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+      if self.stack:
+        self.stack[-1]["peak"] = max(self.stack[-1]["peak"], peak)
+      record["calls"] += 1
+      record["time"] += elapsed
+      record["peakMemory"] = max(record["peakMemory"], peak - frame["memory"])
+      record["nodesAdded"] += (self.scene.GetNumberOfNodes() if countNodes else 0) - numberOfNodes
+
+  def getRecords(self):
+    """
+    :return: list of dictionaries with "phase", "tooth", "calls", "time" (s), "peakMemoryMB" and "nodesAdded"
+    """
+    return [{"phase": name, "tooth": tooth, "calls": record["calls"], "time": record["time"],
+      "peakMemoryMB": record["peakMemory"] / 2**20, "nodesAdded": record["nodesAdded"]}
+      for (name, tooth), record in self.records.items()]
 
 #
 # FunctionalHomodontyTest
@@ -922,6 +3533,16 @@ class FunctionalHomodontyTest(ScriptedLoadableModuleTest):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  # jaws timed by test_SyntheticJawBenchmark: (number of teeth, voxel size in mm)
+  benchmarkConfigurations = [(4, 0.1), (16, 0.1), (4, 0.05), (16, 0.05)]
+  # capture a cProfile of each benchmark run (saved next to the run's JSON log)
+  profileBenchmark = False
+  # test_SyntheticJawBenchmark is timing only and runs with the other tests only if this is set
+  runBenchmark = False
+  # test_SyntheticJawBenchmark warns if a first run takes longer than this factor times the best recorded
+  # first run of the same jaw, plus one second
+  benchmarkMaximumSlowdown = 2.0
+
   def setUp(self):
     """ Do whatever is needed to reset the state - typically a scene clear will be enough.
     """
@@ -931,49 +3552,534 @@ class FunctionalHomodontyTest(ScriptedLoadableModuleTest):
     """Run as few or as many tests as needed here.
     """
     self.setUp()
-    self.test_FunctionalHomodonty1()
+    self.test_SyntheticJawAnalytic()
+    self.setUp()
+    self.test_FlipLegacyLines()
+    self.setUp()
+    self.test_BackgroundRun()
+    self.setUp()
+    self.test_LeanStatistics()
+    self.setUp()
+    self.test_PreviewAndDecimation()
+    self.setUp()
+    self.test_DentitionStore()
+    self.setUp()
+    self.test_ExactBootstrap()
+    if self.runBenchmark:
+      self.setUp()
+      self.test_SyntheticJawBenchmark()
+
+  def createSyntheticJaw(self, numberOfTeeth, voxelSize, jawID="Lower Jaw", namePrefix="Tooth",
+    jawLength=40.0, toothRadius=0.8, toothHeight=3.0):
+    """
+    Create a segmentation of cone-shaped teeth along a curved jaw and the jaw landmarks.
+    The jaw runs from the joint at the origin towards anterior, curving to the right and sloping down slightly;
+    lower teeth point superior, upper teeth inferior.
+    :return: segmentation node, landmarks node and dictionary of expected "basePoints", "tipPoints", "area"
+      (half of the cone surface, as measured by the module), "jointRAS", "jawtipRAS" and "inleverRAS"
+    """
+    import numpy as np
+
+    y = np.linspace(0.25, 0.95, numberOfTeeth) * jawLength
+    basePoints = np.column_stack([0.15 * y**2 / jawLength, y, -0.05 * y])
+    axis = np.array([0.0, 0.0, 1.0 if jawID == "Lower Jaw" else -1.0])
+    tipPoints = basePoints + toothHeight * axis
+    jointRAS = np.zeros(3)
+    jawtipRAS = np.array([0.15 * jawLength, jawLength, -0.05 * jawLength])
+    inleverRAS = np.array([0.0, -0.15 * jawLength, 0.1 * jawLength])
+
+    # voxel grid covering all teeth with a margin
+    margin = toothRadius + 2 * voxelSize
+    low = np.minimum(basePoints, tipPoints).min(axis=0) - margin
+    high = np.maximum(basePoints, tipPoints).max(axis=0) + margin
+    dimensions = np.ceil((high - low) / voxelSize).astype(int) + 1
+    voxels = np.zeros(dimensions[::-1], dtype=np.uint8)
+    for toothIndex, (basePoint, tipPoint) in enumerate(zip(basePoints, tipPoints)):
+      toothLow = np.maximum(np.floor((np.minimum(basePoint, tipPoint) - margin - low) / voxelSize).astype(int), 0)
+      toothHigh = np.minimum(np.ceil((np.maximum(basePoint, tipPoint) + margin - low) / voxelSize).astype(int) + 1, dimensions)
+      i, j, k = [low[axisIndex] + voxelSize * np.arange(toothLow[axisIndex], toothHigh[axisIndex]) - basePoint[axisIndex]
+        for axisIndex in range(3)]
+      along = k[:, np.newaxis, np.newaxis] * axis[2]
+      radial = np.sqrt(i[np.newaxis, np.newaxis, :]**2 + j[np.newaxis, :, np.newaxis]**2)
+      cone = (along >= 0) & (along <= toothHeight) & (radial <= toothRadius * (1 - along / toothHeight))
+      region = voxels[toothLow[2]:toothHigh[2], toothLow[1]:toothHigh[1], toothLow[0]:toothHigh[0]]
+      region[cone] = toothIndex + 1
+
+    labelmapNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+    slicer.util.updateVolumeFromArray(labelmapNode, voxels)
+    labelmapNode.SetSpacing(voxelSize, voxelSize, voxelSize)
+    labelmapNode.SetOrigin(low)
+    segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", namePrefix)
+    segmentationNode.CreateDefaultDisplayNodes()
+    slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapNode, segmentationNode)
+    slicer.mrmlScene.RemoveNode(labelmapNode)
+    for toothIndex in range(numberOfTeeth):
+      segmentationNode.GetSegmentation().GetNthSegment(toothIndex).SetName("{0} {1}".format(namePrefix, toothIndex + 1))
+
+    pointNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", namePrefix + " landmarks")
+    for point in (jointRAS, jawtipRAS, inleverRAS):
+      pointNode.AddControlPoint(point)
+
+    slantHeight = np.sqrt(toothRadius**2 + toothHeight**2)
+    return segmentationNode, pointNode, {
+      "basePoints": basePoints,
+      "tipPoints": tipPoints,
+      "area": (np.pi * toothRadius * slantHeight + np.pi * toothRadius**2) / 2,
+      "jointRAS": jointRAS,
+      "jawtipRAS": jawtipRAS,
+      "inleverRAS": inleverRAS,
+      }
+
+  def test_SyntheticJawAnalytic(self):
+    """ Compare results on synthetic lower and upper jaws with the analytic values of their cone teeth.
+    """
+    import numpy as np
+
+    self.delayDisplay("Starting the analytic test")
+    logic = FunctionalHomodontyLogic()
+    voxelSize = 0.05
+    force = 10.0
+    tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode")
+
+    for jawID, upper in (("Lower Jaw", False), ("Upper Jaw", True)):
+      segmentationNode, pointNode, expected = self.createSyntheticJaw(6, voxelSize, jawID, jawID.split()[0])
+      logic.run(segmentationNode, pointNode, force, tableNode, "Synthetic", not upper, upper, True, False, appendResults=upper)
+      self.delayDisplay('Computed ' + jawID)
+
+      results = logic.readResultsTable(tableNode)
+      rows = [row for row, rowJawID in enumerate(results["Jaw ID"]) if rowJawID == jawID]
+      self.assertEqual(len(rows), 6)
+      inLever = np.linalg.norm(expected["inleverRAS"] - expected["jointRAS"])
+      outLever = np.linalg.norm(expected["tipPoints"] - expected["jointRAS"], axis=1)
+      mechanicalAdvantage = inLever / outLever
+      stress = force * mechanicalAdvantage / (expected["area"] * 1e-6)
+      np.testing.assert_allclose(results["Jaw Length (mm)"][rows], np.linalg.norm(expected["jawtipRAS"]), rtol=1e-5)
+      # base and tip lie on the reconstructed tooth surface, within a few voxels of the ideal cone
+      np.testing.assert_allclose(results["Position (mm)"][rows], np.linalg.norm(expected["basePoints"], axis=1), atol=3 * voxelSize)
+      np.testing.assert_allclose(results["Tooth Height (mm)"][rows], 3.0, rtol=0.1)
+      np.testing.assert_allclose(results["Mechanical Advantage"][rows], mechanicalAdvantage, rtol=0.02)
+      # surface area of the voxelized cone is within a few percent of the smooth one
+      np.testing.assert_allclose(results["Surface Area (mm^2)"][rows], expected["area"], rtol=0.15)
+      np.testing.assert_allclose(results["Stress (N/m^2)"][rows], stress, rtol=0.15)
+
+    # a new force only rescales tooth force and stress, and a sweep gives one stress column per force
+    results = logic.readResultsTable(tableNode)
+    logic.updateResultsForce(tableNode, 2 * force)
+    np.testing.assert_allclose(logic.readResultsTable(tableNode)["Stress (N/m^2)"], 2 * results["Stress (N/m^2)"], rtol=1e-5)
+    toothForce, stress = logic.sweepResultsForces(tableNode, np.array([force, 3 * force]))
+    self.assertEqual(stress.shape, (12, 2))
+    np.testing.assert_allclose(stress[:, 1], 3 * results["Stress (N/m^2)"], rtol=1e-5)
+
+    # a flip switches base and tip of the teeth, a second flip restores them
+    results = logic.readResultsTable(tableNode)
+    self.assertTrue(logic.flipTeeth(tableNode, 2 * force))
+    flippedResults = logic.readResultsTable(tableNode)
+    self.assertFalse(np.allclose(flippedResults["Position (mm)"], results["Position (mm)"]))
+    np.testing.assert_allclose(flippedResults["Tooth Height (mm)"], results["Tooth Height (mm)"], rtol=1e-5)
+    logic.flipTeeth(tableNode, 2 * force)
+    np.testing.assert_allclose(logic.readResultsTable(tableNode)["Position (mm)"], results["Position (mm)"], rtol=1e-5)
+
+    # principal axis detection also finds the apex, its base point is somewhere on the base disk of the cone;
+    # lines of the last run are removed as they would take precedence
+    segmentIds = [segmentationNode.GetSegmentation().GetNthSegmentID(toothIndex) for toothIndex in range(6)]
+    for segmentId in segmentIds:
+      for lineNode in logic.getToothLines(segmentationNode, segmentId):
+        slicer.mrmlScene.RemoveNode(lineNode)
+    logic.baseTipMethod = "PrincipalAxis"
+    logic.run(segmentationNode, pointNode, force, tableNode, "Synthetic", False, True, True, False)
+    results = logic.readResultsTable(tableNode)
+    np.testing.assert_allclose(results["Tooth Height (mm)"], 3.0, rtol=0.1)
+    np.testing.assert_allclose(results["Mechanical Advantage"], mechanicalAdvantage, rtol=0.05)
+
+    # the principal axis is oriented by the jaw line, so base and tip are found directly in an upside down specimen
+    rotation = np.diag([-1.0, 1.0, -1.0])
+    transformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode")
+    transformMatrix = np.eye(4)
+    transformMatrix[:3, :3] = rotation
+    transformNode.SetMatrixTransformToParent(slicer.util.vtkMatrixFromArray(transformMatrix))
+    segmentationNode.SetAndObserveTransformNodeID(transformNode.GetID())
+    jawLandmarks = [rotation @ expected[name] for name in ("jointRAS", "jawtipRAS", "inleverRAS")]
+    toothGeometry = logic.updateToothGeometry(logic.getSegmentationData(segmentationNode, segmentIds), segmentIds,
+      "Upper Jaw", jawLandmarks=jawLandmarks)
+    toothAxis = rotation @ np.array([0.0, 0.0, -1.0])
+    for geometry, basePoint, tipPoint in zip(toothGeometry, expected["basePoints"], expected["tipPoints"]):
+      np.testing.assert_allclose(geometry["tipPoint"], rotation @ tipPoint, atol=3 * voxelSize)
+      self.assertLess(abs(np.dot(geometry["basePoint"] - rotation @ basePoint, toothAxis)), 3 * voxelSize)
+    segmentationNode.SetAndObserveTransformNodeID(None)
+
+    # compact lines: one model per folder instead of markups, markups only for teeth chosen for editing
+    for segmentId in segmentIds:
+      for lineNode in logic.getToothLines(segmentationNode, segmentId):
+        slicer.mrmlScene.RemoveNode(lineNode)
+    logic.compactLines = True
+    logic.run(segmentationNode, pointNode, force, tableNode, "Synthetic", False, True, True, False)
+    np.testing.assert_allclose(logic.readResultsTable(tableNode)["Mechanical Advantage"], results["Mechanical Advantage"], rtol=1e-5)
+    modelNode = slicer.util.getFirstNodeByClassByName("vtkMRMLModelNode", "Out Levers Model")
+    self.assertEqual(modelNode.GetPolyData().GetNumberOfCells(), 6)
+    self.assertEqual(logic.getToothLines(segmentationNode, segmentIds[0]), (None, None))
+    logic.editToothLines([(segmentationNode, segmentIds[0])])
+    self.assertEqual(modelNode.GetPolyData().GetNumberOfCells(), 5)
+    self.assertIsNotNone(logic.getToothLines(segmentationNode, segmentIds[0])[1])
+
+    self.delayDisplay('Test passed')
 
-  def test_FunctionalHomodonty1(self):
-    """ Ideally you should have several levels of tests.  At the lowest level
-    tests should exercise the functionality of the logic with different inputs
-    (both valid and invalid).  At higher levels your tests should emulate the
-    way the user would interact with your code and confirm that it still works
-    the way you intended.
-    One of the most important features of the tests is that it should alert other
-    developers when their changes will have an impact on the behavior of your
-    module.  For example, if a developer removes a feature that you depend on,
-    your test should break so they know that the feature is needed.
+  def test_FlipLegacyLines(self):
+    """ Switch all lines of a scene made by an older version, whose lines are not indexed by segment ID.
     """
+    self.delayDisplay("Starting the legacy lines flip test")
+    logic = FunctionalHomodontyLogic()
+    tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode")
+    segmentationNode, pointNode, expected = self.createSyntheticJaw(4, 0.1)
+    logic.run(segmentationNode, pointNode, 10.0, tableNode, "Synthetic", True, False, True, False)
+    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    newFolder, posFolder, outFolder = logic.getResultFolders()
+
+    # drop the index, as in scenes of older versions
+    segmentIds = [segmentationNode.GetSegmentation().GetNthSegmentID(toothIndex) for toothIndex in range(4)]
+    lines = [logic.getToothLines(segmentationNode, segmentId) for segmentId in segmentIds]
+    for segmentId, (ToothPoslineNode, ToothOutlineNode) in zip(segmentIds, lines):
+      for lineRole, lineNode in ((".Position", ToothPoslineNode), (".OutLever", ToothOutlineNode)):
+        segmentationNode.SetNodeReferenceID(logic.toothLineReferenceRole + segmentId + lineRole, None)
+        lineNode.RemoveNodeReferenceIDs(logic.toothLineSegmentationReferenceRole)
+        lineNode.RemoveAttribute(logic.toothLineSegmentIdAttribute)
+    shNode.RemoveItemAttribute(newFolder, logic.toothLinesIndexedAttribute)
+    # a line matching no segment is switched too
+    ToothPoslineNode, ToothOutlineNode = lines[0]
+    ToothPoslineNode.SetName("Unknown tooth")
+    logic.toothResultCache.clear()
+
+    # rows of uncached teeth cannot be updated in place
+    self.assertFalse(logic.flipTeeth(tableNode, 10.0))
+    for segmentId, (ToothPoslineNode, ToothOutlineNode) in zip(segmentIds, lines):
+      self.assertEqual(shNode.GetItemParent(shNode.GetItemByDataNode(ToothPoslineNode)), outFolder)
+      self.assertEqual(shNode.GetItemParent(shNode.GetItemByDataNode(ToothOutlineNode)), posFolder)
+    # matched lines are indexed again, switched, and the scene is marked as indexed
+    self.assertEqual(logic.getToothLines(segmentationNode, segmentIds[1]), (lines[1][1], lines[1][0]))
+    self.assertEqual(logic.getToothLines(segmentationNode, segmentIds[0]), (lines[0][1], None))
+    self.assertTrue(shNode.GetItemAttribute(newFolder, logic.toothLinesIndexedAttribute))
 
-    self.delayDisplay("Starting the test")
+    self.delayDisplay('Test passed')
 
-    # Get/create input data
+  def test_BackgroundRun(self):
+    """ Cancel a background run, then run one to completion and compare it with a run on the main thread,
+    and check that a run during which the segmentation is edited is discarded.
+    """
+    import json
+    import time
+    import numpy as np
 
-    import SampleData
-    #inputVolume = SampleData.downloadSample('FunctionalHomodonty1')
-    self.delayDisplay('Loaded test data set')
+    self.delayDisplay("Starting the background run test")
+    logic = FunctionalHomodontyLogic()
+    logic.useStatisticsDiskCache = False
+    force = 10.0
+    segmentationNode, pointNode, expected = self.createSyntheticJaw(6, 0.1)
+    tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode")
+    jaw = logic.createJaw(segmentationNode, pointNode, True, False, True, False)
+
+    # a cancelled run changes neither table nor lines
+    backgroundRun = logic.startBackgroundRun([jaw], force, tableNode, "Synthetic")
+    backgroundRun.cancel()
+    self.assertFalse(logic.finishBackgroundRun(backgroundRun))
+    self.assertEqual(tableNode.GetNumberOfRows(), 0)
+    self.assertEqual(len(slicer.util.getNodesByClass("vtkMRMLMarkupsLineNode")), 0)
+
+    # landmarks may be edited while the worker runs, it only reads copies
+    logic.instrumentRuns = True
+    logic.instrumentationLogPath = os.path.join(slicer.app.temporaryPath, "FunctionalHomodontyBackgroundRun.json")
+    backgroundRun = logic.startBackgroundRun([jaw], force, tableNode, "Synthetic")
+    pointNode.SetNthControlPointPosition(0, [5.0, 5.0, 5.0])
+    while backgroundRun.isRunning():
+      slicer.app.processEvents()
+      time.sleep(0.01)
+    completed, total, message = backgroundRun.getProgress()
+    self.assertEqual((completed, message), (total, "Done"))
+    self.assertTrue(logic.finishBackgroundRun(backgroundRun))
+    logic.instrumentRuns = False
+    # the steps in the worker are part of the instrumented run
+    with open(logic.instrumentationLogPath) as f:
+      phases = {record["phase"] for record in json.load(f)["phases"]}
+    self.assertTrue({"run", "segmentation data", "statistics", "base/tip points", "mechanics", "table"} <= phases)
+    backgroundResults = logic.readResultsTable(tableNode)
+    self.assertEqual(len(backgroundResults["Tooth ID"]), 6)
+    np.testing.assert_allclose(backgroundResults["Position (mm)"], np.linalg.norm(expected["basePoints"], axis=1), atol=0.3)
+
+    # same results as a run on the main thread with the same lean statistics, without the lines of the background run
+    pointNode.SetNthControlPointPosition(0, expected["jointRAS"])
+    for segmentId in jaw["segmentIds"]:
+      for lineNode in logic.getToothLines(segmentationNode, segmentId):
+        slicer.mrmlScene.RemoveNode(lineNode)
+    mainThreadLogic = FunctionalHomodontyLogic()
+    mainThreadLogic.useStatisticsDiskCache = False
+    mainThreadLogic.statisticsMethod = "Lean"
+    mainThreadTableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode")
+    mainThreadLogic.run(segmentationNode, pointNode, force, mainThreadTableNode, "Synthetic", True, False, True, False)
+    mainThreadResults = mainThreadLogic.readResultsTable(mainThreadTableNode)
+    for name in ("Position (mm)", "Tooth Height (mm)", "Surface Area (mm^2)", "Stress (N/m^2)"):
+      np.testing.assert_allclose(backgroundResults[name], mainThreadResults[name], rtol=1e-5)
+
+    # the worker reads the labelmaps without a copy, a run during which they are edited is discarded
+    logic.toothGeometryCache.clear()
+    editedTableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode")
+    backgroundRun = logic.startBackgroundRun([jaw], force, editedTableNode, "Synthetic")
+    labelmap = logic.getSegmentLabelmap(segmentationNode, jaw["segmentIds"][0])
+    labelmap.Modified()
+    with self.assertRaises(ValueError):
+      logic.finishBackgroundRun(backgroundRun)
+    self.assertEqual(editedTableNode.GetNumberOfRows(), 0)
+    self.assertFalse(any((segmentationNode.GetID(), segmentId) in logic.toothGeometryCache for segmentId in jaw["segmentIds"]))
 
-    inputScalarRange = inputVolume.GetImageData().GetScalarRange()
-    self.assertEqual(inputScalarRange[0], 0)
-    self.assertEqual(inputScalarRange[1], 695)
+    self.delayDisplay('Test passed')
 
-    outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
-    threshold = 100
+  def test_LeanStatistics(self):
+    """ Compare the lean statistics with the Segment Statistics module on a synthetic jaw, check that switching
+    between them remeasures the teeth, and that statistics read back from the disk cache are identical to the computed ones.
+    """
+    import shutil
+    import tempfile
+    import numpy as np
 
-    # Test the module logic
+    self.delayDisplay("Starting the lean statistics test")
+    logic = FunctionalHomodontyLogic()
+    logic.useStatisticsDiskCache = False
+    voxelSize = 0.1
+    segmentationNode, pointNode, expected = self.createSyntheticJaw(4, voxelSize)
+    segmentIds = [segmentationNode.GetSegmentation().GetNthSegmentID(toothIndex) for toothIndex in range(4)]
+    segmentationData = logic.getSegmentationData(segmentationNode, segmentIds)
+
+    reference = logic.computeSegmentStatistics(segmentationData, segmentIds, statisticsMethod="SegmentStatistics")
+    lean = logic.computeSegmentStatistics(segmentationData, segmentIds, statisticsMethod="Lean")
+    for segmentId in segmentIds:
+      measurement = lambda stats, name: np.array(stats[segmentId, "LabelmapSegmentStatisticsPlugin." + name])
+      np.testing.assert_allclose(measurement(lean, "surface_area_mm2"), measurement(reference, "surface_area_mm2"), rtol=0.02)
+      np.testing.assert_allclose(measurement(lean, "centroid_ras"), measurement(reference, "centroid_ras"), atol=0.1 * voxelSize)
+      np.testing.assert_allclose(np.sort(measurement(lean, "obb_diameter_mm")), np.sort(measurement(reference, "obb_diameter_mm")),
+        atol=2 * voxelSize)
+      # the tooth axis, the OBB axis with the largest diameter, may point either way
+      leanAxis = measurement(lean, "obb_direction_ras_" + "xyz"[np.argmax(measurement(lean, "obb_diameter_mm"))])
+      referenceAxis = measurement(reference, "obb_direction_ras_" + "xyz"[np.argmax(measurement(reference, "obb_diameter_mm"))])
+      self.assertGreater(abs(np.dot(leanAxis, referenceAxis)), 0.99)
+
+    # switching the statistics method remeasures teeth already in the geometry cache
+    for statisticsMethod, stats in (("Lean", lean), ("SegmentStatistics", reference)):
+      for segmentId, entry in zip(segmentIds, logic.updateToothStatistics(segmentationData, segmentIds, statisticsMethod=statisticsMethod)):
+        self.assertEqual(entry["statisticsMethod"], statisticsMethod)
+        self.assertEqual(entry["area"], stats[segmentId, "LabelmapSegmentStatisticsPlugin.surface_area_mm2"]/2)
+
+    cacheDirectory = tempfile.mkdtemp()
+    try:
+      logic.useStatisticsDiskCache = True
+      logic.statisticsCacheDirectory = cacheDirectory
+      contentHashes = {segmentId: logic.getSegmentContentHash(segmentationData, segmentId) for segmentId in segmentIds}
+      computed = logic.computeSegmentStatistics(segmentationData, segmentIds, contentHashes, "Lean")
+      self.assertEqual(len(os.listdir(cacheDirectory)), len(segmentIds))
+
+      cachedLogic = FunctionalHomodontyLogic()
+      cachedLogic.statisticsCacheDirectory = cacheDirectory
+      cachedLogic.computeLeanSegmentStatistics = lambda *args: self.fail("Statistics were not read from the disk cache")
+      cached = cachedLogic.computeSegmentStatistics(segmentationData, segmentIds, contentHashes, "Lean")
+      for segmentId in segmentIds:
+        for name in logic.statisticsMeasurements:
+          key = (segmentId, "LabelmapSegmentStatisticsPlugin." + name)
+          np.testing.assert_array_equal(np.array(cached[key]), np.array(computed[key]))
+    finally:
+      shutil.rmtree(cacheDirectory, ignore_errors=True)
+
+    self.delayDisplay('Test passed')
 
+  def test_PreviewAndDecimation(self):
+    """ Check that preview positions are within their stated error of the full resolution positions,
+    and that base and tip points found on decimated surfaces are within surfaceDecimationError of the full surface.
+    """
+    import numpy as np
+
+    self.delayDisplay("Starting the preview and decimation test")
+    logic = FunctionalHomodontyLogic()
+    logic.useStatisticsDiskCache = False
+    segmentationNode, pointNode, expected = self.createSyntheticJaw(4, 0.05)
+    segmentIds = [segmentationNode.GetSegmentation().GetNthSegmentID(toothIndex) for toothIndex in range(4)]
+
+    # preview first, full resolution lines would take precedence in the preview
+    previewTableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode")
+    logic.run(segmentationNode, pointNode, 10.0, previewTableNode, "Synthetic", True, False, True, False, preview=True)
+    tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode")
+    logic.run(segmentationNode, pointNode, 10.0, tableNode, "Synthetic", True, False, True, False)
+    previewResults = logic.readResultsTable(previewTableNode, logic.resultColumns + logic.previewResultColumns)
+    results = logic.readResultsTable(tableNode)
+    self.assertTrue(np.all(previewResults["Position Error (mm)"] > 0))
+    self.assertTrue(np.all(np.abs(previewResults["Position (mm)"] - results["Position (mm)"]) <= previewResults["Position Error (mm)"]))
+
+    for baseTipMethod in ("BoundingBox", "PrincipalAxis"):
+      decimationLogic = FunctionalHomodontyLogic()
+      decimationLogic.useStatisticsDiskCache = False
+      decimationLogic.baseTipMethod = baseTipMethod
+      decimationLogic.surfaceDecimationError = 0.05
+      segmentationData = decimationLogic.getSegmentationData(segmentationNode, segmentIds)
+      decimationLogic.updateToothStatistics(segmentationData, segmentIds)
+      toothGeometry = decimationLogic.updateToothGeometry(segmentationData, segmentIds, "Lower Jaw")
+      for segmentId, geometry in zip(segmentIds, toothGeometry):
+        surface, locator = decimationLogic.getToothSurfaceLocator(segmentationData, segmentId)
+        points = np.array([geometry["basePoint"], geometry["tipPoint"]])
+        distances = np.linalg.norm(points - decimationLogic.findClosestSurfacePoints(locator, points), axis=1)
+        self.assertTrue(np.all(distances <= decimationLogic.surfaceDecimationError + 1e-6), baseTipMethod)
+
+    self.delayDisplay('Test passed')
+
+  def test_DentitionStore(self):
+    """ Import a dentition CSV file into a store, add the rows of a run and read the dentitions back.
+    """
+    import shutil
+    import tempfile
+    import numpy as np
+
+    self.delayDisplay("Starting the dentition store test")
     logic = FunctionalHomodontyLogic()
+    storeDirectory = tempfile.mkdtemp()
+    try:
+      # headers as in master_dentition.csv, which differ in case from the result columns
+      csvPath = os.path.join(storeDirectory, "master_dentition.csv")
+      with open(csvPath, "w") as f:
+        f.write("Species,Jaw ID,Side of Face,Jaw length (mm),Tooth ID,Position (mm),Stress (N/m^2)\n")
+        for tooth in range(8):
+          f.write("Imported,Lower Jaw,Left,40,Tooth {0},{1},{2}\n".format(tooth, 5 + 4 * tooth, 1e6 * (1 + tooth % 3)))
+      logic.importDentitionCSV(os.path.join(storeDirectory, "store"), csvPath)
+
+      storeDirectory = os.path.join(storeDirectory, "store")
+      results = {name: ["NA"] * 6 if isText else np.full(6, np.nan) for name, description, unit, isText in logic.resultColumns}
+      results.update({"Species": ["Synthetic"] * 6, "Jaw ID": ["Upper Jaw"] * 6, "Side of Face": ["Left"] * 6,
+        "Tooth ID": ["Tooth {0}".format(tooth) for tooth in range(6)], "Jaw Length (mm)": np.full(6, 30.0),
+        "Position (mm)": np.linspace(5, 25, 6), "Stress (N/m^2)": np.linspace(1e6, 2e6, 6)})
+      firstChunk = logic.readDentitionStoreIndex(storeDirectory)["chunks"][0]["directory"]
+      firstChunkTimes = {name: os.stat(os.path.join(storeDirectory, firstChunk, name)).st_mtime_ns
+        for name in os.listdir(os.path.join(storeDirectory, firstChunk))}
+      logic.writeDentitionStore(storeDirectory, results)
+      # a second run of the same jaw replaces its rows
+      logic.writeDentitionStore(storeDirectory, results)
+
+      stored = logic.readDentitionStore(storeDirectory)
+      self.assertEqual(len([name for name in stored if name.lower() == "jaw length (mm)"]), 1)
+      self.assertEqual(len(stored["Species"]), 14)
+      np.testing.assert_allclose(np.sort(stored["Jaw Length (mm)"]), [30.0] * 6 + [40.0] * 8)
+      # stored chunks are not rewritten
+      self.assertEqual(firstChunkTimes, {name: os.stat(os.path.join(storeDirectory, firstChunk, name)).st_mtime_ns
+        for name in os.listdir(os.path.join(storeDirectory, firstChunk))})
+      dentitions = logic.readDentitions(storeDirectory)
+      self.assertEqual(sorted((dentition["species"], len(dentition["stress"])) for dentition in dentitions),
+        [("Imported", 8), ("Synthetic", 6)])
+      upper = logic.readDentitionStore(storeDirectory, jawID="Upper Jaw", columns=["Position (mm)"])
+      np.testing.assert_allclose(upper["Position (mm)"], np.linspace(5, 25, 6))
+
+      # duplicated headers are rejected
+      with open(csvPath, "w") as f:
+        f.write("Species,Jaw ID,Jaw length (mm),Jaw Length (mm)\nImported,Lower Jaw,40,40\n")
+      with self.assertRaises(ValueError):
+        logic.importDentitionCSV(storeDirectory, csvPath)
+    finally:
+      shutil.rmtree(os.path.dirname(storeDirectory), ignore_errors=True)
+
+    self.delayDisplay('Test passed')
 
-    # Test algorithm with non-inverted threshold
-    logic.process(inputVolume, outputVolume, threshold, True)
-    outputScalarRange = outputVolume.GetImageData().GetScalarRange()
-    self.assertEqual(outputScalarRange[0], inputScalarRange[0])
-    self.assertEqual(outputScalarRange[1], threshold)
+  def test_ExactBootstrap(self):
+    """ Compare the closed-form exact residual distribution with the enumeration of all subsamples,
+    the exact cutoffs with the sampled cutoffs, and merge residual sketches of different ranges.
+    """
+    import itertools
+    import numpy as np
 
-    # Test algorithm with inverted threshold
-    logic.process(inputVolume, outputVolume, threshold, False)
-    outputScalarRange = outputVolume.GetImageData().GetScalarRange()
-    self.assertEqual(outputScalarRange[0], inputScalarRange[0])
-    self.assertEqual(outputScalarRange[1], inputScalarRange[1])
+    self.delayDisplay("Starting the exact bootstrap test")
+    rng = np.random.default_rng(5)
+    for numberOfTeeth, sampleSize in [(9, 4), (9, 5), (8, 1), (10, 2)]:
+      stressNorm = rng.random(numberOfTeeth)
+      stressNorm[3] = stressNorm[4]
+      subsamples = np.sort(stressNorm)[np.array(list(itertools.combinations(range(numberOfTeeth), sampleSize)))]
+      enumerated = (subsamples - np.median(subsamples, axis=1, keepdims=True)).ravel()
+      residuals, weights = exactMedianResiduals(stressNorm, sampleSize, len(subsamples))
+      self.assertAlmostEqual(weights.sum(), enumerated.size)
+      for quantile in [0.05, 0.3, 0.5, 0.8, 0.95]:
+        cumulative = np.cumsum(weights)
+        weighted = residuals[np.searchsorted(cumulative, quantile * cumulative[-1] - 1e-9)]
+        self.assertAlmostEqual(weighted, np.sort(enumerated)[int(np.ceil(quantile * enumerated.size)) - 1])
+
+    logic = FunctionalHomodontyLogic()
+    dentitions = [{"stressNorm": rng.gamma(4.0, 0.25, 20)} for dentition in range(50)]
+    exact = logic.bootstrapMedianResiduals(dentitions, seed=1, exact=True)
+    sampled = logic.bootstrapMedianResiduals(dentitions, seed=1)
+    self.assertEqual(len(exact["bootstrappedResiduals"]), len(exact["residualWeights"]))
+    for cutoff in ["sd", "kmeans", "q95"]:
+      self.assertAlmostEqual(exact[cutoff], sampled[cutoff], delta=0.02 * abs(exact[cutoff]))
+
+    # sketches of separate runs merge whatever their ranges, as if all residuals were added to one sketch
+    narrowResiduals = rng.normal(0.0, 0.3, 1000)
+    wideResiduals = rng.normal(0.0, 2.5, 1000)
+    merged = ResidualSketch(np.ptp(narrowResiduals), 1024)
+    merged.add(narrowResiduals)
+    wide = ResidualSketch(np.ptp(wideResiduals), 1024)
+    wide.add(wideResiduals)
+    merged.merge(wide)
+    combined = ResidualSketch(wide.maxAbsResidual, 1024)
+    combined.add(np.concatenate([narrowResiduals, wideResiduals]))
+    self.assertEqual(merged.maxAbsResidual, combined.maxAbsResidual)
+    np.testing.assert_array_equal(merged.binCounts, combined.binCounts)
+    self.assertAlmostEqual(merged.std(), combined.std())
 
     self.delayDisplay('Test passed')
+
+  def test_SyntheticJawBenchmark(self):
+    """ Time the pipeline on synthetic jaws of growing tooth count and resolution, first run and repeated run,
+    with phase instrumentation. The on-disk statistics cache is off, so the first run measures every tooth.
+    Timings are added to FunctionalHomodontyBenchmark.json in the Slicer temporary folder, with a warning
+    if a first run is much slower than the best recorded first run of the same jaw (see benchmarkMaximumSlowdown).
+    Timings depend on the load of the machine, so they are reported, not asserted; the benchmark is not part
+    of runTest unless runBenchmark is set.
+    """
+    import json
+    import time
+
+    self.delayDisplay("Starting the benchmark")
+    benchmarkPath = os.path.join(slicer.app.temporaryPath, "FunctionalHomodontyBenchmark.json")
+    history = []
+    if os.path.exists(benchmarkPath):
+      with open(benchmarkPath) as f:
+        history = json.load(f)
+    regressions = []
+
+    for numberOfTeeth, voxelSize in self.benchmarkConfigurations:
+      slicer.mrmlScene.Clear()
+      logic = FunctionalHomodontyLogic()
+      logic.useStatisticsDiskCache = False
+      logic.instrumentRuns = True
+      logic.profileRuns = self.profileBenchmark
+      logic.instrumentationLogPath = os.path.join(slicer.app.temporaryPath,
+        "FunctionalHomodontyBenchmark-{0}-{1}.json".format(numberOfTeeth, voxelSize))
+      segmentationNode, pointNode, expected = self.createSyntheticJaw(numberOfTeeth, voxelSize)
+      tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode")
+
+      runTimes = []
+      phases = []
+      for repeat in range(2):
+        startTime = time.perf_counter()
+        logic.run(segmentationNode, pointNode, 10.0, tableNode, "Synthetic", True, False, True, False)
+        runTimes.append(time.perf_counter() - startTime)
+        with open(logic.instrumentationLogPath) as f:
+          phases.append(json.load(f)["phases"])
+      self.assertEqual(tableNode.GetTable().GetNumberOfRows(), numberOfTeeth)
+
+      previousTimes = [record["firstRun"] for record in history
+        if record["numberOfTeeth"] == numberOfTeeth and record["voxelSize"] == voxelSize]
+      if previousTimes and runTimes[0] > self.benchmarkMaximumSlowdown * min(previousTimes) + 1.0:
+        regressions.append("{0} teeth at {1} mm took {2:.2f} s, best recorded run took {3:.2f} s".format(
+          numberOfTeeth, voxelSize, runTimes[0], min(previousTimes)))
+      history.append({
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "numberOfTeeth": numberOfTeeth,
+        "voxelSize": voxelSize,
+        "firstRun": runTimes[0],
+        "repeatedRun": runTimes[1],
+        "phases": {"firstRun": phases[0], "repeatedRun": phases[1]},
+        })
+      self.delayDisplay("{0} teeth at {1} mm: {2:.2f} s, repeated {3:.2f} s".format(numberOfTeeth, voxelSize, runTimes[0], runTimes[1]))
+
+    with open(benchmarkPath, "w") as f:
+      json.dump(history, f, indent=2)
+    for regression in regressions:
+      logging.warning('Benchmark slower than before: ' + regression)
+    self.delayDisplay('Benchmark written to ' + benchmarkPath)